@@ -0,0 +1,73 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Checks and benchmarks clean_names() against Series.apply(clean_name).
+
+Usage:
+    python benchmarks/bench_clean_name.py [n_rows] [n_unique]
+"""
+
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parents[1] / "src" / "mic_drop_results")
+)
+from utils import _clean_name, clean_name, clean_names
+
+
+def legacy_clean_name(text) -> str:
+    """clean_name() before it was memoized, kept as the reference."""
+    return _clean_name.__wrapped__(str(text))
+
+
+def timed(func, *args) -> tuple[float, pd.Series]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(n_rows: int, n_unique: int) -> None:
+    rng = np.random.default_rng(0)
+
+    # Usernames with accents, spaces, symbols and discriminators
+    names = np.array(
+        [
+            f"{rng.choice(['Nguyễn', 'Zoë', 'mic', 'DROP'])} {i}"
+            f"{rng.choice(['', '_', '.', '..x', '#1234', ' ★'])}"
+            for i in range(n_unique)
+        ],
+        dtype=object,
+    )
+    column = pd.Series(names[rng.integers(0, n_unique, size=n_rows)])
+    column[::97] = None
+
+    legacy_time, expected = timed(column.apply, legacy_clean_name)
+
+    _clean_name.cache_clear()
+    cold_time, cleaned = timed(clean_names, column)
+    warm_time, _ = timed(clean_names, column)  # e.g. the next sheet
+    apply_time, _ = timed(column.apply, clean_name)
+
+    assert cleaned.equals(expected), "Normalized names mismatch"
+    print(
+        f"{n_rows} rows, {n_unique} unique names:  "
+        f"legacy apply {legacy_time * 1000:8.1f} ms  "
+        f"memoized apply {apply_time * 1000:7.1f} ms  "
+        f"clean_names {cold_time * 1000:7.1f} ms cold "
+        f"({legacy_time / cold_time:.0f}x), "
+        f"{warm_time * 1000:6.1f} ms warm ({legacy_time / warm_time:.0f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2_000,
+    )
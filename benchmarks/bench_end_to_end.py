@@ -0,0 +1,245 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Benchmarks every stage of a run on synthetic seasons, fully offline.
+
+Each scenario generates a data file and a template, serves the avatars
+from a local stub of Discord's API and CDN, and times the stages of the
+pipeline separately. Use --json to save the timings and compare them
+across versions.
+
+Usage:
+    python benchmarks/bench_end_to_end.py [--scenario NAME ...] [--json PATH]
+"""
+
+import argparse
+from collections import defaultdict
+from collections.abc import Iterator
+import contextlib
+import json
+from pathlib import Path
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parents[1] / "src" / "mic_drop_results")
+)
+import client
+import utils
+from avatar_cache import AvatarCache
+from avatars import AvatarRenderer
+from config import Config
+from compiled_template import compile_template, open_compiled_template
+from generate import fill_presentation
+import instrument
+from processing import process_data
+from slides import duplicate_slides, save_presentation
+from stats import export_statistics
+
+from stub_discord import StubDiscordServer
+from synthetic import make_season, make_template
+
+SCENARIOS = {
+    "small": dict(
+        n_sheets=2,
+        n_rows=20,
+        n_scols=2,
+        n_scores=4,
+        n_tables=1,
+        n_db_rows=200,
+        n_templates=2,
+        n_fields=4,
+    ),
+    "medium": dict(
+        n_sheets=6,
+        n_rows=60,
+        n_scols=3,
+        n_scores=8,
+        n_tables=2,
+        n_db_rows=2_000,
+        n_templates=3,
+        n_fields=8,
+    ),
+    "large": dict(
+        n_sheets=15,
+        n_rows=150,
+        n_scols=5,
+        n_scores=12,
+        n_tables=3,
+        n_db_rows=20_000,
+        n_templates=4,
+        n_fields=16,
+    ),
+}
+
+STAGES = [
+    "load",
+    "validate",
+    "rank",
+    "merge",
+    "avatars",
+    "duplicate",
+    "fill",
+    "save",
+    "statistics",
+]
+
+
+class StageTimer:
+    """Accumulates the wall time spent in every stage."""
+
+    def __init__(self) -> None:
+        self.timings: defaultdict[str, float] = defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+
+def run_scenario(params: dict, work_dir: Path, *, latency: float) -> dict:
+    timer = StageTimer()
+
+    data_dir = work_dir / "data.xlsx"
+    template_dir = work_dir / "template.pptx"
+    make_season(data_dir, **{k: v for k, v in params.items() if k != "n_fields"})
+    make_template(
+        template_dir,
+        n_templates=params["n_templates"],
+        n_fields=params["n_fields"],
+        n_scores=params["n_scores"],
+    )
+
+    cfg = Config(str(Path(utils.__file__).with_name("settings.ini")))
+    cfg.sort_orders = [True] + [False] * (params["n_scols"] - 1)
+
+    # Section F: read and process the data file, like main.py does
+    instrument.collect()  # forget the spans of the previous scenario
+    start = time.perf_counter()
+    groups, _ = process_data(data_dir, sort_orders=cfg.sort_orders)
+    total = time.perf_counter() - start
+
+    # Split the time by the spans of process_data(). The rest is spent on the
+    # validation and on indexing the database tables
+    spans = defaultdict(float)
+    for event in instrument.collect()["events"]:
+        if event["ph"] == "X":  # not the thread names
+            spans[event["name"]] += event["dur"] / 1e6
+    timer.timings["load"] += spans["load workbook"]
+    timer.timings["rank"] += spans["rank"]
+    timer.timings["merge"] += spans["merge"]
+    timer.timings["validate"] += total - sum(
+        spans[name] for name in ("load workbook", "rank", "merge")
+    )
+
+    # Section G: download avatars from the stub, then generate every sheet
+    avatar_dir = work_dir / "avatars"
+    avatar_dir.mkdir()
+    uids = list(dict.fromkeys(u for df in groups.values() for u in df["__uid"]))
+    statuses = {}
+
+    with StubDiscordServer(latency=latency) as server, timer("avatars"):
+        client.DISCORD_API_URL, client.DISCORD_CDN_URL = server.api_url, server.cdn_url
+        client.fetch_avatars(
+            uids,
+            ["stub-token"],
+            size=cfg.avatar_resolution,
+            cache=AvatarCache(
+                work_dir / "avatar_cache.json",
+                ttl=60,
+                max_size=2**40,
+                avatar_dir=avatar_dir,
+            ),
+            on_done=statuses.__setitem__,
+        )
+    assert len(statuses) == len(uids), "Some avatars were not processed"
+
+    renderer = AvatarRenderer(avatar_dir=avatar_dir)
+    with timer("duplicate"):
+        template = compile_template(
+            template_dir,
+            trigger_word=cfg.trigger_word,
+            cache_dir=work_dir / "template_cache.pkl",
+        )
+    for sheet, df in groups.items():
+        with timer("duplicate"):
+            prs = open_compiled_template(template)
+            duplicate_slides(prs, df["__template"])
+
+        with timer("fill"):
+            fill_presentation(
+                prs, df, cfg=cfg, field_maps=template.field_maps, renderer=renderer
+            )
+
+        with timer("save"):
+            save_presentation(prs, work_dir / f"{sheet}.pptx")
+
+        with timer("statistics"):
+            export_statistics(df, work_dir / f"{sheet} Statistics.xlsx")
+
+    return {
+        "params": params,
+        "slides": sum(len(df) for df in groups.values()),
+        "avatars": len(uids),
+        "timings": {stage: timer.timings[stage] for stage in STAGES},
+        "total": sum(timer.timings.values()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n")[0])
+    parser.add_argument(
+        "--scenario",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=["small", "medium"],
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.02,
+        help="seconds added to every stub response (default: 0.02)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=1000,
+        help="requests per second per token (default: 1000)",
+    )
+    parser.add_argument("--json", type=Path, help="save the results to this file")
+    args = parser.parse_args()
+
+    client.DISCORD_RATE_LIMIT = args.rate_limit
+
+    results = {}
+    print(f"{'scenario':10}" + "".join(f"{s:>11}" for s in STAGES + ["total"]))
+    for name in args.scenario:
+        with tempfile.TemporaryDirectory() as work_dir:
+            result = run_scenario(SCENARIOS[name], Path(work_dir), latency=args.latency)
+        results[name] = result
+
+        timings = list(result["timings"].values()) + [result["total"]]
+        print(f"{name:10}" + "".join(f"{t * 1000:9.0f}ms" for t in timings))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "scenarios": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Benchmarks the import time of every stage of a run, to track cold start.
+
+Every stage is imported in a fresh interpreter with -X importtime, after
+the stages before it, so only the modules it adds are counted. Startup
+must not load any of HEAVY_MODULES.
+
+Usage:
+    python benchmarks/bench_importtime.py [repeats]
+"""
+
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = Path(__file__).resolve().parents[1] / "src" / "mic_drop_results"
+
+# The modules every stage of main.py imports, in order
+STAGES = {
+    "startup": ["main"],
+    "E: update check": ["requests"],
+    "F: process data": ["processing"],
+    "G: generate": ["fields", "generate", "incremental", "slides"],
+    "statistics": ["stats", "xlsxwriter"],
+    "avatar download": ["aiohttp"],
+    "avatar render": ["cv2"],
+}
+
+HEAVY_MODULES = ["pandas", "numpy", "cv2", "pptx", "aiohttp", "xlsxwriter", "requests"]
+
+
+def import_time(before: list[str], modules: list[str]) -> tuple[float, list[str]]:
+    """Returns the import time of the modules in seconds and the heavy
+    modules they loaded, with the modules of before already imported."""
+    code = "".join(f"import {m}\n" for m in before)
+    code += "import sys\n__loaded = set(sys.modules)\n"
+    code += "".join(f"import {m}\n" for m in modules)
+    code += "print(*sorted(set(sys.modules) - __loaded))"
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=SRC_DIR,
+        env=os.environ | {"PYTHONPATH": str(SRC_DIR)},
+    )
+
+    # Top-level lines look like "import time:  self [us] | cumulative | name"
+    total = 0
+    for line in result.stderr.splitlines():
+        _, _, fields = line.partition("import time:")
+        if fields and "|" in fields:
+            _, cumulative, name = fields.split("|")
+            if not name.startswith("  ") and name.strip() in modules:
+                total += int(cumulative)
+
+    loaded = result.stdout.split()
+    return total / 1e6, [m for m in HEAVY_MODULES if m in loaded]
+
+
+def main(repeats: int) -> None:
+    before: list[str] = []
+    failed = False
+
+    print(f"{'stage':20}{'median':>10}{'min':>10}  heavy modules loaded")
+    for stage, modules in STAGES.items():
+        runs = [import_time(before, modules) for _ in range(repeats)]
+        times = [t for t, _ in runs]
+        heavy = runs[0][1]
+
+        print(
+            f"{stage:20}{statistics.median(times) * 1000:8.0f}ms"
+            f"{min(times) * 1000:8.0f}ms  {', '.join(heavy) or '-'}"
+        )
+        if stage == "startup" and heavy:
+            failed = True
+        before += modules
+
+    if failed:
+        sys.exit("Startup loads heavy modules, import them lazily instead.")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
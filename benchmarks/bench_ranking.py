@@ -0,0 +1,65 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Checks and benchmarks rank_rows() against the row-wise tuple ranking.
+
+Usage:
+    python benchmarks/bench_ranking.py [n_rows]
+"""
+
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parents[1] / "src" / "mic_drop_results")
+)
+from processing import rank_rows
+
+
+def legacy_rank(df: pd.DataFrame, sort_orders: list[bool]) -> np.ndarray:
+    """The ranking used before rank_rows(), kept as the reference."""
+    return (
+        pd.DataFrame(df * (np.array(sort_orders) * 2 - 1))
+        .apply(tuple, axis=1)  # type: ignore
+        .rank(method="min", ascending=False)
+        .astype(int)
+        .to_numpy()
+    )
+
+
+def timed(func, *args) -> tuple[float, np.ndarray]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main(n_rows: int) -> None:
+    rng = np.random.default_rng(0)
+
+    for sort_orders in ([True], [True, False], [False, True, True], [True] * 5):
+        n_cols = len(sort_orders)
+
+        # Few distinct values to produce plenty of ties
+        df = pd.DataFrame(rng.integers(0, 21, size=(n_rows, n_cols)) / 2)
+        df.iloc[::7, 0] = rng.normal(size=len(df.iloc[::7]))
+
+        legacy_time, expected = timed(legacy_rank, df, sort_orders)
+        new_time, ranks = timed(rank_rows, df.to_numpy(dtype=float), sort_orders)
+
+        assert np.array_equal(ranks, expected), f"Rank mismatch for {sort_orders}"
+        print(
+            f"{n_rows} rows, {n_cols} sort cols:  "
+            f"legacy {legacy_time * 1000:9.1f} ms  "
+            f"rank_rows {new_time * 1000:7.1f} ms  "
+            f"({legacy_time / new_time:.0f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
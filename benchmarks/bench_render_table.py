@@ -0,0 +1,122 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Benchmarks turning the processed data into the text of the slides.
+
+Compares the per-cell and per-row conversions used before against the
+vectorized ones, processing.format_floats() for the ranked sheet and
+generate.render_rows() for the fill loop, and checks that both produce
+the same text.
+
+Usage:
+    python benchmarks/bench_render_table.py [--rows N] [--cols N] [--repeats N]
+"""
+
+import argparse
+from collections.abc import Callable
+from pathlib import Path
+import statistics
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(
+    0, str(Path(__file__).resolve().parents[1] / "src" / "mic_drop_results")
+)
+from generate import render_rows
+from processing import format_floats
+
+
+def make_sheet(n_rows: int, n_cols: int, *, seed: int = 0) -> pd.DataFrame:
+    """Makes a ranked sheet with half float columns, like scores and
+    averages, and the rest split between whole numbers and text."""
+    rng = np.random.default_rng(seed)
+    columns = {}
+
+    for i in range(n_cols):
+        match i % 4:
+            case 0 | 1:  # scores, a third of them whole, some missing
+                values = rng.integers(0, 100, n_rows) / rng.choice([1, 4, 3], n_rows)
+                values[rng.random(n_rows) < 0.05] = np.nan
+                columns[f"score{i}"] = values
+            case 2:
+                columns[f"count{i}"] = rng.integers(0, 10_000, n_rows)
+            case 3:
+                words = np.array(["lorem", "ipsum", "dolor", None], dtype=object)
+                columns[f"text{i}"] = words[rng.integers(0, 4, n_rows)]
+
+    df = pd.DataFrame(columns)
+    df["__r"] = np.arange(1, n_rows + 1)
+    df["__template"] = 1
+    return df
+
+
+def format_floats_per_cell(df: pd.DataFrame) -> pd.DataFrame:
+    """The former formatting of rank_sheet(), one lambda call per cell."""
+    df = df.copy()
+    format_int = lambda x: str(int(x)) if x % 1 == 0 else str(x)
+    df.loc[:, df.dtypes == float] = df.loc[:, df.dtypes == float].applymap(format_int)
+    return df
+
+
+def format_floats_vectorized(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for col_ind in np.flatnonzero(df.dtypes == float):
+        df.isetitem(col_ind, format_floats(df.iloc[:, col_ind].to_numpy()))
+    return df
+
+
+def render_rows_per_row(df: pd.DataFrame) -> list[dict[str, str]]:
+    """The former conversion of fill_presentation(), one Series per row."""
+    return [
+        {k.lstrip("__"): str(v) for k, v in df.iloc[i].fillna("").to_dict().items()}
+        for i in range(len(df))
+    ]
+
+
+def render_rows_vectorized(df: pd.DataFrame) -> list[dict[str, str]]:
+    return list(render_rows(df))
+
+
+def best_of(repeats: int, func: Callable, *args) -> tuple[float, float, object]:
+    """Returns the median and minimum time of func in seconds, and its result."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), min(times), result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n")[0])
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--cols", type=int, default=40)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_sheet(args.rows, args.cols)
+    print(f"{args.rows} rows x {args.cols} columns, {args.repeats} repeats")
+    print(f"{'stage':28}{'median':>10}{'min':>10}")
+
+    def run(stage: str, func: Callable, df: pd.DataFrame):
+        median, best, result = best_of(args.repeats, func, df)
+        print(f"{stage:28}{median * 1000:8.0f}ms{best * 1000:8.0f}ms")
+        return result
+
+    formatted = run("format floats (before)", format_floats_per_cell, df)
+    df = run("format floats (after)", format_floats_vectorized, df)
+    if not formatted.astype(str).equals(df.astype(str)):
+        sys.exit("format floats: the vectorized output differs")
+
+    rows = run("render rows (before)", render_rows_per_row, df)
+    if rows != run("render rows (after)", render_rows_vectorized, df):
+        sys.exit("render rows: the vectorized output differs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""A local stand-in for Discord's API and CDN, so benchmarks run offline.
+
+Routes:
+    GET /api/users/<uid>                    user object with an avatar hash
+    GET /cdn/avatars/<uid>/<hash>.png       a 256x256 PNG unique to the user
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "StubDiscordServer"
+
+    def log_message(self, *args) -> None:
+        pass  # keep the benchmark output clean
+
+    def _send(self, code: int, body: bytes, content_type: str) -> None:
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-RateLimit-Remaining", "49")
+        self.send_header("X-RateLimit-Reset-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        time.sleep(self.server.latency)
+        parts = self.path.split("?")[0].strip("/").split("/")
+
+        match parts:
+            case ["api", "users", uid]:
+                self.server.count("api")
+                body = json.dumps({"id": uid, "avatar": f"a{uid[-8:]}"})
+                self._send(200, body.encode(), "application/json")
+            case ["cdn", "avatars", uid, _]:
+                self.server.count("cdn")
+                self._send(200, self.server.render(uid), "image/png")
+            case _:
+                self._send(404, b'{"message": "404: Not Found"}', "application/json")
+
+
+class StubDiscordServer(ThreadingHTTPServer):
+    """Serves fake users and avatars on a free local port.
+
+    Attributes:
+        latency: seconds every response is delayed by, to mimic the
+            round trip to Discord.
+        hits: number of requests per route, "api" and "cdn".
+    """
+
+    daemon_threads = True
+
+    def __init__(self, *, latency: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.hits = {"api": 0, "cdn": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api"
+
+    @property
+    def cdn_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/cdn"
+
+    def count(self, route: str) -> None:
+        with self._lock:
+            self.hits[route] += 1
+
+    def render(self, uid: str) -> bytes:
+        rng = np.random.default_rng(int(uid) % 2**32)
+        img = np.empty((256, 256, 3), dtype=np.uint8)
+        img[:] = rng.integers(0, 256, size=3)
+        cv2.circle(img, (128, 100), 50, rng.integers(0, 256, size=3).tolist(), -1)
+        return cv2.imencode(".png", img)[1].tobytes()
+
+    def __enter__(self) -> "StubDiscordServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
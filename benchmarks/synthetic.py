@@ -0,0 +1,120 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Generates synthetic data files and templates for the benchmarks."""
+
+from pathlib import Path
+
+import cv2
+import numpy as np
+import openpyxl
+from pptx import Presentation
+from pptx.util import Cm, Pt
+
+FIRST_NAMES = ["Nguyễn", "Zoë", "Mic", "Drop", "Ánh", "Lee", "Kai", "Mø", "Ana"]
+COUNTRIES = ["VN", "US", "DE", "BR", "JP", "NO", "FR"]
+
+
+def make_uid(i: int) -> str:
+    """Returns a Discord-like 18-digit user ID."""
+    return str(100_000_000_000_000_000 + i * 7919)
+
+
+def make_name(i: int) -> str:
+    return f"{FIRST_NAMES[i % len(FIRST_NAMES)]} {i}"
+
+
+def make_season(
+    data_dir: Path,
+    *,
+    n_sheets: int,
+    n_rows: int,
+    n_scols: int,
+    n_scores: int,
+    n_tables: int,
+    n_db_rows: int,
+    n_templates: int,
+    seed: int = 0,
+) -> None:
+    """Writes a data file with group sheets and database tables.
+
+    Every group sheet starts with n_scols sorting columns, followed by
+    the contestant name, n_scores score columns, the user ID and the
+    template ID. Contestants repeat across sheets, like in a season.
+    Every database table is keyed by the contestant name.
+    """
+    rng = np.random.default_rng(seed)
+    n_contestants = max(n_db_rows, n_rows)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    for s in range(n_sheets):
+        ws = workbook.create_sheet(f"Group {s + 1}")
+        ws.append(
+            ["avg"]
+            + [f"tie_breaker_{c}" for c in range(1, n_scols)]
+            + ["name"]
+            + [f"score{c}" for c in range(1, n_scores + 1)]
+            + ["__uid", "__template"]
+        )
+
+        contestants = rng.choice(n_contestants, size=n_rows, replace=False)
+        for i in contestants:
+            scores = np.round(rng.uniform(0, 10, size=n_scores), 1)
+            scols = [round(float(scores.mean()), 2)]
+            scols += rng.integers(0, 5, size=n_scols - 1).tolist()  # plenty of ties
+            ws.append(
+                scols
+                + [make_name(i)]
+                + scores.tolist()
+                + [f"_{make_uid(i)}", int(rng.integers(1, n_templates + 1))]
+            )
+
+    for t in range(n_tables):
+        ws = workbook.create_sheet(f"(contestants {t + 1})")
+        ws.append(["name", f"country_{t + 1}", f"team_{t + 1}"])
+        for i in range(n_db_rows):
+            ws.append(
+                [
+                    make_name(i).upper(),  # matched after clean_name()
+                    COUNTRIES[i % len(COUNTRIES)],
+                    f"Team {i % 37}",
+                ]
+            )
+
+    workbook.save(data_dir)
+
+
+def make_template(
+    template_dir: Path, *, n_templates: int, n_fields: int, n_scores: int
+) -> None:
+    """Writes a template with n_fields text fields per template slide.
+
+    Every template slide has an avatar placeholder, the name and rank,
+    and a shared logo image, followed by score fields. Even template
+    slides apply the grayscale effect to the avatar.
+    """
+    prs = Presentation()
+    logo_dir = template_dir.with_suffix(".png")
+    cv2.imwrite(str(logo_dir), np.full((64, 64, 3), (40, 90, 200), dtype=np.uint8))
+
+    for t in range(n_templates):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])  # blank
+        slide.shapes.add_picture(str(logo_dir), Cm(22), Cm(0.5), Cm(2), Cm(2))
+
+        avatar = slide.shapes.add_textbox(Cm(1), Cm(1), Cm(4), Cm(4))
+        avatar.text_frame.text = "{p}" + ("1" if t % 2 else "")
+
+        title = slide.shapes.add_textbox(Cm(6), Cm(1), Cm(12), Cm(2))
+        title.text_frame.text = "#{r}  {name}  ({country_1})"
+
+        for f in range(n_fields):
+            box = slide.shapes.add_textbox(
+                Cm(1 + (f % 4) * 6), Cm(6 + (f // 4) * 1.5), Cm(5), Cm(1.2)
+            )
+            box.text_frame.text = "{score" + str(f % n_scores + 1) + "}"
+            box.text_frame.paragraphs[0].runs[0].font.size = Pt(14)
+
+    prs.save(str(template_dir))
+    logo_dir.unlink()
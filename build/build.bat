@@ -1,3 +1,4 @@
 CALL d:\GitHub\.venv\md_results\Scripts\activate
 cxfreeze -c D:\GitHub\mic-drop-results\src\mic_drop_results\main.py --target-dir output --icon="icon.ico"
+cxfreeze -c D:\GitHub\mic-drop-results\src\mic_drop_results\cli.py --target-dir output --target-name=mic-drop-results --icon="icon.ico"
 pause
\ No newline at end of file
@@ -0,0 +1,133 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from collections.abc import Iterable
+import contextlib
+import json
+import os
+import threading
+import time
+
+from constants import *
+from utils import get_avatar_dir
+
+
+class AvatarCache:
+    """Persistent index of the downloaded avatars.
+
+    Every entry is keyed by user ID and remembers the URL the avatar was
+    downloaded from, which contains the avatar hash and resolution. An
+    entry stays fresh until it expires, after which the user's avatar
+    URL has to be fetched again, but the avatar itself is only
+    re-downloaded if the URL has changed.
+
+    The index is stored as a JSON manifest. The least recently used
+    avatars are evicted once the cache grows past its size limit.
+
+    Attributes:
+        manifest_dir: path to the JSON manifest.
+        ttl: number of seconds an entry stays fresh after validation.
+        max_size: maximum total size of the cached avatars in bytes.
+        avatar_dir: the folder of the avatars.
+        entries: the index, mapping user IDs to their entries.
+    """
+
+    def __init__(
+        self,
+        manifest_dir: Path,
+        *,
+        ttl: float,
+        max_size: int,
+        avatar_dir: Path = AVATAR_DIR,
+    ) -> None:
+        self.manifest_dir = manifest_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self.avatar_dir = avatar_dir
+        self.entries: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            with open(manifest_dir, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def get_avatar_dir(self, uid: str) -> Path:
+        """Returns the path to the avatar file of the user."""
+        return get_avatar_dir(uid, avatar_dir=self.avatar_dir)
+
+    def is_fresh(self, uid: str) -> bool:
+        """Checks if the avatar is downloaded and needs no revalidation."""
+        entry = self.entries.get(uid)
+        return (
+            entry is not None
+            and entry["expires"] > time.time()
+            and self.get_avatar_dir(uid).is_file()
+        )
+
+    def is_current(self, uid: str, avatar_url: str) -> bool:
+        """Checks if the avatar downloaded from avatar_url is cached."""
+        entry = self.entries.get(uid)
+        return (
+            entry is not None
+            and entry["url"] == avatar_url
+            and self.get_avatar_dir(uid).is_file()
+        )
+
+    def revalidate(self, uid: str) -> None:
+        """Marks the cached avatar as up to date for another TTL period."""
+        with self._lock:
+            self.entries[uid]["expires"] = time.time() + self.ttl
+
+    def add(self, uid: str, avatar_url: str) -> None:
+        """Adds or replaces the entry of a freshly downloaded avatar."""
+        now = time.time()
+        with self._lock:
+            self.entries[uid] = {
+                "url": avatar_url,
+                "expires": now + self.ttl,
+                "used": now,
+                "size": self.get_avatar_dir(uid).stat().st_size,
+            }
+
+    def touch(self, uids: Iterable[str]) -> None:
+        """Marks the avatars as recently used."""
+        now = time.time()
+        with self._lock:
+            for uid in uids:
+                if uid in self.entries:
+                    self.entries[uid]["used"] = now
+
+    def evict(self, *, keep: Iterable[str] = ()) -> None:
+        """Removes the least recently used avatars over the size limit.
+
+        Args:
+            keep (optional): the user IDs that must not be evicted, e.g.
+                the avatars used in the current run. Defaults to ().
+        """
+        keep = set(keep)
+        with self._lock:
+            # Forget the avatars that have been deleted manually
+            for uid in [u for u in self.entries if not self.get_avatar_dir(u).is_file()]:
+                del self.entries[uid]
+
+            total_size = sum(entry["size"] for entry in self.entries.values())
+            lru = sorted(self.entries, key=lambda u: self.entries[u]["used"])
+            for uid in lru:
+                if total_size <= self.max_size:
+                    break
+                if uid in keep:
+                    continue
+
+                total_size -= self.entries.pop(uid)["size"]
+                for img_dir in self.avatar_dir.glob(f"*_{uid}.png"):  # with effects
+                    os.unlink(img_dir)
+
+    def save(self) -> None:
+        """Writes the index to the manifest."""
+        with self._lock:
+            tmp_dir = self.manifest_dir.with_suffix(".tmp")
+            with open(tmp_dir, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_dir, self.manifest_dir)
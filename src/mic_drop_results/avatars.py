@@ -0,0 +1,186 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from collections import OrderedDict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+from typing import TYPE_CHECKING
+
+from constants import *
+from utils import get_avatar_dir
+
+if TYPE_CHECKING:  # OpenCV and NumPy are only loaded to render an avatar
+    import numpy as np
+
+
+EMU_PER_PX = 9525  # English Metric Units per pixel at 96 DPI
+
+
+def _apply_effect(img: "np.ndarray", effect: int) -> "np.ndarray":
+    """Applies the artistic effect of a {p} field to a decoded image.
+
+    The image can be greyscale, BGR or BGRA, as decoded with
+    cv2.IMREAD_UNCHANGED, and is returned in BGRA with its alpha kept.
+    """
+    import cv2
+    import numpy as np
+
+    if img.dtype != np.uint8:  # 16-bit PNG
+        img = (img // 257).astype(np.uint8)
+    if img.ndim == 2 or img.shape[2] == 1:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+    elif img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+    else:  # the decoded image is shared by every render of the user
+        img = img.copy()
+
+    match effect:  # TODO: add more effects
+        case 1:
+            grey = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY)
+            img[:, :, :3] = grey[:, :, None]
+    return img
+
+
+def _crop_circle(img: "np.ndarray") -> "np.ndarray":
+    """Makes everything outside the inscribed ellipse of a BGRA image
+    transparent, keeping the transparency of the image inside it."""
+    import cv2
+    import numpy as np
+
+    h, w = img.shape[:2]
+    mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.ellipse(
+        mask, (w // 2, h // 2), (w // 2, h // 2), 0, 0, 360, 255, -1, cv2.LINE_AA
+    )
+
+    img[:, :, 3] = np.minimum(img[:, :, 3], mask)
+    return img
+
+
+def render_avatar(img: "np.ndarray", *, effect: int, size: tuple[int, int]) -> bytes:
+    """Renders a decoded avatar for a {p} field as PNG bytes.
+
+    Args:
+        img: the decoded avatar in greyscale, BGR or BGRA.
+        effect: the coefficient of the {p} field.
+        size: the size of the placeholder shape in EMU.
+
+    Returns:
+        bytes: the PNG with the effect applied, resized to the
+            placeholder and cropped to a circle.
+    """
+    import cv2
+
+    img = _apply_effect(img, effect)
+
+    # Downscale to the displayed size, PowerPoint can upscale on its own
+    h, w = img.shape[:2]
+    width, height = (round(s / EMU_PER_PX * AVATAR_RENDER_SCALE) for s in size)
+    width, height = max(1, min(width, w)), max(1, min(height, h))
+    if (width, height) != (w, h):
+        img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+    _, buffer = cv2.imencode(".png", _crop_circle(img))
+    return buffer.tobytes()
+
+
+class AvatarRenderer:
+    """Renders the avatars of the {p} fields and keeps them in memory.
+
+    Rendered avatars are cached by user ID, effect and placeholder size,
+    so an avatar is rendered once no matter how many slides show it.
+    The least recently used renders are dropped once the cache grows
+    past its size limit.
+
+    Attributes:
+        max_size: maximum total size of the cached PNGs in bytes.
+        avatar_dir: the folder of the downloaded avatars.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = AVATAR_RENDER_CACHE_SIZE,
+        avatar_dir: Path = AVATAR_DIR,
+    ) -> None:
+        self.max_size = max_size
+        self.avatar_dir = avatar_dir
+        self._cache: OrderedDict[tuple, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _get_avatar_dir(self, uid: str) -> Path:
+        return get_avatar_dir(uid, avatar_dir=self.avatar_dir)
+
+    def _get_key(self, uid: str, effect: int, size: tuple[int, int]) -> tuple | None:
+        try:  # the modification time tells re-downloaded avatars apart
+            mtime = os.stat(self._get_avatar_dir(uid)).st_mtime_ns
+        except OSError:
+            return None
+        return uid, effect, size, mtime
+
+    def _store(self, key: tuple, png: bytes) -> None:
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = png
+            self._size += len(png)
+
+            while self._size > self.max_size and len(self._cache) > 1:
+                self._size -= len(self._cache.popitem(last=False)[1])
+
+    def get(self, uid: str, *, effect: int, size: tuple[int, int]) -> bytes | None:
+        """Returns the rendered avatar, or None if it is not downloaded."""
+        if (key := self._get_key(uid, effect, size)) is None:
+            return None
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        import cv2
+
+        img = cv2.imread(str(self._get_avatar_dir(uid)), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            return None
+
+        png = render_avatar(img, effect=effect, size=size)
+        self._store(key, png)
+        return png
+
+    def _prerender_uid(self, uid: str, specs: set[tuple[int, tuple[int, int]]]) -> None:
+        keys = {spec: self._get_key(uid, *spec) for spec in specs}
+        with self._lock:
+            keys = {s: k for s, k in keys.items() if k and k not in self._cache}
+        if not keys:
+            return
+
+        import cv2
+
+        # Decode once for every effect and size of the user
+        img = cv2.imread(str(self._get_avatar_dir(uid)), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            return
+
+        for (effect, size), key in keys.items():
+            self._store(key, render_avatar(img, effect=effect, size=size))
+
+    def prerender(self, jobs: Iterable[tuple[str, int, tuple[int, int]]]) -> None:
+        """Renders avatars in parallel ahead of filling the slides.
+
+        Args:
+            jobs: (user ID, effect, placeholder size in EMU) tuples.
+        """
+        specs_by_uid: dict[str, set[tuple[int, tuple[int, int]]]] = {}
+        for uid, effect, size in jobs:
+            specs_by_uid.setdefault(uid, set()).add((effect, size))
+
+        if not specs_by_uid:
+            return
+        with ThreadPoolExecutor() as pool:  # OpenCV releases the GIL
+            list(pool.map(self._prerender_uid, *zip(*specs_by_uid.items())))
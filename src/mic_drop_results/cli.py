@@ -0,0 +1,322 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Command-line entry point for scripted, non-interactive runs.
+
+Usage:
+    mic-drop-results generate --data data.xlsm --template template.pptm --out output
+
+The mic-drop-results executable is built from build/cli.spec, next to
+the main program. From the source, run python cli.py instead.
+
+Unlike main.py, batch mode never prompts the user, makes no Windows-only
+calls, and skips the update check and the token download, so it can run
+on servers. It exits with 0 on success, 2 on invalid arguments, 130 when
+interrupted, and with the exit code of the error otherwise, see
+errors.Error.get_exit_code().
+"""
+
+import argparse
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+import sys
+import warnings
+
+import pandas as pd
+
+from avatar_cache import AvatarCache
+from client import AvatarStatus, fetch_avatars, prefetch_images
+from compiled_regex import *
+from compiled_template import compile_template
+from config import Config
+import constants
+from constants import *
+from errors import Error, ErrorType, print_exception_hook
+from exceptions import *
+from generate import generate_sheet
+from incremental import slide_fingerprints
+import instrument
+from processing import check_template_ids, hash_data, process_data
+from stats import export_combined_statistics, export_data
+
+
+MAX_ATTEMPTS = 3  # attempts to download the avatars that failed
+
+
+def _abs_path(path: str) -> Path:
+    """Resolves a path argument against the working directory.
+
+    The program joins relative paths to its own folder with abs_dir(),
+    while open() and os.makedirs() resolve them against the working
+    directory, so every path is made absolute up front.
+    """
+    return Path(path).resolve()
+
+
+def _parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="mic-drop-results",
+        description="Generates the result slides of an event without prompting.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate = subparsers.add_parser(
+        "generate", help="generate the slides and statistics of a data file"
+    )
+    generate.add_argument("--data", type=_abs_path, required=True, help="data.xlsm")
+    generate.add_argument(
+        "--template", type=_abs_path, required=True, help="template.pptm"
+    )
+    generate.add_argument(
+        "--out", type=_abs_path, required=True, help="folder to save the output to"
+    )
+    generate.add_argument(
+        "--settings",
+        type=_abs_path,
+        default=MAIN_DIR / "settings.ini",
+        help="settings.ini (default: the one next to the program)",
+    )
+    generate.add_argument(
+        "--tokens", type=_abs_path, help="token.txt with the bot tokens for avatar mode"
+    )
+    generate.add_argument(
+        "--cache",
+        type=_abs_path,
+        help="folder for the downloaded avatars and images, can be reused by "
+        "later runs (default: OUT/.temp)",
+    )
+    generate.add_argument(
+        "--no-avatars", action="store_true", help="disable avatar mode"
+    )
+    generate.add_argument(
+        "--profile", action="store_true", help="profile the run with cProfile"
+    )
+    return parser.parse_args(argv)
+
+
+def _read_tokens(token_dir: Path | None) -> list[str]:
+    if token_dir is None:
+        return []
+
+    with open(token_dir, "r", encoding="utf-8", errors="ignore") as f:
+        lines = f.read().splitlines()
+    return [line.replace('"', "").strip() for line in lines if len(line) > 70]
+
+
+def _download_avatars(
+    groups: dict[str, pd.DataFrame],
+    token_list: list[str],
+    *,
+    cfg: Config,
+    cache: AvatarCache,
+) -> None:
+    """Downloads the avatars that are missing or out of date."""
+    if any(df["__uid"].dtype.kind in "biufc" for df in groups.values()):
+        Error(70).throw()
+
+    uids_used = {uid for df in groups.values() for uid in df["__uid"].dropna()}
+    uids = [uid for uid in sorted(uids_used) if not cache.is_fresh(uid)]
+    uids_unknown = []
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        if not uids:
+            break
+        if attempt > 1:
+            instrument.count("avatars.retry_attempts")
+
+        results: dict[str, AvatarStatus] = {}
+
+        def on_done(uid: str, avatar_status: AvatarStatus) -> None:
+            results[uid] = avatar_status
+            instrument.count(f"avatars.{avatar_status.name.lower()}")
+
+        try:
+            with instrument.span("fetch avatars", attempt=attempt, uids=len(uids)):
+                fetch_avatars(
+                    uids,
+                    token_list,
+                    size=cfg.avatar_resolution,
+                    cache=cache,
+                    on_done=on_done,
+                )
+        except (ConnectionError, TimeoutError):
+            instrument.count("avatars.connection_errors")
+        except InvalidTokenError as e:
+            Error(21.1).throw(*e.args)
+        except DiscordAPIError as e:
+            Error(22).throw(*e.args)
+
+        # Retry the failed and unfinished uids only
+        uids_unknown += [u for u in uids if results.get(u) == AvatarStatus.UNKNOWN]
+        uids = [
+            u
+            for u in uids
+            if results.get(u, AvatarStatus.FAILED) == AvatarStatus.FAILED
+        ]
+
+    cache.touch(uids_used)
+    cache.evict(keep=uids_used)
+    cache.save()
+
+    if uids:
+        Error(20).throw(err_type=ErrorType.WARNING)
+    if uids_unknown:
+        Error(23).throw(str(uids_unknown), err_type=ErrorType.WARNING)
+
+
+def _generate(args: argparse.Namespace) -> None:
+    constants.interactive = False
+    warnings.simplefilter(action="ignore", category=UserWarning)
+
+    if missing_files := [
+        str(f) for f in (args.data, args.template, args.settings) if not f.is_file()
+    ]:
+        Error(40).throw(
+            "The following files are missing:", "- " + "\n- ".join(missing_files)
+        )
+
+    cfg = Config(str(args.settings))
+    avatar_mode = cfg.avatar_mode and not args.no_avatars
+    token_list = _read_tokens(args.tokens)
+    if avatar_mode and not token_list:
+        Error(21).throw()
+
+    cache_dir = args.cache or args.out / ".temp"
+    avatar_dir = cache_dir / "avatars"
+    image_cache_dir = cache_dir / "images"
+    stats_dir = args.out / "statistics"
+    for folder in (args.out, stats_dir, avatar_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    # Read and process the data file
+    instrument.begin_section("Process data")
+    groups, _ = process_data(args.data, sort_orders=cfg.sort_orders)
+    if not groups:
+        Error(68).throw()
+    if any("__uid" not in df.columns for df in groups.values()):
+        avatar_mode = False
+
+    template = compile_template(
+        args.template,
+        trigger_word=cfg.trigger_word,
+        cache_dir=cache_dir / "template_cache.pkl",
+    )
+    for df in groups.values():
+        check_template_ids(df, slides_count=template.slides_count)
+
+    # Download avatars and linked images up front
+    instrument.begin_section("Download")
+    cache = AvatarCache(
+        cache_dir / "avatar_cache.json",
+        ttl=AVATAR_CACHE_TTL,
+        max_size=AVATAR_CACHE_MAX_SIZE,
+        avatar_dir=avatar_dir,
+    )
+    if avatar_mode:
+        _download_avatars(groups, token_list, cfg=cfg, cache=cache)
+
+    with instrument.span("prefetch images"):
+        prefetch_images(
+            (
+                url
+                for df in groups.values()
+                for val in df.select_dtypes(include="object").to_numpy().ravel()
+                if isinstance(val, str)
+                for url in match_url.findall(val)
+            ),
+            cache_dir=image_cache_dir,
+        )
+
+    # Generate every sheet, in worker processes if enabled
+    instrument.begin_section("Generate")
+    template_key = hash_data(
+        args.template,
+        VERSION_TAG,
+        cfg.trigger_word,
+        cfg.ranges,
+        cfg.scheme,
+        cfg.scheme_alt,
+    )
+    avatar_urls = {uid: entry["url"] for uid, entry in cache.entries.items()}
+
+    def get_options(sheet: str, df: pd.DataFrame) -> dict:
+        return dict(
+            cfg=cfg,
+            template=template,
+            output_prs_dir=args.out / f"{sheet}.pptx",
+            output_stats_dir=(
+                stats_dir / f"{sheet} Statistics.xlsx"
+                if cfg.statistics and not cfg.combined_statistics
+                else None
+            ),
+            fingerprints=(
+                slide_fingerprints(
+                    df, template_key=template_key, avatar_urls=avatar_urls
+                )
+                if cfg.incremental
+                else None
+            ),
+            avatar_dir=avatar_dir,
+            image_cache_dir=image_cache_dir,
+        )
+
+    def finish(sheet: str, get_result: Callable[[], dict]) -> None:
+        try:
+            instrument.merge(get_result())  # spans and counters of the sheet
+        except UnsupportedSlideError:
+            Error(43).throw(f"[b]Sheet name:[/b]  {sheet}")
+        except StatisticsLockedError:
+            Error(42).throw(f"{sheet} Statistics.xlsx")
+        except PermissionError:
+            Error(44).throw(f"{sheet}.pptx")
+        console.print(f"Generated {sheet}.pptx ({len(groups[sheet])} slides)")
+
+    if cfg.parallel_sheets and len(groups) > 1:
+        max_workers = min(len(groups), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers) as pool:
+            futures = {
+                sheet: pool.submit(generate_sheet, sheet, df, **get_options(sheet, df))
+                for sheet, df in groups.items()
+            }
+            for sheet, future in futures.items():
+                finish(sheet, future.result)
+    else:
+        for sheet, df in groups.items():
+            finish(sheet, lambda: generate_sheet(sheet, df, **get_options(sheet, df)))
+
+    if cfg.statistics and cfg.combined_statistics:
+        with instrument.span("statistics"):
+            try:
+                export_combined_statistics(groups, stats_dir / "Statistics.xlsx")
+            except StatisticsLockedError:
+                Error(42).throw("Statistics.xlsx")
+    if cfg.data_export != "none":
+        with instrument.span("data export"):
+            export_data(groups, stats_dir, fmt=cfg.data_export)
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Runs the command and returns the exit code."""
+    args = _parse_args(argv)
+    if args.profile:
+        instrument.start_profiler()
+
+    try:
+        match args.command:
+            case "generate":
+                _generate(args)
+    except KeyboardInterrupt:
+        return 130
+    except Exception as e:
+        print_exception_hook(type(e), e, e.__traceback__)  # exits with 70
+    finally:
+        instrument.write_report(args.out / ".temp" / "trace.json")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,20 +3,29 @@
 # Licensed under the Apache License, Version 2.0 (the "License");
 # you may not use this file except in compliance with the License.
 
+import asyncio
+from collections.abc import Awaitable, Callable, Iterable, Mapping
 from concurrent.futures import ThreadPoolExecutor
+import contextlib
 from enum import Enum
-import requests
+import hashlib
+import itertools
+import json
+import os
+import threading
 import time
-from urllib.request import Request, urlopen
-from urllib.error import URLError
-
-import cv2
-import numpy as np
+from typing import TYPE_CHECKING, Any
 
+from avatar_cache import AvatarCache
 import constants
 from constants import *
 from exceptions import *
-from utils import is_number, get_avatar_dir
+import instrument
+from utils import abs_dir, is_number
+
+if TYPE_CHECKING:  # only loaded by the stages that use the network
+    import aiohttp
+    import requests
 
 
 # Section A: GitHub API
@@ -27,6 +36,8 @@ class ProgramStatus(Enum):
 
 
 def fetch_latest_version() -> tuple[str, str]:
+    import requests
+
     response = requests.get(
         "https://api.github.com/repos/SicariusBlack/mic-drop-results/releases/latest",
         timeout=3,
@@ -37,6 +48,8 @@ def fetch_latest_version() -> tuple[str, str]:
 
 
 def fetch_token_file() -> str:
+    import requests
+
     response = requests.get(
         "https://raw.githubusercontent.com/SicariusBlack/mic-drop-results/main/templates/token.txt",
         timeout=3,
@@ -44,97 +57,377 @@ def fetch_token_file() -> str:
     return response.text
 
 
+_network_cache_lock = threading.Lock()
+
+
+def _load_network_cache() -> dict[str, dict]:
+    try:
+        with open(NETWORK_CACHE_DIR, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_cached(key: str) -> Any:
+    """Returns the cached result of a network check, even if expired.
+
+    Returns None if the check has never succeeded.
+    """
+    with _network_cache_lock:
+        entry = _load_network_cache().get(key)
+    return entry["value"] if entry else None
+
+
+def fetch_cached(key: str, fetch: Callable[[], Any], *, ttl: float) -> Any:
+    """Returns the result of a network check, cached for ttl seconds.
+
+    The network is only used once the cached result has expired. If the
+    check fails, the expired result is returned instead, or None if the
+    check has never succeeded. Meant to run in the background.
+
+    Args:
+        key: the name of the check in the cache.
+        fetch: the check, e.g. fetch_latest_version.
+        ttl: the number of seconds to reuse the result for.
+    """
+    import requests
+
+    with _network_cache_lock:
+        entry = _load_network_cache().get(key)
+    if entry and time.time() - entry["time"] < ttl:
+        return entry["value"]
+
+    try:
+        with instrument.span(f"fetch {key}"):
+            value = fetch()
+    except (requests.exceptions.RequestException, KeyError, ValueError):
+        instrument.count("network_checks.failed")
+        return entry["value"] if entry else None
+
+    with _network_cache_lock:
+        cache = _load_network_cache()
+        cache[key] = {"time": time.time(), "value": value}
+
+        os.makedirs(NETWORK_CACHE_DIR.parent, exist_ok=True)
+        tmp_dir = NETWORK_CACHE_DIR.with_suffix(".tmp")
+        with open(tmp_dir, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_dir, NETWORK_CACHE_DIR)
+    return value
+
+
 # Section B: Discord's API
-def _fetch_avatar_url(uid: str, api_token: str) -> str | None:  # TODO: docstring
+class TokenBucket:
+    """Rate limiter of the requests sent with a bot token.
+
+    Tokens refill at a steady rate up to the capacity, and every request
+    takes one. The bucket also follows Discord's rate limit headers and
+    pauses entirely when the limit has been exhausted or a request got
+    rate limited.
+
+    Attributes:
+        rate: number of tokens refilled per second.
+        capacity: maximum number of tokens in the bucket.
+        tokens: number of tokens currently in the bucket.
+        blocked_until: the time.monotonic() value until which no request
+            may be sent.
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens: float = capacity
+        self.blocked_until: float = 0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Waits until a request can be sent and takes a token."""
+        async with self._lock:  # serve waiting requests in order
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                elapsed, self._updated = now - self._updated, now
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float) -> None:
+        """Pauses all requests for a number of seconds."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Adjusts the bucket to Discord's X-RateLimit-* response headers."""
+        with contextlib.suppress(KeyError, ValueError):
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset_after = float(headers["X-RateLimit-Reset-After"])
+
+            self.tokens = min(self.tokens, remaining)
+            if remaining == 0:
+                self.block(reset_after)
+
+
+async def _fetch_avatar_url(
+    session: "aiohttp.ClientSession", uid: str, api_token: str, bucket: TokenBucket
+) -> str | None:  # TODO: docstring
+    import aiohttp
+
     if not is_number(uid):
         return None
 
-    time.sleep(constants.delay * constants.max_workers)
-
     # Try sending out a request to the API for the avatar's hash
-    try:
-        header = {"Authorization": f"Bot {api_token}"}
-        if constants.is_rate_limited == True:
-            time.sleep(1)
-            return _fetch_avatar_url(uid, api_token)
-        else:
-            response = requests.get(
-                f"https://discord.com/api/v10/users/{uid}", headers=header, timeout=15
-            )
-        # if not ('message' in response.json() or 'avatar' in response.json())
-    except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as e:
-        raise ConnectionError from e
+    while True:
+        await bucket.acquire()
+        start = time.perf_counter()
+        try:
+            async with session.get(
+                f"{DISCORD_API_URL}/users/{uid}",
+                headers={"Authorization": f"Bot {api_token}"},
+                timeout=aiohttp.ClientTimeout(total=15),
+            ) as response:
+                bucket.update(response.headers)
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            instrument.count("avatars.api_errors")
+            raise ConnectionError from e
+        instrument.observe("avatars.api_latency", time.perf_counter() - start)
+
+        if "retry_after" not in data:
+            break
+        bucket.block(float(data["retry_after"]))  # rate limited, try again later
+        instrument.count("avatars.rate_limited")
 
     # Try extracting the hash and return the complete link if succeed
     try:
-        if response.json()["avatar"] is not None:
-            return "https://cdn.discordapp.com/avatars/{}/{}.png".format(
-                uid, response.json()["avatar"]
-            )
+        if data["avatar"] is not None:
+            return f"{DISCORD_CDN_URL}/avatars/{uid}/{data['avatar']}.png"
 
-        if response.json()["discriminator"] == "0000":
+        if data["discriminator"] == "0000":
             return None
         # Return default avatar
         # https://discord.com/developers/docs/reference#image-formatting-cdn-endpoints
-        return "https://cdn.discordapp.com/embed/avatars/{}.png".format(
-            int(response.json()["discriminator"]) % 5
-        )
+        return f"{DISCORD_CDN_URL}/embed/avatars/{int(data['discriminator']) % 5}.png"
     except KeyError as e:
-        msg = response.json()["message"].lower()
+        msg = data["message"].lower()
         if "401: unauthorized" in msg:  # invalid token
             raise InvalidTokenError(api_token) from e
 
-        elif "limit" in msg:
-            constants.is_rate_limited = True
-            r = response.json()["retry_after"]
-            time.sleep(r)
-            constants.is_rate_limited = False
-            return _fetch_avatar_url(uid, api_token)
-
         elif "unknown" not in msg:
-            raise DiscordAPIError(api_token, response.json()) from e
+            raise DiscordAPIError(api_token, data) from e
 
 
-def _download(avatar_url: str, img_dir: Path) -> None:
-    try:
-        req = urlopen(Request(avatar_url, headers={"User-Agent": "Mozilla/5.0"}))
-        arr = np.asarray(bytearray(req.read()), dtype=np.uint8)
-        img = cv2.imdecode(arr, -1)
+def _save_avatar(content: bytes, img_dir: Path) -> None:
+    import cv2
+    import numpy as np
+
+    arr = np.asarray(bytearray(content), dtype=np.uint8)
+    img = cv2.imdecode(arr, -1)
+
+    if not cv2.imwrite(str(img_dir), img):
+        raise OSError(f"Could not write the avatar to {img_dir}")
 
-        cv2.imwrite(str(img_dir), img)
-    except URLError as e:
+
+async def _download(
+    session: "aiohttp.ClientSession", uid: str, avatar_url: str, cache: AvatarCache
+) -> None:
+    import aiohttp
+
+    start = time.perf_counter()
+    try:
+        async with session.get(
+            avatar_url,
+            headers={"User-Agent": "Mozilla/5.0"},
+            timeout=aiohttp.ClientTimeout(total=15),
+        ) as response:
+            response.raise_for_status()
+            content = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         raise ConnectionError from e
+    instrument.observe("avatars.download_latency", time.perf_counter() - start)
 
+    await asyncio.to_thread(_save_avatar, content, cache.get_avatar_dir(uid))
+    cache.add(uid, avatar_url)
 
-def fetch_avatar(uid, api_token, size, status):
-    if avatar_url := _fetch_avatar_url(uid, api_token):
-        constants.downloaded += 1
-        status.update(_get_download_banner(avatar_url))
-        avatar_url += f"?size={size}"
-        constants.avatar_urls.append((uid, avatar_url))
 
+class AvatarStatus(Enum):
+    DOWNLOADED = "downloaded"
+    CACHED = "up to date"  # unchanged since the last download
+    UNKNOWN = "unknown"  # invalid ID or deleted account
+    FAILED = "failed"  # connection error, try again later
 
-def download_avatars():
-    retry = 10
-    while True:
-        if constants.is_downloading == False and len(constants.avatar_urls) == 0:
-            retry -= 1
-            if retry < 1:
-                break
+
+class DownloadStage:
+    """Bounded producer/consumer stage that downloads the avatars.
+
+    Producers put (uid, avatar URL) items into a bounded queue and wait
+    when it is full. A fixed number of workers consume the queue until
+    they receive the shutdown sentinel, and report the outcome of every
+    item through the on_done callback. Use run() to drive the producers,
+    so that they can never wait on a queue the workers stopped consuming.
+
+    Attributes:
+        session: the pooled HTTP session.
+        cache: the avatar cache to record the downloads in.
+        on_done: called with the user ID and AvatarStatus of every item.
+    """
+
+    _SENTINEL = None
+
+    def __init__(
+        self,
+        session: "aiohttp.ClientSession",
+        cache: AvatarCache,
+        *,
+        workers: int,
+        maxsize: int,
+        on_done: Callable[[str, AvatarStatus], None],
+    ) -> None:
+        self.session = session
+        self.cache = cache
+        self.on_done = on_done
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(workers)]
+
+    async def put(self, uid: str, avatar_url: str) -> None:
+        """Queues an avatar for download, waits if the queue is full."""
+        await self._queue.put((uid, avatar_url))
+
+    async def close(self) -> None:
+        """Waits for the queued avatars to finish and stops the workers."""
+        for _ in self._workers:
+            await self._queue.put(self._SENTINEL)
+        await asyncio.gather(*self._workers)
+
+    def cancel(self) -> None:
+        """Stops the workers immediately."""
+        for task in self._workers:
+            task.cancel()
+
+    async def run(self, producers: Awaitable[Any]) -> None:
+        """Runs the producers, then waits for the queued avatars to finish.
+
+        The workers are awaited alongside the producers, so if a worker
+        stops with an error, the error is raised here and the producers
+        are cancelled instead of waiting on a full queue forever.
+        """
+
+        async def produce() -> None:
+            await producers
+            await self.close()
+
+        task = asyncio.ensure_future(produce())
+        try:
+            await asyncio.gather(task, *self._workers)
+        finally:
+            task.cancel()
+            self.cancel()
+
+    async def _work(self) -> None:
+        while (item := await self._queue.get()) is not self._SENTINEL:
+            uid, avatar_url = item
+            try:
+                await _download(self.session, uid, avatar_url, self.cache)
+            except Exception:  # one bad avatar must not stop the worker
+                instrument.count("avatars.download_errors")
+                self.on_done(uid, AvatarStatus.FAILED)
+            else:
+                self.on_done(uid, AvatarStatus.DOWNLOADED)
+
+
+async def _fetch_avatars(
+    uids: list[str],
+    token_list: list[str],
+    *,
+    size: int,
+    cache: AvatarCache,
+    workers: int,
+    on_done: Callable[[str, AvatarStatus], None],
+) -> None:
+    import aiohttp
+
+    buckets = {
+        api_token: TokenBucket(DISCORD_RATE_LIMIT, DISCORD_RATE_LIMIT)
+        for api_token in token_list
+    }
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        downloads = DownloadStage(
+            session,
+            cache,
+            workers=workers,
+            maxsize=DOWNLOAD_QUEUE_SIZE,
+            on_done=on_done,
+        )
+
+        async def fetch_avatar(uid: str, api_token: str) -> None:
+            avatar_url = await _fetch_avatar_url(
+                session, uid, api_token, buckets[api_token]
+            )
+            if not avatar_url:
+                on_done(uid, AvatarStatus.UNKNOWN)
+                return
+
+            avatar_url += f"?size={size}"
+
+            # Only download again if the avatar hash or resolution has changed
+            if cache.is_current(uid, avatar_url):
+                cache.revalidate(uid)
+                on_done(uid, AvatarStatus.CACHED)
             else:
-                continue
+                await downloads.put(uid, avatar_url)
+
+        await downloads.run(
+            asyncio.gather(
+                *(
+                    fetch_avatar(uid, api_token)
+                    for uid, api_token in zip(uids, itertools.cycle(token_list))
+                )  # distribute tokens evenly among requests
+            )
+        )
 
-        with ThreadPoolExecutor(max_workers=2) as pool:
-            while len(constants.avatar_urls) > 0:
-                uid, avatar_url = constants.avatar_urls[0]
-                img_dir = get_avatar_dir(uid)
 
-                pool.submit(_download, avatar_url, img_dir)
+def fetch_avatars(
+    uids: list[str],
+    token_list: list[str],
+    *,
+    size: int,
+    cache: AvatarCache,
+    workers: int = DOWNLOAD_WORKERS,
+    on_done: Callable[[str, AvatarStatus], None],
+) -> None:
+    """Looks up and downloads the avatars of the users.
 
-                try:
-                    constants.avatar_urls.pop(0)
-                except IndexError:
-                    pass
+    The avatar URLs are looked up on Discord's API, rate limited per bot
+    token, and streamed to the download stage as soon as they arrive.
+    Unchanged avatars in the cache are skipped.
+
+    Args:
+        uids: the user IDs.
+        token_list: the bot tokens to distribute the requests among.
+        size: the resolution of the avatars.
+        cache: the avatar cache.
+        workers (optional): the number of concurrent downloads. Defaults
+            to DOWNLOAD_WORKERS.
+        on_done: called with the user ID and AvatarStatus of every user
+            as soon as it is done.
+
+    Raises:
+        ConnectionError: failed to communicate with Discord's API.
+        InvalidTokenError: a bot token is invalid.
+        DiscordAPIError: unknown error returned by Discord's API.
+    """
+    asyncio.run(
+        _fetch_avatars(
+            uids, token_list, size=size, cache=cache, workers=workers, on_done=on_done
+        )
+    )
 
 
 def _get_download_banner(desc: str) -> str:
@@ -143,3 +436,98 @@ def _get_download_banner(desc: str) -> str:
         f"{indent}[bold yellow]Downloading avatars...[/bold yellow] "
         f"({constants.downloaded} of {constants.queue_len} downloaded)\n{' ' * constants.padding}{desc}"
     )
+
+
+# Section C: Images linked in the data file
+def _get_image_cache_dir(img_url: str, cache_dir: Path) -> Path:
+    return abs_dir(cache_dir, hashlib.sha1(img_url.encode()).hexdigest())
+
+
+def read_cached_image(
+    img_url: str, *, cache_dir: Path = IMAGE_CACHE_DIR
+) -> bytes | None:
+    """Returns the prefetched image of the URL, or None if unavailable."""
+    try:
+        with open(_get_image_cache_dir(img_url, cache_dir), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _fetch_image(session: "requests.Session", img_url: str, cache_dir: Path) -> None:
+    """Downloads the image of the URL unless the cached copy is current.
+
+    The cached copy is revalidated with the ETag and Last-Modified
+    headers of the previous response. Failures leave the cache as it is.
+    """
+    import requests
+
+    img_dir = _get_image_cache_dir(img_url, cache_dir)
+    meta_dir = img_dir.with_suffix(".json")
+
+    headers = {}
+    if img_dir.is_file():
+        with contextlib.suppress(OSError, ValueError):
+            with open(meta_dir, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+    with contextlib.suppress(requests.exceptions.RequestException, OSError):
+        start = time.perf_counter()
+        try:
+            response = session.get(img_url, headers=headers, timeout=IMAGE_TIMEOUT)
+        except requests.exceptions.RequestException:
+            instrument.count("images.failed")
+            raise
+        instrument.observe("images.latency", time.perf_counter() - start)
+        instrument.count(f"images.status_{response.status_code}")
+
+        if response.status_code != 200:  # 304 Not Modified or failed
+            return
+
+        tmp_dir = img_dir.with_suffix(".tmp")
+        with open(tmp_dir, "wb") as f:
+            f.write(response.content)
+        os.replace(tmp_dir, img_dir)
+
+        with open(meta_dir, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "url": img_url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                },
+                f,
+            )
+
+
+def prefetch_images(
+    img_urls: Iterable[str],
+    *,
+    cache_dir: Path = IMAGE_CACHE_DIR,
+    workers: int = IMAGE_WORKERS,
+) -> None:
+    """Downloads or revalidates the images of the URLs concurrently.
+
+    The images can then be read with read_cached_image() from the same
+    cache_dir, so filling the slides never waits for the network.
+    """
+    img_urls = list(dict.fromkeys(img_urls))  # remove duplicates, keep order
+    if not img_urls:
+        return
+
+    import requests
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda url: _fetch_image(session, url, cache_dir), img_urls))
@@ -0,0 +1,105 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""The parts of template.pptm that every sheet needs, compiled once.
+
+A compiled template holds the slide count and the field map of every
+template slide, including the effect and the geometry of the avatar
+placeholders. It is cached on disk under the hash of the template, so
+later runs validate the template IDs and get the field maps without
+parsing the template at all.
+
+The bytes of the template are kept in memory for the rest of the run,
+and every sheet parses its own presentation from them, so the sheets
+never share python-pptx objects.
+"""
+
+from io import BytesIO
+import os
+from pathlib import Path
+import pickle
+from typing import NamedTuple
+
+from pptx.presentation import Presentation as PresentationType
+
+from constants import VERSION_TAG
+from fields import Field, build_field_maps
+import instrument
+from processing import hash_data
+from slides import open_template
+
+
+class CompiledTemplate(NamedTuple):
+    """The template slide count and field maps, see compile_template()."""
+
+    path: Path  # the path to the template presentation
+    key: str  # hash of the template and the settings the field maps depend on
+    slides_count: int
+    field_maps: list[list[Field]]  # the field map of every template slide
+
+
+# Template files read by this process, by key
+_blobs: dict[str, bytes] = {}
+
+
+def _load(cache_dir: Path, key: str) -> CompiledTemplate | None:
+    try:
+        with open(cache_dir, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+    if not isinstance(cache, CompiledTemplate) or cache.key != key:
+        return None
+    return cache
+
+
+def _save(cache_dir: Path, template: CompiledTemplate) -> None:
+    os.makedirs(cache_dir.parent, exist_ok=True)
+
+    tmp_dir = cache_dir.with_suffix(".tmp")
+    with open(tmp_dir, "wb") as f:
+        pickle.dump(template, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_dir, cache_dir)
+
+
+def compile_template(
+    template_dir: Path, *, trigger_word: str, cache_dir: Path
+) -> CompiledTemplate:
+    """Compiles the template, or loads it from the cache if unchanged.
+
+    Args:
+        template_dir: the path to the template presentation.
+        trigger_word: the trigger word of the user configurations.
+        cache_dir: the path to cache the compiled template to.
+    """
+    key = hash_data(template_dir, VERSION_TAG, trigger_word)
+
+    if template := _load(cache_dir, key):
+        instrument.count("template_cache.hits")
+        return template._replace(path=template_dir)  # the folder may have moved
+
+    instrument.count("template_cache.misses")
+    _blobs[key] = template_dir.read_bytes()
+    prs = open_template(BytesIO(_blobs[key]))
+    template = CompiledTemplate(
+        path=template_dir,
+        key=key,
+        slides_count=len(prs.slides),
+        field_maps=build_field_maps(prs, trigger_word=trigger_word),
+    )
+    _save(cache_dir, template)
+    return template
+
+
+def open_compiled_template(template: CompiledTemplate) -> PresentationType:
+    """Returns a new copy of the template presentation to fill a sheet with.
+
+    The template file is read once per process, every call parses a new
+    presentation from its bytes in memory.
+    """
+    if template.key not in _blobs:
+        _blobs[template.key] = template.path.read_bytes()
+    return open_template(BytesIO(_blobs[template.key]))
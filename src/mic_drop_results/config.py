@@ -15,6 +15,10 @@ class ConfigVarTypes:
     update_check: bool
     avatar_mode: bool
     statistics: bool
+    combined_statistics: bool
+    data_export: str
+    parallel_sheets: bool
+    incremental: bool
     avatar_resolution: int
 
     sort_orders: list[bool]
@@ -25,13 +29,23 @@ class ConfigVarTypes:
     scheme_alt: list[str]
 
 
+# Values of the config vars added after the first release, used when an
+# older settings.ini lacks them. They keep the behaviour of that release.
+DEFAULTS = {
+    "parallel_sheets": "0",
+    "incremental": "0",
+    "combined_statistics": "0",
+    "data_export": "none",
+}
+
+
 class Config(ConfigVarTypes):  # TODO: add docstrings
     def __init__(self, file_dir: str):
         parser = configparser.ConfigParser()
         parser.read(file_dir)
 
         # Flatten config dict
-        self.config: dict[str, Any] = {
+        self.config: dict[str, Any] = DEFAULTS | {
             k: v for d in parser.values() for k, v in d.items()
         }
 
@@ -51,6 +65,12 @@ class Config(ConfigVarTypes):  # TODO: add docstrings
             cfg["avatar_resolution"] in resolution_presets
         ), "Avatar resolution must be taken from the list of available resolutions."
 
+        assert cfg["data_export"] in [
+            "none",
+            "csv",
+            "parquet",
+        ], 'Config variable "data_export" must be one of: none, csv, parquet.'
+
         assert (
             len(cfg["trigger_word"]) > 0
         ), 'Config variable "trigger_word" cannot be empty.'
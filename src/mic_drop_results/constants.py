@@ -4,6 +4,8 @@ import sys
 from rich.console import Console
 
 
+VERSION_TAG = "3.0.1"
+
 REPO_URL = "https://github.com/SicariusBlack/mic-drop-results"
 LATEST_RELEASE_URL = f"{REPO_URL}/releases/latest"
 TEMPLATES_URL = f"{REPO_URL}/tree/main/templates"
@@ -18,14 +20,31 @@ STATS_DIR = OUTPUT_DIR / "statistics"
 AVATAR_DIR = MAIN_DIR / "avatars"
 TEMP_DIR = MAIN_DIR / ".temp"
 
+AVATAR_CACHE_TTL = 3600 * 12  # revalidate cached avatars every 12 hours
+AVATAR_CACHE_MAX_SIZE = 200 * 1024**2  # evict avatars beyond 200 MB
+AVATAR_RENDER_SCALE = 2  # pixels per 96 DPI pixel of the rendered avatars
+AVATAR_RENDER_CACHE_SIZE = 64 * 1024**2  # rendered avatars kept in memory
+STREAM_MIN_SLIDES = 500  # write longer sheets one slide at a time to save memory
+
 console = Console(highlight=False)
 padding = 4
 
+DISCORD_API_URL = "https://discord.com/api/v10"
+DISCORD_CDN_URL = "https://cdn.discordapp.com"
+DISCORD_RATE_LIMIT = 50  # requests per second per bot token
+MAX_CONNECTIONS = 32  # pooled connections of the avatar download session
+DOWNLOAD_QUEUE_SIZE = 64  # avatar URLs waiting to be downloaded
+DOWNLOAD_WORKERS = 4
+
+IMAGE_CACHE_DIR = TEMP_DIR / "images"  # images linked in the data file
+IMAGE_TIMEOUT = 10  # seconds to wait for an image host to respond
+IMAGE_WORKERS = 8
+
+NETWORK_CACHE_DIR = TEMP_DIR / "network_cache.json"  # results of startup checks
+TOKEN_FILE_TTL = 3600 * 24  # download the token.txt template once a day
+UPDATE_CHECK_TTL = 3600 * 24  # check for updates once a day
+
 # Mutable globals (usage: import constants; constants.var)
 downloaded = 0
 queue_len = 0
-delay = 0
-is_rate_limited = False
-max_workers = 0
-avatar_urls: list[tuple] = []
-is_downloading = False
+interactive = True  # False in batch mode, where nothing prompts the user
@@ -6,11 +6,14 @@
 import copy
 from enum import Enum, auto
 import os
+import sys
+import threading
 from traceback import format_exception
 
 from rich.padding import Padding
 
 from compiled_regex import *
+import constants
 from constants import *
 from utils import inp
 
@@ -106,6 +109,17 @@ class Traceback:
             "Failed to open Excel file",
             "Please save your work, close the following window, and try again.",
         ],
+        43: [
+            Tag.SYS,
+            "Template slides need PowerPoint",
+            "Some template slides contain content that can only be duplicated through PowerPoint, which batch mode does not use.",
+            "Remove the unsupported content from template.pptm, or run the program normally on Windows.",
+        ],
+        44: [
+            Tag.SYS,
+            "Failed to save PowerPoint file",
+            "Please close the following presentation and try again.",
+        ],
         # 60 and above: Data errors
         60: [
             Tag.FILE_DATA,
@@ -183,6 +197,20 @@ class Error(Traceback):
         code = whole if int(decimal) == 0 else f"{whole}.{int(decimal)}"
         return f"E-{code}"
 
+    def get_exit_code(self) -> int:
+        """Returns the exit code of the error in batch mode, see sysexits.h."""
+        if self.tb < 20:
+            return 70  # EX_SOFTWARE: dev errors
+        elif self.tb < 30:
+            return 69  # EX_UNAVAILABLE: API errors
+        elif self.tb < 40:
+            return 78  # EX_CONFIG: config errors
+        elif self.tb == 40:
+            return 66  # EX_NOINPUT: missing files
+        elif self.tb < 60:
+            return 73  # EX_CANTCREAT: system errors
+        return 65  # EX_DATAERR: data errors
+
     def throw(self, *details: str, err_type: ErrorType = ErrorType.ERROR) -> None:
         if len(self.content) >= 3:
             self.content = self.content[:2] + [*details] + self.content[2:]
@@ -238,6 +266,14 @@ class Error(Traceback):
             for part in content[2:]:
                 console.print(Padding(part, (1, 4, 0, 4)))  # extra details
 
+        if not constants.interactive:  # batch mode, never wait for the user
+            console.line(1)
+            if err_type == ErrorType.ERROR:
+                if threading.current_thread() is threading.main_thread():
+                    sys.exit(self.get_exit_code())  # run exit handlers
+                os._exit(self.get_exit_code())
+            return
+
         if err_type == ErrorType.ERROR:
             console.line(2)
             inp("Press Enter to exit the program...\n\n")
@@ -4,3 +4,17 @@ class DiscordAPIError(Exception):
 
 class InvalidTokenError(DiscordAPIError):
     pass
+
+
+class StatisticsLockedError(Exception):
+    """The statistics workbook cannot be saved, usually because it is
+    opened in Excel."""
+
+    pass
+
+
+class UnsupportedSlideError(Exception):
+    """A template slide links to content that can only be duplicated
+    through PowerPoint."""
+
+    pass
@@ -0,0 +1,74 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from enum import Enum, auto
+from typing import NamedTuple
+
+from pptx.presentation import Presentation as PresentationType
+from pptx.slide import Slide
+
+from compiled_regex import match_field_name
+from utils import parse_coef
+
+
+class FieldKind(Enum):
+    AVATAR = auto()  # {p}, replaced with the avatar
+    TRIGGER = auto()  # {triggerword_blahblah}, conditionally formatted
+    TEXT = auto()  # everything else, replaced with text
+
+
+class Field(NamedTuple):
+    """The location and parsed details of a {field} on a template slide."""
+
+    shape: int  # index of the shape on the slide
+    paragraph: int  # index of the paragraph in the shape
+    run: int  # index of the run in the paragraph
+    name: str  # field name without the leading underscores
+    coef: int  # the digit right after the field, e.g. 1 in {score2}1
+    kind: FieldKind
+    size: tuple[int, int] | None = None  # width and height of the {p} shape in EMU
+
+
+def build_field_map(slide: Slide, *, trigger_word: str) -> list[Field]:
+    """Scans a template slide for fields in the order they are filled.
+
+    All slides duplicated from the same template slide share this
+    structure, so the map only needs to be built once per template.
+    """
+    field_map = []
+
+    for shape_ind, shape in enumerate(slide.shapes):  # type: ignore
+        if not shape.has_text_frame:
+            continue
+
+        for p_ind, p in enumerate(shape.text_frame.paragraphs):
+            for run_ind, run in enumerate(p.runs):
+                for field_name in match_field_name.findall(run.text):
+                    field_name = field_name.lstrip("__")
+
+                    if field_name == "p":
+                        kind = FieldKind.AVATAR
+                    elif field_name.startswith(trigger_word):
+                        kind = FieldKind.TRIGGER
+                    else:
+                        kind = FieldKind.TEXT
+
+                    coef = parse_coef(run.text, field_name=field_name)
+                    size = None
+                    if kind == FieldKind.AVATAR:
+                        size = (int(shape.width), int(shape.height))
+                    field_map.append(
+                        Field(shape_ind, p_ind, run_ind, field_name, coef, kind, size)
+                    )
+
+                    if kind == FieldKind.AVATAR:
+                        break  # the rest of the run is cleared with the avatar
+
+    return field_map
+
+
+def build_field_maps(prs: PresentationType, *, trigger_word: str) -> list[list[Field]]:
+    """Builds the field map of every template slide in the presentation."""
+    return [build_field_map(s, trigger_word=trigger_word) for s in prs.slides]
@@ -0,0 +1,535 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from collections.abc import Callable, Collection, Iterator
+import contextlib
+from pathlib import Path
+from queue import Queue
+import time
+
+import pandas as pd
+from pptx.dml.color import RGBColor
+from pptx.enum.shapes import MSO_SHAPE  # type: ignore
+from pptx.enum.text import PP_ALIGN  # type: ignore
+from pptx.presentation import Presentation as PresentationType
+from pptx.slide import Slide
+from pptx.util import Cm
+
+from avatars import AvatarRenderer
+from client import read_cached_image
+from compiled_regex import *
+from compiled_template import CompiledTemplate, open_compiled_template
+from config import Config
+from constants import AVATAR_DIR, IMAGE_CACHE_DIR, STREAM_MIN_SLIDES
+from exceptions import UnsupportedSlideError
+from fields import Field, FieldKind, build_field_map
+from incremental import PreviousOutput, load_previous_output, save_fingerprints
+import instrument
+from slides import (
+    ImageRegistry,
+    SlideStream,
+    duplicate_slides,
+    save_presentation,
+)
+from utils import (
+    is_number,
+    as_type,
+    hex_to_rgb,
+)
+
+
+def _replace_avatar(
+    slide: Slide,
+    shape,
+    run,
+    *,
+    uid: str,
+    effect_id: int,
+    renderer: AvatarRenderer,
+    images: ImageRegistry,
+) -> None:
+    """Replaces avatar element on slide with avatar.
+
+    Args:
+        slide (Slide): the slide containing the shape.
+        shape: the placeholder shape of the {p} field.
+        run: the run containing the {p} field.
+        uid (str): the user ID of the avatar.
+        effect_id (int): the coefficient of the {p} field.
+        renderer (AvatarRenderer): renders and caches the avatars.
+        images (ImageRegistry): the images embedded in the presentation.
+    """
+    run.text = ""  # reset text box to empty
+
+    size = (int(shape.width), int(shape.height))
+    image_part = images.get_or_add(
+        ("avatar", uid, effect_id, size),
+        lambda: renderer.get(uid, effect=effect_id, size=size),
+    )
+    if image_part is None:  # avatar not downloaded
+        return
+
+    # Add avatar to slide
+    new_shape = images.add_picture(
+        slide, image_part, shape.left, shape.top, shape.width, shape.height
+    )
+    new_shape.auto_shape_type = MSO_SHAPE.OVAL
+    old = shape._element
+    new = new_shape._element
+    old.addnext(new)
+    old.getparent().remove(old)
+
+
+def _replace_text(run, field: Field, *, text: str, cfg: Config, schemes) -> None:
+    scheme, scheme_alt = schemes
+
+    if field.kind == FieldKind.TRIGGER:  # apply to {triggerword_blahblah}
+        # Find breakpoints and apply conditional formatting to numbers
+        for ind, breakpoint in enumerate(cfg.ranges[::-1]):
+            if not is_number(text):
+                break
+
+            if float(text) >= breakpoint:
+                if field.coef == 0:
+                    run.font.color.rgb = RGBColor(*scheme[::-1][ind])
+                else:
+                    run.font.color.rgb = RGBColor(*scheme_alt[::-1][ind])
+                break
+
+        run.text = text
+    else:
+        # Replace text normally
+        run.text = run.text.replace("{" + field.name + "}", text)
+
+
+def _replace_image_url(
+    slide: Slide, shape, p, run, *, images: ImageRegistry, image_cache_dir: Path
+) -> None:
+    if img_url := match_url.findall(run.text):  # find image urls
+        with contextlib.suppress(Exception):
+            margin_left = _insert_image(
+                slide,
+                shape,
+                img_url=img_url[0],
+                images=images,
+                image_cache_dir=image_cache_dir,
+            )
+            run.text = run.text.replace(img_url[0], "")
+            # With some measurements we can obtain 12.47 cm = 4490850
+            # 1 cm = 360132.3175621492
+            shape.text_frame.margin_left = Cm(margin_left / 360132.3175621492)
+            p.alignment = PP_ALIGN.LEFT
+
+
+def _insert_image(
+    slide: Slide,
+    shape,
+    *,
+    img_url: str,
+    images: ImageRegistry,
+    image_cache_dir: Path,
+) -> float:
+    """Inserts an image on top of a shape on slide.
+
+    Args:
+        slide: the slide containing the shape.
+        shape: the shape to fit the image.
+        img_url (str): the URL of the image on the internet, which must
+            have been prefetched with client.prefetch_images().
+        images (ImageRegistry): the images embedded in the presentation.
+        image_cache_dir (Path): the folder the image was prefetched to.
+
+    Returns:
+        float: the left margin to indent the remaining text.
+    """
+    image_part = images.get_or_add(
+        ("url", img_url),
+        lambda: read_cached_image(img_url, cache_dir=image_cache_dir),
+    )
+    img_width, img_height = image_part.image.size  # type: ignore
+
+    height = shape.height
+    width = height / img_height * img_width
+    left = shape.left + (shape.width - width) / 2
+    top = shape.top
+
+    new_shape = images.add_picture(slide, image_part, left, top, width, height)
+    shape._element.addnext(new_shape._element)
+
+    return left + width  # left margin for the remaining text
+
+
+def fill_slide(
+    slide: Slide,
+    data: dict[str, str],
+    field_map: list[Field],
+    *,
+    cfg: Config,
+    schemes,
+    renderer: AvatarRenderer,
+    images: ImageRegistry,
+    image_cache_dir: Path = IMAGE_CACHE_DIR,
+) -> None:
+    # Look up every run before the slide gets modified by the replacements
+    shapes = list(slide.shapes)  # type: ignore
+    paragraphs: dict[int, list] = {}
+    targets = []
+    for field in field_map:
+        shape = shapes[field.shape]
+        if field.shape not in paragraphs:
+            paragraphs[field.shape] = shape.text_frame.paragraphs
+        p = paragraphs[field.shape][field.paragraph]
+        targets.append((shape, p, p.runs[field.run]))
+
+    for field, (shape, p, run) in zip(field_map, targets):
+        # Replace {p} with avatar
+        if field.kind == FieldKind.AVATAR:
+            _replace_avatar(
+                slide,
+                shape,
+                run,
+                uid=data["uid"],
+                effect_id=field.coef,
+                renderer=renderer,
+                images=images,
+            )
+            continue
+
+        if field.name not in data:
+            continue
+
+        # Replace text
+        _replace_text(run, field, text=data[field.name], cfg=cfg, schemes=schemes)
+
+        _replace_image_url(
+            slide, shape, p, run, images=images, image_cache_dir=image_cache_dir
+        )
+
+
+def render_rows(df: pd.DataFrame) -> Iterator[dict[str, str]]:
+    """Yields the text of every field for each row of the sheet, in order.
+
+    All values are converted to strings in a single pass over the
+    columns, instead of building a Series for every slide.
+    """
+    # Treat program-domain vars like normal vars when replacing
+    keys = [k.lstrip("__") for k in df.columns]
+    values = df.to_numpy(dtype=object)
+    values[pd.isna(values)] = ""
+    # dtype=object stops pandas from inferring datetime columns, which
+    # astype(str) would format without the time unlike str(Timestamp)
+    table = pd.DataFrame(values, dtype=object).astype(str).to_numpy()
+
+    for row in table:
+        yield dict(zip(keys, row))
+
+
+def _prerender_avatars(
+    df: pd.DataFrame,
+    field_map_by_slide: dict[int, list[Field]],
+    renderer: AvatarRenderer,
+) -> None:
+    """Renders the avatars of every slide in one go."""
+    if "__uid" not in df.columns:
+        return
+
+    uids = df["__uid"].fillna("").astype(str).tolist()
+    jobs = []
+    for i, field_map in field_map_by_slide.items():
+        jobs += [
+            (uids[i], f.coef, f.size) for f in field_map if f.kind == FieldKind.AVATAR
+        ]
+    with instrument.span("prerender avatars", avatars=len(jobs)):
+        renderer.prerender(jobs)
+
+
+def fill_presentation(
+    prs: PresentationType,
+    df: pd.DataFrame,
+    *,
+    cfg: Config,
+    field_maps: list[list[Field]] | None = None,
+    skip: Collection[int] = (),
+    renderer: AvatarRenderer | None = None,
+    image_cache_dir: Path = IMAGE_CACHE_DIR,
+    on_progress: Callable[[int], None] | None = None,
+) -> None:
+    """Fills the duplicated slides with the judging data, one row per slide.
+
+    Args:
+        prs: the presentation with one duplicated slide per row of df.
+        df: the processed data of the sheet.
+        cfg: the user configurations.
+        field_maps (optional): the field maps of the template slides,
+            see fields.build_field_maps(). Pass None to scan every slide
+            for fields instead. Defaults to None.
+        skip (optional): the indices of the slides that are already
+            filled, e.g. reused from the previous run. Defaults to ().
+        renderer (optional): the avatar renderer to share between
+            presentations. Pass None to use a new one. Defaults to None.
+        image_cache_dir (optional): the folder the linked images were
+            prefetched to, see client.prefetch_images(). Defaults to
+            IMAGE_CACHE_DIR.
+        on_progress (optional): called with the number of slides filled
+            so far after every slide. Defaults to None.
+    """
+    schemes = [list(map(hex_to_rgb, x)) for x in (cfg.scheme, cfg.scheme_alt)]
+    if renderer is None:
+        renderer = AvatarRenderer()
+    images = ImageRegistry(prs)
+
+    slides = list(prs.slides)
+    field_map_by_slide: dict[int, list[Field]] = {}
+    for i, (slide, template) in enumerate(zip(slides, df["__template"])):
+        if i in skip:
+            continue
+        if field_maps is None:
+            field_map = build_field_map(slide, trigger_word=cfg.trigger_word)
+        else:
+            field_map = field_maps[int(as_type(int, template)) - 1]
+        field_map_by_slide[i] = field_map
+
+    _prerender_avatars(df, field_map_by_slide, renderer)
+
+    for i, (slide, data) in enumerate(zip(slides, render_rows(df))):
+        if i in field_map_by_slide:
+            start = time.perf_counter()
+            fill_slide(
+                slide,
+                data,
+                field_map_by_slide[i],
+                cfg=cfg,
+                schemes=schemes,
+                renderer=renderer,
+                images=images,
+                image_cache_dir=image_cache_dir,
+            )
+            instrument.observe("slides.fill_time", time.perf_counter() - start)
+            instrument.count("slides.filled")
+
+        if on_progress is not None:
+            on_progress(i + 1)
+
+
+def stream_presentation(
+    prs: PresentationType,
+    df: pd.DataFrame,
+    output_prs_dir: Path,
+    *,
+    cfg: Config,
+    field_maps: list[list[Field]],
+    renderer: AvatarRenderer | None = None,
+    image_cache_dir: Path = IMAGE_CACHE_DIR,
+    previous: PreviousOutput | None = None,
+    fingerprints: list[str] | None = None,
+    on_progress: Callable[[int], None] | None = None,
+) -> None:
+    """Duplicates, fills and saves the slides one at a time, see SlideStream.
+
+    This is the low-memory equivalent of slides.duplicate_slides(),
+    fill_presentation() and slides.save_presentation() for long sheets.
+    Slides that are unchanged since the previous run are copied from its
+    presentation as they are, instead of being filled again.
+
+    Args:
+        prs: the opened template presentation.
+        df: the processed data of the sheet.
+        output_prs_dir: the path to save the presentation to.
+        cfg: the user configurations.
+        field_maps: the field maps of the template slides, see
+            fields.build_field_maps().
+        renderer (optional): the avatar renderer to share between
+            presentations. Pass None to use a new one. Defaults to None.
+        image_cache_dir (optional): the folder the linked images were
+            prefetched to, see client.prefetch_images(). Defaults to
+            IMAGE_CACHE_DIR.
+        previous (optional): the presentation of the previous run, see
+            incremental.load_previous_output(). Defaults to None.
+        fingerprints (optional): the fingerprints of the slides, see
+            incremental.slide_fingerprints(), to find the slides of
+            previous to copy. Defaults to None.
+        on_progress (optional): called with the number of slides done
+            so far after every slide. Defaults to None.
+
+    Raises:
+        UnsupportedSlideError: the template slides cannot be streamed,
+            see SlideStream. Nothing has been written at this point.
+    """
+    schemes = [list(map(hex_to_rgb, x)) for x in (cfg.scheme, cfg.scheme_alt)]
+    if renderer is None:
+        renderer = AvatarRenderer()
+    images = ImageRegistry(prs)
+
+    indices = [int(as_type(int, x)) - 1 for x in df["__template"]]
+    reused = {}  # the part names of the previous slides to copy, by index
+    if previous is not None and fingerprints is not None:
+        reused = {
+            i: previous.slides[fp]
+            for i, fp in enumerate(fingerprints)
+            if fp in previous.slides
+        }
+
+    with SlideStream(prs, output_prs_dir, df["__template"]) as stream:
+        _prerender_avatars(
+            df,
+            {
+                i: field_maps[index]
+                for i, index in enumerate(indices)
+                if i not in reused
+            },
+            renderer,
+        )
+
+        for i, (index, data) in enumerate(zip(indices, render_rows(df))):
+            if i in reused:
+                try:
+                    stream.copy_slide(previous.package, reused[i], images)  # type: ignore
+                except UnsupportedSlideError:
+                    pass  # fill the slide instead
+                else:
+                    instrument.count("slides.reused")
+                    if on_progress is not None:
+                        on_progress(i + 1)
+                    continue
+
+            start = time.perf_counter()
+            fill_slide(
+                stream.add_slide(index),
+                data,
+                field_maps[index],
+                cfg=cfg,
+                schemes=schemes,
+                renderer=renderer,
+                images=images,
+                image_cache_dir=image_cache_dir,
+            )
+            instrument.observe("slides.fill_time", time.perf_counter() - start)
+            instrument.count("slides.filled")
+
+            if on_progress is not None:
+                on_progress(i + 1)
+
+
+def generate_sheet(
+    sheet: str,
+    df: pd.DataFrame,
+    *,
+    cfg: Config,
+    template: CompiledTemplate,
+    output_prs_dir: Path,
+    output_stats_dir: Path | None = None,
+    fingerprints: list[str] | None = None,
+    avatar_dir: Path = AVATAR_DIR,
+    image_cache_dir: Path = IMAGE_CACHE_DIR,
+    progress_queue: Queue | None = None,
+) -> dict:
+    """Generates the presentation (and statistics) of a sheet.
+
+    This is the entry point of the worker processes in parallel mode,
+    so it must not prompt the user. Avatars have to be downloaded
+    beforehand.
+
+    Sheets of STREAM_MIN_SLIDES slides or more, and sheets with a
+    previous output to copy the unchanged slides from, are written one
+    slide at a time with stream_presentation().
+
+    Args:
+        sheet: the name of the sheet.
+        df: the processed data of the sheet.
+        cfg: the user configurations.
+        template: the compiled template, see
+            compiled_template.compile_template().
+        output_prs_dir: the path to save the presentation to.
+        output_stats_dir (optional): the path to save the statistics
+            workbook to. Pass None to skip exporting statistics.
+            Defaults to None.
+        fingerprints (optional): the fingerprints of the slides, see
+            incremental.slide_fingerprints(). Unchanged slides are
+            copied from the previous output instead of being filled.
+            Pass None to fill every slide. Defaults to None.
+        avatar_dir (optional): the folder of the downloaded avatars.
+            Defaults to AVATAR_DIR.
+        image_cache_dir (optional): the folder the linked images were
+            prefetched to, see client.prefetch_images(). Defaults to
+            IMAGE_CACHE_DIR.
+        progress_queue (optional): the queue to report progress to as
+            (sheet, slides filled, total slides) tuples. Defaults to
+            None.
+
+    Raises:
+        UnsupportedSlideError: the template slides cannot be duplicated
+            in-process and need to go through PowerPoint instead.
+        PermissionError: the presentation is opened in PowerPoint.
+        StatisticsLockedError: the statistics workbook is opened in
+            Excel. The presentation has already been saved at this
+            point.
+
+    Returns:
+        dict: the instrumentation data recorded by the worker, to be
+            merged into the main process, see instrument.collect().
+    """
+
+    def report(n: int) -> None:
+        if progress_queue is not None:
+            progress_queue.put((sheet, n, len(df)))
+
+    report(0)
+    renderer = AvatarRenderer(avatar_dir=avatar_dir)
+
+    with instrument.span("sheet", sheet=sheet, slides=len(df)):
+        previous = None
+        if fingerprints is not None:
+            with instrument.span("load previous output"):
+                previous = load_previous_output(output_prs_dir)
+
+        # Stream long sheets to save memory, and sheets with a previous
+        # output to copy the unchanged slides from it without parsing them
+        streamed = False
+        if len(df) >= STREAM_MIN_SLIDES or previous is not None:
+            with instrument.span("stream"), contextlib.suppress(UnsupportedSlideError):
+                stream_presentation(
+                    open_compiled_template(template),
+                    df,
+                    output_prs_dir,
+                    cfg=cfg,
+                    field_maps=template.field_maps,
+                    renderer=renderer,
+                    image_cache_dir=image_cache_dir,
+                    previous=previous,
+                    fingerprints=fingerprints,
+                    on_progress=report,
+                )
+                streamed = True
+                instrument.count("sheets.streamed")
+
+        if not streamed:
+            with instrument.span("duplicate"):
+                prs = open_compiled_template(template)
+                duplicate_slides(prs, df["__template"])
+
+            with instrument.span("fill"):
+                fill_presentation(
+                    prs,
+                    df,
+                    cfg=cfg,
+                    field_maps=template.field_maps,
+                    renderer=renderer,
+                    image_cache_dir=image_cache_dir,
+                    on_progress=report,
+                )
+            with instrument.span("save"):
+                save_presentation(prs, output_prs_dir)
+
+        if fingerprints is not None:
+            save_fingerprints(output_prs_dir, fingerprints)
+
+        if output_stats_dir is not None:
+            from stats import export_statistics  # loads XlsxWriter
+
+            with instrument.span("statistics"):
+                export_statistics(df, output_stats_dir)
+    instrument.count("sheets.generated")
+
+    return instrument.collect()
@@ -0,0 +1,115 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from collections.abc import Mapping
+import hashlib
+from io import BytesIO
+import json
+import os
+from pathlib import Path
+from typing import NamedTuple
+import zipfile
+
+from lxml.etree import XMLSyntaxError
+import pandas as pd
+from pptx.opc.packuri import PackURI
+
+from slides import read_slide_partnames
+
+
+def get_fingerprints_dir(output_prs_dir: Path) -> Path:
+    """Returns the path to the fingerprints stored next to a presentation."""
+    return output_prs_dir.with_suffix(".fingerprints.json")
+
+
+def slide_fingerprints(
+    df: pd.DataFrame, *, template_key: str, avatar_urls: Mapping[str, str]
+) -> list[str]:
+    """Computes a fingerprint for the slide of every row of the sheet.
+
+    Two slides with the same fingerprint have the same content, so a
+    slide from a previous run can be reused as long as its fingerprint
+    has not changed, even if it has moved to another position.
+
+    Args:
+        df: the processed data of the sheet, one row per slide.
+        template_key: the hash of the template and of the config values
+            that affect how slides are filled.
+        avatar_urls: maps user IDs to the URLs of their downloaded
+            avatars, which change whenever an avatar changes.
+
+    Returns:
+        list[str]: the fingerprint of every slide, in order.
+    """
+    columns = df.columns.tolist()
+    uids = df["__uid"] if "__uid" in df.columns else [None] * len(df)
+
+    fingerprints = []
+    for row, uid in zip(df.fillna("").astype(str).itertuples(index=False), uids):
+        payload = json.dumps(
+            [template_key, columns, list(row), avatar_urls.get(uid, "")]
+        )
+        fingerprints.append(hashlib.sha1(payload.encode()).hexdigest())
+    return fingerprints
+
+
+def load_fingerprints(output_prs_dir: Path) -> list[str] | None:
+    """Loads the fingerprints of the slides of a previous run.
+
+    Returns:
+        list[str] | None: the fingerprints, or None if there are none or
+            the presentation has been modified since they were saved.
+    """
+    try:
+        with open(get_fingerprints_dir(output_prs_dir), "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        stat = os.stat(output_prs_dir)
+    except (OSError, ValueError):
+        return None
+
+    if saved.get("pptx") != [stat.st_size, stat.st_mtime_ns]:
+        return None
+    return saved.get("slides")
+
+
+def save_fingerprints(output_prs_dir: Path, fingerprints: list[str]) -> None:
+    """Saves the fingerprints of the slides of a freshly saved presentation."""
+    stat = os.stat(output_prs_dir)
+    with open(get_fingerprints_dir(output_prs_dir), "w", encoding="utf-8") as f:
+        json.dump({"pptx": [stat.st_size, stat.st_mtime_ns], "slides": fingerprints}, f)
+
+
+class PreviousOutput(NamedTuple):
+    """The presentation saved by the previous run, see load_previous_output()."""
+
+    package: zipfile.ZipFile  # the .pptx file, read into memory
+    slides: dict[str, PackURI]  # the part name of the slide of every fingerprint
+
+
+def load_previous_output(output_prs_dir: Path) -> PreviousOutput | None:
+    """Loads the presentation of the previous run to copy its slides from.
+
+    The file is read into memory, so the new presentation can be written
+    to the same path, and only the order of the slides is parsed. The
+    unchanged slides are copied over as they are with
+    slides.SlideStream.copy_slide().
+
+    Returns:
+        PreviousOutput | None: the previous presentation, or None if it
+            has no fingerprints, has been modified since they were saved
+            or cannot be read.
+    """
+    if not (fingerprints := load_fingerprints(output_prs_dir)):
+        return None
+
+    try:
+        package = zipfile.ZipFile(BytesIO(output_prs_dir.read_bytes()))
+        slide_partnames = read_slide_partnames(package)
+    except (OSError, KeyError, StopIteration, zipfile.BadZipFile, XMLSyntaxError):
+        return None
+
+    if len(slide_partnames) != len(fingerprints):
+        return None
+    return PreviousOutput(package, dict(zip(fingerprints, slide_partnames)))
@@ -0,0 +1,242 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+"""Lightweight instrumentation of a run.
+
+Spans, counters and histograms are recorded in memory by every thread,
+and worker processes hand theirs over with collect() and merge(). The
+report is written in the Trace Event Format, which chrome://tracing and
+https://ui.perfetto.dev can open, with the totals of every stage, the
+counters and the histograms summarized under "otherData".
+"""
+
+from bisect import bisect_left
+from collections.abc import Iterator
+import contextlib
+import cProfile
+import json
+import os
+from pathlib import Path
+import pstats
+import threading
+import time
+
+
+HISTOGRAM_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+PROFILE_TOP = 30  # functions listed in the report, by cumulative time
+
+_lock = threading.Lock()
+_events: list[dict] = []
+_counters: dict[str, int] = {}
+_samples: dict[str, list[float]] = {}
+_threads: set[tuple[int, int]] = set()  # (pid, tid) with a thread_name event
+
+_section: tuple[str, int] | None = None  # name and start of the current section
+_profiler: cProfile.Profile | None = None
+_profile: dict | None = None  # path and top functions of the stopped profiler
+
+
+def _now() -> int:
+    return time.perf_counter_ns() // 1000  # trace events are in microseconds
+
+
+def _add_span(name: str, start: int, *, cat: str, args: dict) -> None:
+    pid, tid = os.getpid(), threading.get_native_id()
+    event = {
+        "name": name,
+        "cat": cat,
+        "ph": "X",
+        "ts": start,
+        "dur": _now() - start,
+        "pid": pid,
+        "tid": tid,
+    }
+    if args:
+        event["args"] = args
+
+    with _lock:
+        if (pid, tid) not in _threads:
+            _threads.add((pid, tid))
+            _events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                }
+            )
+        _events.append(event)
+
+
+@contextlib.contextmanager
+def span(name: str, **args) -> Iterator[None]:
+    """Records the time spent in the block as a span.
+
+    Args:
+        name: the name of the stage.
+        **args: shown along with the span, e.g. the name of the sheet.
+    """
+    start = _now()
+    try:
+        yield
+    finally:
+        _add_span(name, start, cat="stage", args=args)
+
+
+def begin_section(name: str) -> None:
+    """Ends the span of the current section of the run and starts the next."""
+    global _section
+    end_section()
+    _section = (name, _now())
+
+
+def end_section() -> None:
+    global _section
+    if _section is not None:
+        _add_span(_section[0], _section[1], cat="section", args={})
+        _section = None
+
+
+def count(name: str, n: int = 1) -> None:
+    """Adds n to a counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name: str, value: float) -> None:
+    """Adds a sample to a histogram, e.g. a latency in seconds."""
+    with _lock:
+        _samples.setdefault(name, []).append(value)
+
+
+def collect() -> dict:
+    """Takes everything recorded so far, to be merged into another process."""
+    with _lock:
+        data = {
+            "events": _events.copy(),
+            "counters": _counters.copy(),
+            "samples": {k: v.copy() for k, v in _samples.items()},
+        }
+        _events.clear()
+        _counters.clear()
+        _samples.clear()
+        _threads.clear()
+    return data
+
+
+def merge(data: dict) -> None:
+    """Adds the data collected by another process, see collect()."""
+    with _lock:
+        _events.extend(data["events"])
+        for name, n in data["counters"].items():
+            _counters[name] = _counters.get(name, 0) + n
+        for name, samples in data["samples"].items():
+            _samples.setdefault(name, []).extend(samples)
+
+
+def _reset() -> None:
+    """Forgets everything recorded by the parent of a forked worker."""
+    global _lock, _section, _profiler
+    _lock = threading.Lock()  # may have been held by another thread at fork
+    collect()
+    _section = _profiler = None
+
+
+if hasattr(os, "register_at_fork"):  # not on Windows, where workers are spawned
+    os.register_at_fork(after_in_child=_reset)
+
+
+def start_profiler() -> None:
+    """Profiles the main thread with cProfile until the report is written."""
+    global _profiler
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def _summarize(samples: list[float]) -> dict:
+    samples = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for value in samples:
+        buckets[bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+
+    return {
+        "count": len(samples),
+        "sum": sum(samples),
+        "min": samples[0],
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": samples[-1],
+        "buckets": dict(zip([*map(str, HISTOGRAM_BUCKETS), "+Inf"], buckets)),
+    }
+
+
+def _stop_profiler(profile_dir: Path) -> None:
+    """Saves the profile for snakeviz and the like, keeps the top functions."""
+    global _profiler, _profile
+    _profiler.disable()  # type: ignore
+    _profiler.dump_stats(profile_dir)  # type: ignore
+
+    stats = pstats.Stats(_profiler)
+    _profiler = None
+
+    top = sorted(stats.stats.items(), key=lambda x: x[1][3], reverse=True)  # type: ignore
+    _profile = {
+        "path": str(profile_dir),
+        "top": [
+            {
+                "function": f"{file}:{line}({func})",
+                "calls": calls,
+                "tottime": tottime,
+                "cumtime": cumtime,
+            }
+            for (file, line, func), (_, calls, tottime, cumtime, _) in top[:PROFILE_TOP]
+        ],
+    }
+
+
+def write_report(report_dir: Path) -> None:
+    """Ends the current section and writes the report of the run.
+
+    If the profiler is running, it is stopped and its stats are saved
+    next to the report with the .prof extension. The report can be
+    written again later, e.g. on exit, with everything recorded since.
+    """
+    end_section()
+    os.makedirs(report_dir.parent, exist_ok=True)
+
+    if _profiler is not None:
+        _stop_profiler(report_dir.with_suffix(".prof"))
+
+    other_data: dict = {}
+    if _profile is not None:
+        other_data["profile"] = _profile
+
+    with _lock:
+        stages: dict[str, float] = {}
+        for event in _events:
+            if event["ph"] == "X":
+                stages[event["name"]] = (
+                    stages.get(event["name"], 0) + event["dur"] / 1e6
+                )
+
+        other_data |= {
+            "stages": stages,  # seconds spent in every stage, all threads summed
+            "counters": _counters.copy(),
+            "histograms": {k: _summarize(v) for k, v in _samples.items() if v},
+        }
+        report = {
+            "traceEvents": _events.copy(),
+            "displayTimeUnit": "ms",
+            "otherData": other_data,
+        }
+
+    with open(report_dir, "w", encoding="utf-8") as f:
+        json.dump(report, f)
@@ -4,42 +4,33 @@
 # you may not use this file except in compliance with the License.
 
 import atexit
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 import contextlib
-from io import BytesIO
-import itertools
-from multiprocessing import freeze_support
+from multiprocessing import Manager, freeze_support
 import os
+import queue
 from signal import signal, SIGINT, SIG_IGN
 from subprocess import check_call, run, DEVNULL
 import sys
 import threading
-import time
+from typing import TYPE_CHECKING
 import warnings
 import webbrowser
 
-import numpy as np
-import pandas as pd
-from PIL import Image
-from pptx import Presentation
-from pptx.dml.color import RGBColor
-from pptx.enum.shapes import MSO_SHAPE  # type: ignore
-from pptx.enum.text import PP_ALIGN  # type: ignore
-from pptx.slide import Slide
-from pptx.util import Cm
-from pywintypes import com_error
 from rich.padding import Padding
-import requests
-import win32com.client
-import xlwings as xw
 
+from avatar_cache import AvatarCache
+from avatars import AvatarRenderer
 from client import (
+    AvatarStatus,
     ProgramStatus,
-    fetch_avatar,
+    fetch_avatars,
+    fetch_cached,
     fetch_latest_version,
-    download_avatars,
+    prefetch_images,
     _get_download_banner,
     fetch_token_file,
+    read_cached,
 )
 from compiled_regex import *
 from config import Config
@@ -47,229 +38,325 @@ import constants
 from constants import *
 from errors import Error, ErrorType, print_exception_hook
 from exceptions import *
+import instrument
 from utils import (
     inp,
     enable_console,
     disable_console,
-    is_number,
-    as_type,
-    hex_to_rgb,
     parse_version,
-    parse_coef,
-    clean_name,
     abs_dir,
-    get_avatar_dir,
-    artistic_effect,
 )
 from vba.macros import module1_bas
 
+# Heavy modules are imported by the sections that need them, so the
+# program starts up without loading pandas, python-pptx or XlsxWriter
+if TYPE_CHECKING:
+    import pandas as pd
 
-def _replace_avatar(slide: Slide, shape, run, *, uid: str) -> None:
-    """Replaces avatar element on slide with avatar.
 
-    Args:
-        slide (Slide): _description_
-        shape: _description_
-        run: _description_
-        uid (str): _description_
+def _duplicate_with_powerpoint(df: "pd.DataFrame", output_prs_dir: Path) -> None:
+    """Duplicates the template slides through PowerPoint and VBA macros.
+
+    This is the fallback for templates that the in-process duplication
+    engine cannot handle. The result is saved to output_prs_dir.
     """
-    effect_id = parse_coef(
-        run.text, field_name="p"
-    )  # parse effect id from the field's coefficient
-    run.text = ""  # reset text box to empty
-
-    avatar_og_dir = get_avatar_dir(uid)  # get avatar without effect directory
-    if not avatar_og_dir.is_file():
-        return
-
-    # Add avatar to slide
-    avatar_dir = artistic_effect(avatar_og_dir, effect=effect_id)
-    new_shape = slide.shapes.add_picture(  # type: ignore
-        str(avatar_dir), shape.left, shape.top, shape.width, shape.height
+    from pywintypes import com_error
+    import win32com.client
+
+    run(
+        "TASKKILL /F /IM powerpnt.exe",  # kill all PowerPoint instances
+        stdout=DEVNULL,
+        stderr=DEVNULL,
     )
-    new_shape.auto_shape_type = MSO_SHAPE.OVAL
-    old = shape._element
-    new = new_shape._element
-    old.addnext(new)
-    old.getparent().remove(old)
-
-
-def _replace_text(run, field_name, *, text: str) -> None:
-    if field_name.startswith(cfg.trigger_word):  # apply to {triggerword_blahblah}
-        # Find breakpoints and apply conditional formatting to numbers
-        for ind, breakpoint in enumerate(cfg.ranges[::-1]):
-            if not is_number(text):
-                break
-
-            if float(text) >= breakpoint:
-                if parse_coef(run.text, field_name=field_name) == 0:
-                    run.font.color.rgb = RGBColor(*scheme[::-1][ind])
-                else:
-                    run.font.color.rgb = RGBColor(*scheme_alt[::-1][ind])
-                break
-
-        run.text = text
-    else:
-        # Replace text normally
-        run.text = run.text.replace("{" + field_name + "}", text)
 
+    # Create Module1.bas
+    with open(abs_dir(TEMP_DIR, "Module1.bas"), "w") as f:
+        f.write(module1_bas)
 
-def _replace_image_url(shape, p, run) -> None:
-    if img_url := match_url.findall(run.text):  # find image urls
-        with contextlib.suppress(Exception):
-            margin_left = _insert_image(shape, img_url=img_url[0])
-            run.text = run.text.replace(img_url[0], "")
-            # With some measurements we can obtain 12.47 cm = 4490850
-            # 1 cm = 360132.3175621492
-            shape.text_frame.margin_left = Cm(margin_left / 360132.3175621492)
-            p.alignment = PP_ALIGN.LEFT
+    # Open template.pptm
+    ppt = win32com.client.Dispatch("PowerPoint.Application")
+    ppt.Presentations.Open(abs_dir("template.pptm"))
 
+    # Minimize the window
+    try:
+        ppt.ActiveWindow.WindowState = 2
+    except:  # catch all "no opened window" errors
+        pass
 
-def _insert_image(shape, *, img_url: str) -> float:
-    """Inserts an image on top of a shape on slide.
+    # Import macros
+    try:
+        ppt.VBE.ActiveVBProject.VBComponents.Import(abs_dir(TEMP_DIR, "Module1.bas"))
+    except com_error as e:  # trust access not yet enabled
+        if e.hresult == -2147352567:  # type: ignore
+            Error(41).throw()
+        else:
+            raise e
 
-    Args:
-        shape: the shape to fit the image.
-        img_url (str): the URL of the image on the internet.
+    # Duplicate initial template slides
+    slides_count = ppt.Run("Count")
+    for template in df["__template"]:
+        ppt.Run("Duplicate", template)
+    ppt.Run("DelSlide", *range(1, slides_count + 1))  # delete initial template slides
 
-    Returns:
-        float: the left margin to indent the remaining text.
-    """
-    im_bytes = BytesIO(requests.get(img_url).content)
-    img = Image.open(im_bytes)
+    # Save as .pptx
+    ppt.Run("SaveAs", str(output_prs_dir))
+    ppt.Quit()
 
-    height = shape.height
-    width = height / img.height * img.width
-    left = shape.left + (shape.width - width) / 2
-    top = shape.top
 
-    new_shape = slide.shapes.add_picture(  # type: ignore
-        im_bytes, left, top, width, height
-    )
-    shape._element.addnext(new_shape._element)
+def _export_statistics(sheet: str, df: "pd.DataFrame") -> None:
+    output_stats_dir = abs_dir(STATS_DIR, f"{sheet} Statistics.xlsx")
 
-    return left + width  # left margin for the remaining text
+    while True:
+        try:
+            export_statistics(df, output_stats_dir)
+        except StatisticsLockedError:
+            Error(42).throw(
+                f"{sheet} Statistics.xlsx - Excel", err_type=ErrorType.WARNING
+            )
+            continue
+        break
 
 
-def fill_slide(slide: Slide, data: dict[str, str]) -> None:
-    columns = set([*data] + ["p"])
+def _export_combined_statistics() -> None:
+    output_stats_dir = abs_dir(STATS_DIR, "Statistics.xlsx")
 
-    for shape in slide.shapes:  # type: ignore
-        if not shape.has_text_frame:
+    while True:
+        try:
+            export_combined_statistics(groups, output_stats_dir)
+        except StatisticsLockedError:
+            Error(42).throw("Statistics.xlsx - Excel", err_type=ErrorType.WARNING)
             continue
+        break
+
+
+def _get_fingerprints(df: "pd.DataFrame") -> list[str] | None:
+    """Returns the fingerprints of the slides of a sheet in incremental mode."""
+    if not cfg.incremental:
+        return None
+
+    return slide_fingerprints(
+        df,
+        template_key=template_key,
+        avatar_urls={uid: entry["url"] for uid, entry in avatar_cache.entries.items()},
+    )
+
+
+def _wait_for_downloads() -> None:
+    """Waits for the avatars and the linked images to be downloaded."""
+    with instrument.span("wait for downloads"):
+        if avatar_mode:
+            thread_avatar.join()
+        thread_images.join()
+
 
-        for p in shape.text_frame.paragraphs:
-            for run in p.runs:
-                for field_name in match_field_name.findall(run.text):
-                    field_name = field_name.lstrip("__")
-                    if field_name not in columns:
-                        continue
-
-                    # Replace {p} with avatar
-                    if field_name == "p":
-                        _replace_avatar(slide, shape, run, uid=data["uid"])
-                        break
-
-                    # Replace text
-                    _replace_text(run, field_name, text=data[field_name])
-
-                    _replace_image_url(shape, p, run)
-
-
-def preview_df(
-    df: pd.DataFrame,
-    filter_series: pd.Series | None = None,
-    *,
-    n_cols: int,
-    n_cols_ext: int = 5,
-    highlight: bool = True,
-    words_to_highlight: list[str | None] | None = None,
-) -> str:
-    """Formats and returns a string preview of the dataframe.
-
-    Args:
-        df: the dataframe to format.
-        filter_series (optional): the boolean series used to select
-            rows. Pass None to include all rows in the preview. Defaults
-            to None.
-        n_cols: the number columns to format (starts at first column).
-            If n_cols is less than the number of columns in the dataframe,
-            the preview will be a snippet, which shows ellipses at the
-            end of every line).
-        n_cols_ext (optional): the number of extra columns to preview
-            alongside with the formatted columns. Defaults to 5.
-        highlight (optional): enable value highlighting. Defaults to
-            True.
-        words_to_highlight (optional): list of words
-            to highlight in red (only effective to values in the first
-            n_cols columns). List None if the value to highlight is
-            numpy.nan. Pass None to highlight nothing. Defaults to None.
+def _stream_sheet(
+    df: "pd.DataFrame", output_prs_dir: Path, previous: "PreviousOutput | None"
+) -> bool:
+    """Writes a sheet one slide at a time to save memory.
+
+    The unchanged slides of the previous output, if any, are copied over
+    instead of being filled again.
 
     Returns:
-        str: the formatted dataframe as a string.
+        bool: whether the presentation has been saved, False if the
+            template slides cannot be streamed.
     """
-    if words_to_highlight is None:
-        words_to_highlight = []
-
-    df = df.copy(deep=True)
-    if filter_series is not None:
-        df = df[filter_series]
-    df.index += 2  # reflect row index as displayed in Excel
-
-    # Only show the first few columns for preview
-    df = df.iloc[:, : min(n_cols + n_cols_ext, len(df.columns))]
-
-    # Replace text_to_highlight with ⁅text_to_highlight⁆
-    prefix, suffix = "⁅", "⁆"  # arbitrary symbols, must be single length
-    highlight_str = lambda x: f"{prefix}{x}{suffix}"
-    for word in words_to_highlight:
-        if word is None:
-            df.iloc[:, :n_cols] = df.iloc[:, :n_cols].fillna(highlight_str("NaN"))
+    _wait_for_downloads()
+    fingerprints = _get_fingerprints(df)
+
+    try:
+        with instrument.span("stream"):
+            stream_presentation(
+                open_compiled_template(template),
+                df,
+                output_prs_dir,
+                cfg=cfg,
+                field_maps=template.field_maps,
+                renderer=avatar_renderer,
+                previous=previous,
+                fingerprints=fingerprints,
+            )
+    except UnsupportedSlideError:
+        return False
+
+    if fingerprints is not None:
+        save_fingerprints(output_prs_dir, fingerprints)
+    return True
+
+
+def _build_sheet(df: "pd.DataFrame", output_prs_dir: Path) -> None:
+    """Generates the presentation of a sheet with every slide in memory."""
+    # Duplicate slides in-process, fall back to PowerPoint if unsupported
+    with instrument.span("duplicate"):
+        prs = open_compiled_template(template)
+        field_maps = template.field_maps
+
+        try:
+            duplicate_slides(prs, df["__template"])
+        except UnsupportedSlideError:
+            instrument.count("sheets.powerpoint_fallback")
+            _duplicate_with_powerpoint(df, output_prs_dir)
+            prs = open_template(output_prs_dir)
+            field_maps = None  # slides saved by PowerPoint are scanned one by one
+
+    # Wait for avatars and linked images
+    _wait_for_downloads()
+    fingerprints = _get_fingerprints(df) if field_maps is not None else None
+
+    # Fill slides with judging data
+    with instrument.span("fill"):
+        fill_presentation(
+            prs,
+            df,
+            cfg=cfg,
+            field_maps=field_maps,
+            renderer=avatar_renderer,
+        )
+
+    # Save .pptx file
+    with instrument.span("save"):
+        save_presentation(prs, output_prs_dir)
+    if fingerprints is not None:
+        save_fingerprints(output_prs_dir, fingerprints)
+
+
+def _generate_sheet(sheet: str, df: "pd.DataFrame") -> None:
+    with instrument.span("sheet", sheet=sheet, slides=len(df)):
+        # Generate statistics
+        if cfg.statistics == True and not cfg.combined_statistics:
+            with instrument.span("statistics"):
+                _export_statistics(sheet, df)
+
+        output_prs_dir = abs_dir(OUTPUT_DIR, f"{sheet}.pptx")
+        check_template_ids(df, slides_count=template.slides_count)
+        # Stream long sheets, and sheets with slides to copy from the last run
+        previous = load_previous_output(output_prs_dir) if cfg.incremental else None
+        if (len(df) >= STREAM_MIN_SLIDES or previous is not None) and _stream_sheet(
+            df, output_prs_dir, previous
+        ):
+            instrument.count("sheets.streamed")
         else:
-            df.iloc[:, :n_cols] = df.iloc[:, :n_cols].replace(word, highlight_str(word))
+            _build_sheet(df, output_prs_dir)
 
-    preview = repr(df.head(8)) if n_cols < len(df.columns) else repr(df)
+    instrument.count("sheets.generated")
 
-    # Highlight text_to_highlight
-    preview = preview.replace(prefix, "[red]  ").replace(suffix, "[/red]")
 
-    # Highlight column names
-    for n in range(n_cols):
-        col = df.columns.tolist()[n]
-        preview = preview.replace(" " + col, f" [red]{col}[/red]", 1)
+def _get_generate_banner(progress: dict[str, tuple[int, int]]) -> str:
+    indent = " " * (constants.padding - 2)
+    n_done = sum(n == total for n, total in progress.values())
+    lines = [
+        f"{' ' * constants.padding}{sheet}  ({n} of {total} slides)"
+        for sheet, (n, total) in progress.items()
+        if 0 < n < total
+    ]
+    return (
+        f"{indent}[bold yellow]Generating slides...[/bold yellow] "
+        f"({n_done} of {len(progress)} sheets done)\n" + "\n".join(lines)
+    )
+
+
+def _generate_parallel() -> None:
+    """Generates every sheet in a separate worker process.
+
+    Everything that may prompt the user happens in the main process:
+    template IDs are checked before the sheets are dispatched, and the
+    sheets that need PowerPoint or whose statistics file is opened in
+    Excel are handled sequentially afterwards.
+    """
+    for df in groups.values():
+        check_template_ids(df, slides_count=template.slides_count)
 
-    # Add ... at the end of each line if preview is a snippet
-    if n_cols < len(df.columns):
-        preview = preview.replace("\n", "  ...\n") + "  ..."
+    # Avatars and images are downloaded once up front and shared by all workers
+    if avatar_mode:
+        thread_avatar.join()
+    thread_images.join()
+
+    progress = {sheet: (0, len(df)) for sheet, df in groups.items()}
+    max_workers = min(len(groups), os.cpu_count() or 1)
+
+    with Manager() as manager, ProcessPoolExecutor(max_workers) as pool:
+        progress_queue = manager.Queue()
+        futures = {
+            pool.submit(
+                generate_sheet,
+                sheet,
+                df,
+                cfg=cfg,
+                template=template,
+                output_prs_dir=abs_dir(OUTPUT_DIR, f"{sheet}.pptx"),
+                output_stats_dir=(
+                    abs_dir(STATS_DIR, f"{sheet} Statistics.xlsx")
+                    if cfg.statistics and not cfg.combined_statistics
+                    else None
+                ),
+                fingerprints=_get_fingerprints(df),
+                progress_queue=progress_queue,
+            ): sheet
+            for sheet, df in groups.items()
+        }
+
+        with console.status(
+            _get_generate_banner(progress), refresh_per_second=10
+        ) as status:
+            while True:
+                done, _ = wait(futures, timeout=0.1)
 
-    # Bold first row
-    preview = "[b]" + preview.replace("\n", "[/b]\n", 1)
+                with contextlib.suppress(queue.Empty):
+                    while True:
+                        sheet, n, total = progress_queue.get_nowait()
+                        progress[sheet] = (n, total)
 
-    if not highlight:
-        preview = preview.replace("[red]", "")
-    return preview
+                for future in done:  # count failed sheets as done
+                    progress[futures[future]] = (len(groups[futures[future]]),) * 2
+                status.update(_get_generate_banner(progress))
+
+                if len(done) == len(futures):
+                    break
+
+    for future, sheet in futures.items():
+        try:
+            instrument.merge(future.result())  # spans and counters of the worker
+        except UnsupportedSlideError:  # template needs PowerPoint
+            instrument.count("sheets.powerpoint_fallback")
+            _generate_sheet(sheet, groups[sheet])
+        except StatisticsLockedError:  # statistics file is opened in Excel
+            _export_statistics(sheet, groups[sheet])
+
+
+def _prefetch_images() -> None:
+    """Downloads the images linked in the data file to the image cache."""
+    with instrument.span("prefetch images"):
+        prefetch_images(
+            url
+            for df in groups.values()
+            for val in df.select_dtypes(include="object").to_numpy().ravel()
+            if isinstance(val, str)
+            for url in match_url.findall(val)
+        )
 
 
 def _import_avatars():
+    import pandas as pd
+
     failed = False  # whether the download task has failed
     max_attempt = 5  # maximum number of attempts
     has_task = False  # whether a download task exists (to skip avatar download banner)
     uids_unknown = []  # uids that failed to download
 
+    uids = []  # uids that are not downloaded yet
+    for df in groups.values():
+        if df["__uid"].dtype.kind in "biufc":  # if uid column is numeric
+            Error(70).throw()
+
+        for id in df["__uid"]:
+            if not (
+                pd.isnull(id)  # skip nan values
+                or avatar_cache.is_fresh(id)  # skip if cached and up to date
+                or id in uids  # skip if uid already in queue
+            ):
+                uids.append(id)
+
     for attempt in range(1, max_attempt + 1):
-        uids = []  # uids that are not downloaded yet
-        for df in groups.values():
-            if df["__uid"].dtype.kind in "biufc":  # if uid column is numeric
-                Error(70).throw()
-
-            for id in df["__uid"]:
-                if not (
-                    pd.isnull(id)  # skip nan values
-                    or get_avatar_dir(id).is_file()  # skip if already downloaded
-                    or id in uids  # skip if uid already in queue
-                    or id in uids_unknown  # skip if already in the unknown list
-                ):
-                    uids.append(id)
         if not uids:  # if queue is empty, break and finish the task
             break
 
@@ -282,6 +369,10 @@ def _import_avatars():
             failed = True
             uids_unknown += uids  # add all uids in the queue to the unknown list
             break
+        else:
+            instrument.count("avatars.retry_attempts")
+
+        results: dict[str, AvatarStatus] = {}  # outcome of every finished uid
 
         try:
             with console.status(
@@ -290,56 +381,24 @@ def _import_avatars():
                 ),
                 refresh_per_second=100,
             ) as status:
-                constants.is_downloading = True
-                thread_download = threading.Thread(target=download_avatars)
-                thread_download.start()  # download while fetching avatars
 
-                task_list = list(
-                    zip(
+                def on_done(uid: str, avatar_status: AvatarStatus) -> None:
+                    results[uid] = avatar_status
+                    instrument.count(f"avatars.{avatar_status.name.lower()}")
+                    constants.downloaded += 1
+                    status.update(_get_download_banner(f"{uid}: {avatar_status.value}"))
+
+                with instrument.span("fetch avatars", attempt=attempt, uids=len(uids)):
+                    fetch_avatars(
                         uids,
-                        itertools.islice(  # distribute tokens evenly among instances
-                            itertools.cycle(token_list), constants.queue_len
-                        ),
+                        token_list,
+                        size=cfg.avatar_resolution,
+                        cache=avatar_cache,
+                        on_done=on_done,
                     )
-                )
-                constants.max_workers = min(32, (os.cpu_count() or 1) + 2)
-                constants.delay = 0.28 / len(token_list)
-
-                with ThreadPoolExecutor(max_workers=constants.max_workers) as pool:
-                    for batch_number, task_batch in enumerate(
-                        np.array_split(
-                            task_list, len(task_list) // (80 * len(token_list)) + 1
-                        )
-                    ):
-                        futures = []
-                        for iteration, (uid, api_token) in enumerate(task_batch):
-                            if iteration < len(token_list) and batch_number == 0:
-                                # Test if the tokens are working
-                                fetch_avatar(
-                                    uid, api_token, cfg.avatar_resolution, status
-                                )
-                            else:
-                                futures.append(
-                                    pool.submit(
-                                        fetch_avatar,
-                                        uid,
-                                        api_token,
-                                        cfg.avatar_resolution,
-                                        status,
-                                    )
-                                )
-
-                        # Wait and finish before moving on to the next batch
-                        for future in futures:
-                            try:
-                                future.result()
-                            except AttributeError:
-                                pass
-
-                constants.is_downloading = False
-                thread_download.join()
 
         except (ConnectionError, TimeoutError) as e:
+            instrument.count("avatars.connection_errors")
             if attempt >= 3:
                 Error(20).throw(err_type=ErrorType.WARNING)
         except InvalidTokenError as e:
@@ -347,6 +406,20 @@ def _import_avatars():
         except DiscordAPIError as e:
             Error(22).throw(*e.args)
 
+        # Retry the failed and unfinished uids only
+        uids_unknown += [u for u in uids if results.get(u) == AvatarStatus.UNKNOWN]
+        uids = [
+            u
+            for u in uids
+            if results.get(u, AvatarStatus.FAILED) == AvatarStatus.FAILED
+        ]
+
+    # Keep the avatars of this run and evict the least recently used ones
+    uids_used = {id for df in groups.values() for id in df["__uid"].dropna()}
+    avatar_cache.touch(uids_used)
+    avatar_cache.evict(keep=uids_used)
+    avatar_cache.save()
+
     if uids_unknown:
         Error(23).throw(str(uids_unknown), err_type=ErrorType.WARNING)
 
@@ -363,23 +436,36 @@ def _import_avatars():
 
 
 if __name__ == "__main__":
+    freeze_support()  # multiprocessing freeze support, must be called first
+
+    # Record the stages of the run to .temp/trace.json, see instrument.py
+    if "--profile" in sys.argv:
+        instrument.start_profiler()
+    trace_dir = abs_dir(TEMP_DIR, "trace.json")
+    atexit.register(instrument.write_report, trace_dir)
+
     check_call(["attrib", "+H", abs_dir("lib")])  # hide library folder
     check_call(["attrib", "+H", abs_dir("python3.dll")])
     check_call(["attrib", "+H", abs_dir("python311.dll")])
 
-    version_tag = "3.0.1"
     console.clear()
-    console.set_window_title(f"Mic Drop Results {version_tag}")
+    console.set_window_title(f"Mic Drop Results {VERSION_TAG}")
     disable_console()
 
     # Section A: Fix console-related issues
-    freeze_support()  # multiprocessing freeze support
+    instrument.begin_section("Section A: Fix console-related issues")
     signal(SIGINT, SIG_IGN)  # handle KeyboardInterrupt
     atexit.register(enable_console)
     warnings.simplefilter(action="ignore", category=UserWarning)
     sys.excepthook = print_exception_hook  # avoid exiting program on exception
 
     # Section B1: Update token.txt
+    instrument.begin_section("Section B1: Update token.txt")
+    network = ThreadPoolExecutor(2)  # network checks run alongside Sections C to G
+    future_token_file = network.submit(
+        fetch_cached, "token_file", fetch_token_file, ttl=TOKEN_FILE_TTL
+    )
+
     try:
         with open(abs_dir("token.txt"), "r", encoding="utf-8", errors="ignore") as f:
             lines = f.read().splitlines()
@@ -389,10 +475,18 @@ if __name__ == "__main__":
     except (FileNotFoundError, ValueError):
         token_list = []
 
-    with open(abs_dir("token.txt"), "w", encoding="utf-8", errors="ignore") as f:
-        f.write("\n".join(token_list + [fetch_token_file()]))
+    # Use the template from the last run, only wait for the download if
+    # there is neither a cached template nor a token.txt yet
+    token_file = read_cached("token_file")
+    if token_file is None and not abs_dir("token.txt").is_file():
+        token_file = future_token_file.result() or ""
+
+    if token_file is not None:
+        with open(abs_dir("token.txt"), "w", encoding="utf-8", errors="ignore") as f:
+            f.write("\n".join(token_list + [token_file]))
 
     # Section B2: Check for missing files
+    instrument.begin_section("Section B2: Check for missing files")
     if missing_files := [
         f
         for f in (
@@ -410,14 +504,12 @@ if __name__ == "__main__":
         )
 
     # Section C: Load user configurations
+    instrument.begin_section("Section C: Load user configurations")
     cfg = Config(str(abs_dir("settings.ini")))
-    n_scols = len(cfg.sort_orders)  # number of sorting columns
     avatar_mode = cfg.avatar_mode  # is subject to change later
-    scheme, scheme_alt = [
-        list(map(hex_to_rgb, x)) for x in (cfg.scheme, cfg.scheme_alt)
-    ]
 
     # Section D: Parse and test tokens
+    instrument.begin_section("Section D: Parse and test tokens")
     with open(abs_dir("token.txt"), "r", encoding="utf-8") as f:
         lines = f.read().splitlines()
         token_list = [line.replace('"', "").strip() for line in lines if len(line) > 70]
@@ -426,192 +518,64 @@ if __name__ == "__main__":
         Error(21).throw()
 
     # Section E: Check for updates
-    status = None
+    instrument.begin_section("Section E: Check for updates")
+    future_release = None  # shown once the slides are generated
     if cfg.update_check:
-        with contextlib.suppress(
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ReadTimeout,
-            KeyError,
-        ):
-            # Fetch the latest version and the summary of the update
-            latest_tag, summary = fetch_latest_version()
-
-            latest, current = parse_version(latest_tag, version_tag)
-
-            if latest > current:
-                status = ProgramStatus.UPDATE_AVAILABLE
-
-                console.print(
-                    Padding(
-                        f"[bold yellow]Update available: Version {latest_tag}[/bold yellow]\n"
-                        f"{summary}\n"
-                        f"Visit release: {LATEST_RELEASE_URL}",
-                        (2, constants.padding, 2, constants.padding),
-                    )
-                )
-
-                time.sleep(3)
-                webbrowser.open(LATEST_RELEASE_URL, new=2)
-                time.sleep(3)
-
-            elif latest < current:
-                status = ProgramStatus.BETA
-            else:
-                status = ProgramStatus.UP_TO_DATE
+        future_release = network.submit(
+            fetch_cached, "latest_version", fetch_latest_version, ttl=UPDATE_CHECK_TTL
+        )
 
     # Print the program's header
     console.print(f"[bold]Mic Drop Results[/bold] ", justify="center")
-    console.print(f"Version {version_tag}", justify="center")
+    console.print(f"Version {VERSION_TAG}", justify="center")
     console.print(REPO_URL, justify="center")
 
     # Section F: Read and process the data file
-    xls = pd.ExcelFile(abs_dir("data.xlsm"))
-    workbook: dict[str, pd.DataFrame] = pd.read_excel(xls, sheet_name=None)
-    xls.close()
-
-    sheet_names = [
-        match_forbidden_char.sub("", str(name)).strip()  # forbidden file name chars
-        for name in workbook
-    ]
-    workbook = {name: list(workbook.values())[i] for i, name in enumerate(sheet_names)}
-
-    db_prefix = "("  # signifies database tables
-    database: dict[str, pd.DataFrame] = {}
-    for sheet in sheet_names:
-        if not sheet.startswith(db_prefix):
-            continue  # exclude non-database sheets
-
-        table = workbook[sheet]
-        if table.empty or table.shape < (1, 2):  # (1 row, 2 cols) min
-            continue
-        table = table.replace(np.nan, None)
-        database[sheet] = table
-
-    groups: dict[str, pd.DataFrame] = {}
-    for sheet in sheet_names:
-        if sheet.startswith(db_prefix):
-            continue  # exclude database tables
-
-        df = workbook[sheet]
-        if df.empty or df.shape < (1, n_scols):  # (1 row, n_scols cols) min
-            continue
-        df = df.replace(np.nan, None)
-
-        scols = df.columns.tolist()[:n_scols]  # get sorting cols
-        SHEET_INFO = (
-            f"[b]Sheet name:[/b]  {sheet}\n\n"
-            "See the following row(s) in data.xlsm to find out what caused the problem:"
-        )
-
-        # Exclude sheets with non-numeric sorting cols
-        if any(df.loc[:, scol].dtype.kind not in "biufc" for scol in scols):
-            # Get list of non-numeric vals
-            str_vals = (
-                df.loc[:, scols][~df.loc[:, scols].applymap(np.isreal)]
-                .melt(value_name="__value")
-                .dropna()["__value"]
-                .tolist()
-            )
-
-            Error(60).throw(
-                SHEET_INFO,
-                preview_df(
-                    df,
-                    ~df.loc[:, scols].applymap(np.isreal).all(1),
-                    n_cols=n_scols,
-                    words_to_highlight=str_vals,
-                ),
-                err_type=ErrorType.ERROR,
-            )
-
-        # Fill nan vals within the sorting cols
-        if df.loc[:, scols].isnull().values.any():
-            Error(61).throw(
-                SHEET_INFO,
-                preview_df(
-                    df,
-                    df.loc[:, scols].isnull().any(axis=1),
-                    n_cols=n_scols,
-                    words_to_highlight=[None],
-                ),
-                err_type=ErrorType.WARNING,
-            )
-
-            df.loc[:, scols] = df.loc[:, scols].fillna(0)
-
-        # Rank the slides
-        df["__r"] = (
-            pd.DataFrame(
-                df.loc[:, scols]  # select sorting cols
-                * (np.array(cfg.sort_orders) * 2 - 1)
-            )  # map bool 0/1 to -1/1
-            .apply(tuple, axis=1)  # type: ignore
-            .rank(method="min", ascending=False)
-            .astype(int)
-        )
+    instrument.begin_section("Section F: Read and process the data file")
+    from processing import (
+        check_template_ids,
+        hash_data,
+        load_processed_data,
+        process_data,
+        save_processed_data,
+        throw_warnings,
+    )
 
-        # Sort the slides by rank
-        df = df.sort_values(by="__r", ascending=True)
+    data_key = hash_data(abs_dir("data.xlsm"), VERSION_TAG, cfg.sort_orders)
+    data_cache_dir = abs_dir(TEMP_DIR, "data_cache.pkl")
 
-        # Remove .0 from whole nums
-        format_int = lambda x: str(int(x)) if x % 1 == 0 else str(x)
-        df.loc[:, df.dtypes == float] = df.loc[:, df.dtypes == float].applymap(
-            format_int
+    if cached_data := load_processed_data(data_cache_dir, data_key):
+        instrument.count("data_cache.hits")
+        groups, database, data_warnings = cached_data
+        throw_warnings(data_warnings)
+    else:
+        instrument.count("data_cache.misses")
+        data_warnings = []
+        groups, database = process_data(
+            abs_dir("data.xlsm"), sort_orders=cfg.sort_orders, warnings=data_warnings
         )
+        save_processed_data(data_cache_dir, data_key, groups, database, data_warnings)
 
-        # Replace {__sheet} with sheet name
-        df["__sheet"] = sheet
-
-        # Merge contestant database
-        if database:
-            process_str = lambda series: (
-                series.apply(clean_name) if (series.dtype.kind == "O") else series
-            )
-
-            for table in database.values():
-                df_cols = df.columns.tolist()
-                db_cols = table.columns.tolist()
-
-                anchor_col = db_cols[0]
-                overlapped_cols = [
-                    col for col in db_cols if (col in df_cols) and (col != anchor_col)
-                ]
-
-                if anchor_col not in df_cols:  # TODO: add a warning
-                    continue
-
-                # Copy processed vals of anchor col to '__merge_anchor'
-                df["__merge_anchor"] = process_str(df[anchor_col])
-                table["__merge_anchor"] = process_str(table[anchor_col])
-                table = table.drop(columns=anchor_col)
-                table = table.drop_duplicates("__merge_anchor")
-
-                # Merge
-                df = df.merge(table, on="__merge_anchor", how="left")
-                # Note: merging wtih an existing column will produce duplicates
-
-                for col in overlapped_cols:
-                    df[col] = df[f"{col}_x"].fillna(df[f"{col}_y"])
-                    df = df.drop(columns=[f"{col}_x", f"{col}_y"])
-
-                df = df.drop(columns="__merge_anchor")
-
-        if "__uid" not in df.columns:
-            avatar_mode = False
-
-        df["__template"] = df["__template"].fillna(1)
-        df["__uid"] = df["__uid"].str.replace("_", "").str.strip()
-        groups[sheet] = df
+    if any("__uid" not in df.columns for df in groups.values()):
+        avatar_mode = False
 
     if not groups:
         Error(68).throw()
 
     # Section G: Generate PowerPoint slides
-    run(
-        "TASKKILL /F /IM powerpnt.exe",  # kill all PowerPoint instances
-        stdout=DEVNULL,
-        stderr=DEVNULL,
+    instrument.begin_section("Section G: Generate PowerPoint slides")
+    from compiled_template import compile_template, open_compiled_template
+    from generate import fill_presentation, generate_sheet, stream_presentation
+    from incremental import (
+        PreviousOutput,
+        load_previous_output,
+        save_fingerprints,
+        slide_fingerprints,
     )
+    from slides import open_template, duplicate_slides, save_presentation
+
+    if cfg.statistics or cfg.data_export != "none":
+        from stats import export_combined_statistics, export_data, export_statistics
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     os.makedirs(STATS_DIR, exist_ok=True)
@@ -619,178 +583,84 @@ if __name__ == "__main__":
     os.makedirs(TEMP_DIR, exist_ok=True)
     check_call(["attrib", "+H", TEMP_DIR])  # hide temp folder
 
-    # Create Module1.bas
-    with open(abs_dir(TEMP_DIR, "Module1.bas"), "w") as f:
-        f.write(module1_bas)
-
     ### Main body
     console.print(
         Padding(
             "[bold yellow]Generating slides...[/bold yellow]\n"
-            "To prevent any errors or interruptions, please avoid clicking on "
-            "any PowerPoint window that pops up during the process.",
+            "If a PowerPoint window pops up during the process, please avoid "
+            "clicking on it to prevent any errors or interruptions.",
             (2, constants.padding, 2, constants.padding),
         )
     )
 
+    template = compile_template(
+        abs_dir("template.pptm"),
+        trigger_word=cfg.trigger_word,
+        cache_dir=abs_dir(TEMP_DIR, "template_cache.pkl"),
+    )
+    template_key = hash_data(
+        abs_dir("template.pptm"),
+        VERSION_TAG,
+        cfg.trigger_word,
+        cfg.ranges,
+        cfg.scheme,
+        cfg.scheme_alt,
+    )
+
     thread_avatar = threading.Thread(target=_import_avatars)
+    avatar_renderer = AvatarRenderer()
+    avatar_cache = AvatarCache(
+        abs_dir(TEMP_DIR, "avatar_cache.json"),
+        ttl=AVATAR_CACHE_TTL,
+        max_size=AVATAR_CACHE_MAX_SIZE,
+    )
     if avatar_mode:
-        last_clear_dir = abs_dir(TEMP_DIR, "last_clear_avatar_cache.txt")
-
-        try:
-            with open(last_clear_dir, "r") as f:
-                last_clear_time = int(f.readline())
-        except (FileNotFoundError, ValueError):
-            last_clear_time = 0
-
-        if time.time() - last_clear_time > 3600 * 12:  # clear every 12 hours
-            for avatar_dir in os.scandir(AVATAR_DIR):
-                os.unlink(avatar_dir)
-
-            with open(last_clear_dir, "w") as f:
-                f.write(str(int(time.time())))  # update last clear time
-
         # Download avatars while generating slides
         thread_avatar.start()
+    thread_images = threading.Thread(target=_prefetch_images)
+    thread_images.start()
 
-    for sheet, df in groups.items():
-        # Generate statistics
-        if cfg.statistics == True:
-            output_stats_dir = abs_dir(STATS_DIR, f"{sheet} Statistics.xlsx")
-
-            while True:
-                try:
-                    with xw.App(visible=False) as app:  # TODO: Simplify code
-                        # Write data sheet
-                        with pd.ExcelWriter(output_stats_dir) as writer:
-                            df.fillna("").to_excel(
-                                writer, sheet_name="data", index=False
-                            )
-
-                        # Write lookup sheet
-                        stats_workbook = xw.Book(output_stats_dir)
-
-                        sheet_lookup = stats_workbook.sheets.add("lookup")
-                        sheet_data = stats_workbook.sheets["data"]
-
-                        stats_workbook.api.Styles("Normal").Font.Name = "Arial Nova"
-                        stats_workbook.api.Styles("Normal").Font.Size = 10
-                        stats_workbook.api.Styles(
-                            "Normal"
-                        ).VerticalAlignment = -4108  # align center
-
-                        sheet_data.range("1:1").api.Font.Name = "Arial Nova"
-                        sheet_data.range("1:1").api.Font.Size = 10
-                        sheet_data.range(
-                            "1:1"
-                        ).api.VerticalAlignment = -4108  # align center
-
-                        sheet_lookup.range("A:A").api.RowHeight = 15
-                        sheet_data.range("A:A").api.RowHeight = 15
-
-                        sheet_lookup.range("A1").value = "name"
-                        sheet_lookup.range("B1").value = "avg"
-                        sheet_lookup.range(
-                            "B2"
-                        ).formula2 = "=IF(ISBLANK($A2), 0, FILTER(CHOOSECOLS(data!$A:$Z, MATCH(B$1, data!$1:$1, 0)), CHOOSECOLS(data!$A:$Z, MATCH($A$1, data!$1:$1, 0))=$A2))"
-
-                        sheet_lookup.range("A:A").api.Borders(2).Weight = 2
-                        sheet_lookup.range("1:1").api.Borders(4).Weight = 2
-
-                        sheet_lookup.range("1:1").font.bold = True
-                        sheet_lookup.range(
-                            "1:1"
-                        ).api.HorizontalAlignment = -4108  # align center
-
-                        stats_workbook.save()
-                        stats_workbook.close()
-
-                except PermissionError:
-                    Error(42).throw(
-                        f"{sheet} Statistics.xlsx - Excel", err_type=ErrorType.WARNING
-                    )
-                    continue
-                break
-
-        # Open template.pptm
-        ppt = win32com.client.Dispatch("PowerPoint.Application")
-        ppt.Presentations.Open(abs_dir("template.pptm"))
+    if cfg.parallel_sheets and len(groups) > 1:
+        _generate_parallel()
+    else:
+        for sheet, df in groups.items():
+            _generate_sheet(sheet, df)
 
-        # Minimize the window
-        try:
-            ppt.ActiveWindow.WindowState = 2
-        except:  # catch all "no opened window" errors
-            pass
+    if cfg.statistics and cfg.combined_statistics:
+        with instrument.span("statistics"):
+            _export_combined_statistics()
+    if cfg.data_export != "none":
+        with instrument.span("data export"):
+            export_data(groups, STATS_DIR, fmt=cfg.data_export)
 
-        # Import macros
-        try:
-            ppt.VBE.ActiveVBProject.VBComponents.Import(
-                abs_dir(TEMP_DIR, "Module1.bas")
-            )
-        except com_error as e:  # trust access not yet enabled
-            if e.hresult == -2147352567:  # type: ignore
-                Error(41).throw()
-            else:
-                raise e
-
-        # Duplicate slides
-        slides_count = ppt.Run("Count")
-
-        # Check for invalid template IDs
-        if unknown_templates := [
-            x
-            for x in df["__template"]
-            if as_type(int, x) not in range(1, slides_count + 1)
-        ]:
-            showcase_cols = ["__r", "__template"]
-            df_showcase = df[
-                showcase_cols + [col for col in df.columns if col not in showcase_cols]
-            ]
-            df_showcase = df_showcase.drop_duplicates("__template").reset_index(
-                drop=True
-            )
-            Error(71).throw(
-                preview_df(
-                    df_showcase,
-                    n_cols=2,
-                    n_cols_ext=0,
-                    words_to_highlight=unknown_templates,
-                )
-            )
-
-        # Duplicate initial template slides
-        for template in df["__template"]:
-            ppt.Run("Duplicate", template)
-        ppt.Run(
-            "DelSlide", *range(1, slides_count + 1)
-        )  # delete initial template slides
+    # Section H: Launch the file
+    instrument.write_report(trace_dir)  # before waiting for the user
 
-        # Save as .pptx
-        output_prs_dir = abs_dir(OUTPUT_DIR, f"{sheet}.pptx")
-        ppt.Run("SaveAs", str(output_prs_dir))
-        ppt.Quit()
+    # Show the update, waiting briefly if the check is still running
+    status = None
+    with contextlib.suppress(TimeoutError):
+        if future_release and (release := future_release.result(timeout=1)):
+            latest_tag, summary = release
+            latest, current = parse_version(latest_tag, VERSION_TAG)
 
-        # Wait for avatars
-        if avatar_mode:
-            thread_avatar.join()
+            if latest > current:
+                status = ProgramStatus.UPDATE_AVAILABLE
 
-        # Open .pptx file and fill slides with judging data
-        prs = Presentation(str(output_prs_dir))
-        for i, slide in enumerate(prs.slides):
-            fill_slide(
-                slide,
-                {
-                    k.lstrip("__"): str(
-                        v
-                    )  # treat program-domain vars like normal vars when replacing
-                    for k, v in df.iloc[i].fillna("").to_dict().items()
-                },
-            )
+                console.print(
+                    Padding(
+                        f"[bold yellow]Update available: Version {latest_tag}[/bold yellow]\n"
+                        f"{summary}\n"
+                        f"Visit release: {LATEST_RELEASE_URL}",
+                        (0, constants.padding, 2, constants.padding),
+                    )
+                )
+                webbrowser.open(LATEST_RELEASE_URL, new=2)
 
-        # Save .pptx file
-        prs.save(output_prs_dir)
+            elif latest < current:
+                status = ProgramStatus.BETA
+            else:
+                status = ProgramStatus.UP_TO_DATE
 
-    # Section H: Launch the file
     inp(
         Padding(
             f"[bold yellow]Exported to {OUTPUT_DIR}[/bold yellow]\n"
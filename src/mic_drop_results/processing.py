@@ -0,0 +1,493 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from collections.abc import Sequence
+import hashlib
+import os
+from pathlib import Path
+import pickle
+from typing import Any, NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from compiled_regex import match_forbidden_char
+from errors import Error, ErrorType
+import instrument
+from utils import as_type, clean_names
+
+
+DB_PREFIX = "("  # signifies database tables
+
+
+def load_workbook(
+    data_dir: Path, *, n_scols: int
+) -> tuple[dict[str, pd.DataFrame], dict[str, pd.DataFrame]]:
+    """Reads the sheets of the data file that can be turned into slides.
+
+    The workbook is opened in read-only mode and every sheet is
+    classified by its name before it is parsed. Sheets that are too
+    narrow to be used, going by the dimension stored in the sheet
+    header, are never parsed at all.
+
+    Args:
+        data_dir: path to data.xlsm.
+        n_scols: the number of sorting columns a sheet needs.
+
+    Returns:
+        tuple[dict[str, pd.DataFrame], dict[str, pd.DataFrame]]: the
+            sheets and the database tables, keyed by their sanitized
+            names in workbook order.
+    """
+    with pd.ExcelFile(data_dir, engine="openpyxl") as xls:
+        sheet_names: dict[str, str] = {}  # original name -> sanitized name
+        for name in xls.sheet_names:
+            sheet = match_forbidden_char.sub("", str(name)).strip()
+            min_cols = 2 if sheet.startswith(DB_PREFIX) else n_scols
+
+            # Chartsheets have no cells, unsized sheets are parsed anyway
+            max_col = getattr(xls.book[name], "max_column", 0)
+            if max_col is not None and max_col < min_cols:
+                continue
+            sheet_names[name] = sheet
+
+        workbook: dict[str, pd.DataFrame] = pd.read_excel(
+            xls, sheet_name=list(sheet_names)
+        )
+
+    groups: dict[str, pd.DataFrame] = {}
+    database: dict[str, pd.DataFrame] = {}
+    for name, df in workbook.items():
+        sheet = sheet_names[name]
+
+        # Drop the empty columns past the used range, e.g. formatted cells
+        n_cols = len(df.columns)
+        while (
+            n_cols > 0
+            and str(df.columns[n_cols - 1]).startswith("Unnamed:")
+            and df.iloc[:, n_cols - 1].isna().all()
+        ):
+            n_cols -= 1
+        df = df.iloc[:, :n_cols]
+
+        if sheet.startswith(DB_PREFIX):
+            database[sheet] = df
+        else:
+            groups[sheet] = df
+
+    return groups, database
+
+
+# The traceback ID and the details of a warning about the data
+DataWarning = tuple[float, tuple[str, ...]]
+
+
+class DatabaseIndex(NamedTuple):
+    """A database table indexed by the normalized values of its anchor column."""
+
+    anchor_col: str  # the first column, matched against the sheet's column
+    table: pd.DataFrame  # the other columns, indexed by the normalized anchor
+
+
+def _normalize_anchor(series: pd.Series) -> pd.Series:
+    """Normalizes names for matching, other values are left as they are."""
+    return clean_names(series) if series.dtype.kind == "O" else series
+
+
+def build_database_index(table: pd.DataFrame) -> DatabaseIndex:
+    """Indexes a database table for lookups by its first column.
+
+    Only the first row of every normalized anchor value is kept.
+    """
+    anchor_col = table.columns[0]
+    indexed = table.drop(columns=anchor_col)
+    indexed.index = pd.Index(_normalize_anchor(table[anchor_col]))
+    indexed = indexed[~indexed.index.duplicated()]
+    return DatabaseIndex(anchor_col, indexed)
+
+
+def join_database(df: pd.DataFrame, indexes: Sequence[DatabaseIndex]) -> pd.DataFrame:
+    """Attaches the columns of the database tables to the rows of a sheet.
+
+    Every row is matched to a database row by the normalized value of
+    the anchor column. Columns that already exist in the sheet only have
+    their empty cells filled by the database, and are moved after the
+    new columns of the table.
+
+    Args:
+        df: the data of the sheet.
+        indexes: the indexed database tables, see build_database_index().
+
+    Returns:
+        pd.DataFrame: the sheet with the columns of the database.
+    """
+    joined = False
+    for db in indexes:
+        if db.anchor_col not in df.columns:  # TODO: add a warning
+            continue
+
+        matches = db.table.reindex(_normalize_anchor(df[db.anchor_col]))
+        matches.index = df.index
+
+        new_cols = [col for col in matches.columns if col not in df.columns]
+        old_cols = [col for col in matches.columns if col in df.columns]
+        filled = df[old_cols].fillna(matches[old_cols])
+        df = pd.concat([df.drop(columns=old_cols), matches[new_cols], filled], axis=1)
+        joined = True
+
+    return df.reset_index(drop=True) if joined else df
+
+
+def hash_data(data_dir: Path, *salt: Any) -> str:
+    """Hashes the content of the data file together with the salt values.
+
+    The salt should contain everything else the processed data depends
+    on, e.g. the program version and the relevant config values.
+    """
+    h = hashlib.sha256(repr(salt).encode())
+    with open(data_dir, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_processed_data(
+    cache_dir: Path, key: str
+) -> tuple[dict[str, pd.DataFrame], dict[str, pd.DataFrame], list[DataWarning]] | None:
+    """Loads the groups, the database and the warnings of the same data.
+
+    Returns:
+        tuple[dict[str, pd.DataFrame], dict[str, pd.DataFrame],
+            list[DataWarning]] | None: the cached groups, database and
+            warnings, or None if the cache is missing, unreadable or was
+            made from different data.
+    """
+    try:
+        with open(cache_dir, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+    if not isinstance(cache, dict) or cache.get("key") != key:
+        return None
+    if "warnings" not in cache:  # made before the warnings were cached
+        return None
+    return cache["groups"], cache["database"], cache["warnings"]
+
+
+def save_processed_data(
+    cache_dir: Path,
+    key: str,
+    groups: dict[str, pd.DataFrame],
+    database: dict[str, pd.DataFrame],
+    warnings: list[DataWarning],
+) -> None:
+    """Caches the processed groups, database and warnings under the key.
+
+    The warnings are cached so that a cache hit can show them again with
+    throw_warnings(), as they point at problems in the data file.
+    """
+    os.makedirs(cache_dir.parent, exist_ok=True)
+
+    tmp_dir = cache_dir.with_suffix(".tmp")
+    with open(tmp_dir, "wb") as f:
+        pickle.dump(
+            {"key": key, "groups": groups, "database": database, "warnings": warnings},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    os.replace(tmp_dir, cache_dir)
+
+
+def rank_rows(values: np.ndarray, sort_orders: Sequence[bool]) -> np.ndarray:
+    """Ranks the rows of a 2D array by comparing them column by column.
+
+    The first column decides the rank, the next columns break the ties.
+    Rows that are tied on every column share the lowest rank, like
+    pandas' rank(method="min").
+
+    Args:
+        values: the values of the sorting columns, one row per slide.
+        sort_orders: the sort order of every column. True means that a
+            greater value gets a higher rank.
+
+    Returns:
+        np.ndarray: the 1-based rank of every row.
+
+    Examples:
+        >>> rank_rows(np.array([[9, 1], [9, 2], [10, 5], [9, 1]]), [True, False])
+        array([2, 4, 1, 2])
+    """
+    # Map bool 0/1 to -1/1 and negate, so that ascending order is rank order
+    signed = values * -(np.asarray(sort_orders, dtype=int) * 2 - 1)
+
+    order = np.lexsort(signed.T[::-1])  # the last key is the primary key
+    signed = signed[order]
+
+    # Rows that differ from the previous row start a new group of ties
+    is_new = np.ones(len(signed), dtype=bool)
+    is_new[1:] = np.any(signed[1:] != signed[:-1], axis=1)
+    starts = np.flatnonzero(is_new)
+
+    ranks = np.empty(len(signed), dtype=int)
+    ranks[order] = starts[np.cumsum(is_new) - 1] + 1
+    return ranks
+
+
+def format_floats(values: np.ndarray) -> np.ndarray:
+    """Formats floats as strings, without the trailing .0 of whole numbers.
+
+    This is the vectorized equivalent of
+    str(int(x)) if x % 1 == 0 else str(x) for every value. Only the
+    distinct values are formatted, since scores repeat a lot, and the
+    strings are then gathered for the whole column at once.
+
+    Args:
+        values: the float array to format.
+
+    Returns:
+        np.ndarray: the formatted strings, as an object array.
+    """
+    codes, values = pd.factorize(values, use_na_sentinel=False)
+
+    with np.errstate(invalid="ignore"):  # nan and inf are not whole numbers
+        whole = values % 1 == 0
+    fits = whole & (np.abs(values) < 2**63)
+
+    # NumPy's own float to string cast is no faster than str()
+    to_str = np.frompyfunc(str, 1, 1)  # returns an object array of str
+    formatted = np.empty(len(values), dtype=object)
+    formatted[~whole] = to_str(values[~whole])
+    formatted[fits] = to_str(values[fits].astype(np.int64))
+    formatted[whole & ~fits] = [str(int(x)) for x in values[whole & ~fits]]
+    return formatted[codes]
+
+
+def rank_sheet(df: pd.DataFrame, sort_orders: Sequence[bool]) -> pd.DataFrame:
+    """Ranks the rows of a validated sheet and sorts them by rank.
+
+    The rank is stored in the "__r" column, and whole numbers lose their
+    trailing .0 for display.
+
+    Args:
+        df: the data of the sheet, starting with the sorting columns.
+        sort_orders: the sort order of every sorting column, see
+            rank_rows().
+
+    Returns:
+        pd.DataFrame: the ranked and sorted data.
+    """
+    scols = df.columns.tolist()[: len(sort_orders)]  # get sorting cols
+
+    # Rank the slides
+    df["__r"] = rank_rows(df.loc[:, scols].to_numpy(dtype=float), sort_orders)
+
+    # Sort the slides by rank
+    df = df.sort_values(by="__r", ascending=True)
+
+    # Remove .0 from whole nums
+    for col_ind in np.flatnonzero(df.dtypes == float):
+        df.isetitem(col_ind, format_floats(df.iloc[:, col_ind].to_numpy()))
+    return df
+
+
+def preview_df(
+    df: pd.DataFrame,
+    filter_series: pd.Series | None = None,
+    *,
+    n_cols: int,
+    n_cols_ext: int = 5,
+    highlight: bool = True,
+    words_to_highlight: list[str | None] | None = None,
+) -> str:
+    """Formats and returns a string preview of the dataframe.
+
+    Args:
+        df: the dataframe to format.
+        filter_series (optional): the boolean series used to select
+            rows. Pass None to include all rows in the preview. Defaults
+            to None.
+        n_cols: the number columns to format (starts at first column).
+            If n_cols is less than the number of columns in the dataframe,
+            the preview will be a snippet, which shows ellipses at the
+            end of every line).
+        n_cols_ext (optional): the number of extra columns to preview
+            alongside with the formatted columns. Defaults to 5.
+        highlight (optional): enable value highlighting. Defaults to
+            True.
+        words_to_highlight (optional): list of words
+            to highlight in red (only effective to values in the first
+            n_cols columns). List None if the value to highlight is
+            numpy.nan. Pass None to highlight nothing. Defaults to None.
+
+    Returns:
+        str: the formatted dataframe as a string.
+    """
+    if words_to_highlight is None:
+        words_to_highlight = []
+
+    df = df.copy(deep=True)
+    if filter_series is not None:
+        df = df[filter_series]
+    df.index += 2  # reflect row index as displayed in Excel
+
+    # Only show the first few columns for preview
+    df = df.iloc[:, : min(n_cols + n_cols_ext, len(df.columns))]
+
+    # Replace text_to_highlight with ⁅text_to_highlight⁆
+    prefix, suffix = "⁅", "⁆"  # arbitrary symbols, must be single length
+    highlight_str = lambda x: f"{prefix}{x}{suffix}"
+    for word in words_to_highlight:
+        if word is None:
+            df.iloc[:, :n_cols] = df.iloc[:, :n_cols].fillna(highlight_str("NaN"))
+        else:
+            df.iloc[:, :n_cols] = df.iloc[:, :n_cols].replace(word, highlight_str(word))
+
+    preview = repr(df.head(8)) if n_cols < len(df.columns) else repr(df)
+
+    # Highlight text_to_highlight
+    preview = preview.replace(prefix, "[red]  ").replace(suffix, "[/red]")
+
+    # Highlight column names
+    for n in range(n_cols):
+        col = df.columns.tolist()[n]
+        preview = preview.replace(" " + col, f" [red]{col}[/red]", 1)
+
+    # Add ... at the end of each line if preview is a snippet
+    if n_cols < len(df.columns):
+        preview = preview.replace("\n", "  ...\n") + "  ..."
+
+    # Bold first row
+    preview = "[b]" + preview.replace("\n", "[/b]\n", 1)
+
+    if not highlight:
+        preview = preview.replace("[red]", "")
+    return preview
+
+
+def check_template_ids(df: pd.DataFrame, *, slides_count: int) -> None:
+    """Throws an error if any template ID has no matching template slide."""
+    if unknown_templates := [
+        x for x in df["__template"] if as_type(int, x) not in range(1, slides_count + 1)
+    ]:
+        showcase_cols = ["__r", "__template"]
+        df_showcase = df[
+            showcase_cols + [col for col in df.columns if col not in showcase_cols]
+        ]
+        df_showcase = df_showcase.drop_duplicates("__template").reset_index(drop=True)
+        Error(71).throw(
+            preview_df(
+                df_showcase,
+                n_cols=2,
+                n_cols_ext=0,
+                words_to_highlight=unknown_templates,
+            )
+        )
+
+
+def throw_warnings(warnings: Sequence[DataWarning]) -> None:
+    """Shows the warnings of process_data() again, e.g. on a cache hit."""
+    for tb, details in warnings:
+        Error(tb).throw(*details, err_type=ErrorType.WARNING)
+
+
+def process_data(
+    data_dir: Path,
+    *,
+    sort_orders: Sequence[bool],
+    warnings: list[DataWarning] | None = None,
+) -> tuple[dict[str, pd.DataFrame], dict[str, pd.DataFrame]]:
+    """Reads, validates, ranks and merges the sheets of the data file.
+
+    Args:
+        data_dir: path to data.xlsm.
+        sort_orders: the sort order of every sorting column, see
+            rank_rows().
+        warnings (optional): the list to also record the warnings shown
+            about the data in, so they can be cached with the data.
+
+    Returns:
+        tuple[dict[str, pd.DataFrame], dict[str, pd.DataFrame]]: the
+            processed sheets and the database tables.
+    """
+    n_scols = len(sort_orders)  # number of sorting columns
+    with instrument.span("load workbook"):
+        sheets, tables = load_workbook(data_dir, n_scols=n_scols)
+
+    database: dict[str, pd.DataFrame] = {}
+    for sheet, table in tables.items():
+        if table.empty or table.shape < (1, 2):  # (1 row, 2 cols) min
+            continue
+        table = table.replace(np.nan, None)
+        database[sheet] = table
+
+    db_indexes = [build_database_index(table) for table in database.values()]
+
+    groups: dict[str, pd.DataFrame] = {}
+    for sheet, df in sheets.items():
+        if df.empty or df.shape < (1, n_scols):  # (1 row, n_scols cols) min
+            continue
+        df = df.replace(np.nan, None)
+
+        scols = df.columns.tolist()[:n_scols]  # get sorting cols
+        SHEET_INFO = (
+            f"[b]Sheet name:[/b]  {sheet}\n\n"
+            "See the following row(s) in data.xlsm to find out what caused the problem:"
+        )
+
+        # Exclude sheets with non-numeric sorting cols
+        if any(df.loc[:, scol].dtype.kind not in "biufc" for scol in scols):
+            # Get list of non-numeric vals
+            str_vals = (
+                df.loc[:, scols][~df.loc[:, scols].applymap(np.isreal)]
+                .melt(value_name="__value")
+                .dropna()["__value"]
+                .tolist()
+            )
+
+            Error(60).throw(
+                SHEET_INFO,
+                preview_df(
+                    df,
+                    ~df.loc[:, scols].applymap(np.isreal).all(1),
+                    n_cols=n_scols,
+                    words_to_highlight=str_vals,
+                ),
+                err_type=ErrorType.ERROR,
+            )
+
+        # Fill nan vals within the sorting cols
+        if df.loc[:, scols].isnull().values.any():
+            details = (
+                SHEET_INFO,
+                preview_df(
+                    df,
+                    df.loc[:, scols].isnull().any(axis=1),
+                    n_cols=n_scols,
+                    words_to_highlight=[None],
+                ),
+            )
+            Error(61).throw(*details, err_type=ErrorType.WARNING)
+            if warnings is not None:
+                warnings.append((61, details))
+
+            df.loc[:, scols] = df.loc[:, scols].fillna(0)
+
+        # Rank and sort the slides
+        with instrument.span("rank", sheet=sheet):
+            df = rank_sheet(df, sort_orders)
+
+        # Replace {__sheet} with sheet name
+        df["__sheet"] = sheet
+
+        # Merge contestant database
+        with instrument.span("merge", sheet=sheet):
+            df = join_database(df, db_indexes)
+
+        df["__template"] = df["__template"].fillna(1)
+        df["__uid"] = df["__uid"].str.replace("_", "").str.strip()
+        groups[sheet] = df
+
+    return groups, database
@@ -0,0 +1,466 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from collections.abc import Callable, Hashable, Iterable
+import contextlib
+import copy
+from io import BytesIO
+import os
+from pathlib import Path
+import zipfile
+
+from pptx import Presentation
+from pptx.opc.constants import (
+    CONTENT_TYPE as CT,
+    RELATIONSHIP_TARGET_MODE as RTM,
+    RELATIONSHIP_TYPE as RT,
+)
+from pptx.opc.oxml import CT_Relationships, parse_xml, serialize_part_xml
+from pptx.opc.package import Part
+from pptx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI, PackURI
+from pptx.opc.serialized import _ContentTypesItem
+from pptx.parts.image import Image, ImagePart
+from pptx.presentation import Presentation as PresentationType
+from pptx.shapes.picture import Picture
+from pptx.slide import Slide
+
+from exceptions import UnsupportedSlideError
+from utils import as_type
+
+
+R_NAMESPACE = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+# Relationships that can be shared between a template slide and its copies
+SHAREABLE_RELTYPES = (RT.IMAGE, RT.MEDIA, RT.VIDEO, RT.AUDIO)
+
+SLIDES_BASE_URI = "/ppt/slides"  # the folder of the slides of every package
+
+
+def open_template(template_dir: Path | BytesIO) -> PresentationType:
+    """Opens the template presentation (.pptm or .pptx) with python-pptx.
+
+    Args:
+        template_dir: the path to the template, or its bytes in memory.
+    """
+    if isinstance(template_dir, Path):
+        template_dir = str(template_dir)
+    return Presentation(template_dir)
+
+
+def _copy_slide_content(src: Slide, dst: Slide, rid_map: dict[str, str]) -> None:
+    """Replaces the content of dst with a copy of the content of src.
+
+    Args:
+        src: the slide to copy.
+        dst: the slide to overwrite.
+        rid_map: maps the relationship IDs of src to the matching
+            relationship IDs of dst.
+    """
+    dst_sld, src_sld = dst._element, src._element
+    sp_tree = dst.shapes._spTree  # keep the shape tree cached by python-pptx
+    for child in list(dst_sld):
+        dst_sld.remove(child)
+    for key, val in src_sld.attrib.items():
+        dst_sld.set(key, val)
+    for child in src_sld:
+        dst_sld.append(copy.deepcopy(child))
+
+    copied_tree = dst_sld.cSld.spTree
+    for child in list(sp_tree):
+        sp_tree.remove(child)
+    sp_tree.extend(list(copied_tree))
+    copied_tree.getparent().replace(copied_tree, sp_tree)
+
+    # Point the copied elements to the relationships of the new slide
+    for element in dst_sld.iter():
+        for key, val in element.attrib.items():
+            if key.startswith(R_NAMESPACE) and val in rid_map:
+                element.set(key, rid_map[val])
+
+    if src.has_notes_slide:
+        dst.notes_slide.notes_text_frame.text = src.notes_slide.notes_text_frame.text
+
+
+def duplicate_slide(prs: PresentationType, index: int) -> Slide:
+    """Appends a copy of the slide at index to the end of the presentation.
+
+    The slide XML is deep-copied and every relationship it references
+    (layout, images, media, hyperlinks) is re-created on the new slide
+    with the relationship IDs remapped accordingly.
+
+    Raises:
+        UnsupportedSlideError: the slide links to a part that cannot be
+            shared between slides (charts, diagrams, embedded objects,
+            links to other slides, etc.).
+    """
+    src = prs.slides[index]
+    dst = prs.slides.add_slide(src.slide_layout)
+
+    rid_map: dict[str, str] = {}
+    for rel in src.part.rels:
+        if rel.reltype == RT.NOTES_SLIDE:
+            continue
+        elif rel.is_external:
+            rid_map[rel.rId] = dst.part.relate_to(
+                rel.target_ref, rel.reltype, is_external=True
+            )
+        elif rel.reltype == RT.SLIDE_LAYOUT or rel.reltype in SHAREABLE_RELTYPES:
+            rid_map[rel.rId] = dst.part.relate_to(rel.target_part, rel.reltype)
+        else:
+            raise UnsupportedSlideError(f"Cannot duplicate relationship: {rel.reltype}")
+
+    _copy_slide_content(src, dst, rid_map)
+    return dst
+
+
+def delete_slides(prs: PresentationType, indices: Iterable[int]) -> None:
+    """Deletes the slides at the given indices from the presentation."""
+    sld_id_lst = prs.slides._sldIdLst  # type: ignore
+    sld_ids = list(sld_id_lst)
+
+    for index in sorted(set(indices), reverse=True):
+        sld_id = sld_ids[index]
+        prs.part.drop_rel(sld_id.rId)
+        sld_id_lst.remove(sld_id)
+
+
+def duplicate_slides(prs: PresentationType, template_ids: Iterable) -> None:
+    """Replaces the template slides with one copy per template ID.
+
+    This is the in-process equivalent of running the Duplicate macro
+    for every template ID followed by the DelSlide macro.
+
+    Args:
+        prs: the opened template presentation.
+        template_ids: the 1-based indices of the template slides to
+            duplicate, in the order the new slides should appear.
+    """
+    slides_count = len(prs.slides)
+
+    for template in template_ids:
+        duplicate_slide(prs, int(as_type(int, template)) - 1)
+    delete_slides(prs, range(slides_count))  # delete initial template slides
+
+
+def _read_rels(package: zipfile.ZipFile, partname: PackURI) -> list:
+    """Returns the <Relationship> elements of a part of a .pptx file."""
+    try:
+        rels_xml = package.read(partname.rels_uri.membername)
+    except KeyError:  # the part has no relationships
+        return []
+    return parse_xml(rels_xml).relationship_lst
+
+
+def read_slide_partnames(package: zipfile.ZipFile) -> list[PackURI]:
+    """Returns the part names of the slides of a .pptx file, in order.
+
+    Only the package and presentation relationships and the slide list
+    are parsed, the slides themselves are not.
+    """
+    prs_partname = next(
+        PackURI.from_rel_ref(PACKAGE_URI.baseURI, rel.target_ref)
+        for rel in _read_rels(package, PACKAGE_URI)
+        if rel.reltype == RT.OFFICE_DOCUMENT
+    )
+    targets = {
+        rel.rId: PackURI.from_rel_ref(prs_partname.baseURI, rel.target_ref)
+        for rel in _read_rels(package, prs_partname)
+    }
+
+    sld_id_lst = parse_xml(package.read(prs_partname.membername)).sldIdLst
+    if sld_id_lst is None:
+        return []
+    return [targets[sld_id.rId] for sld_id in sld_id_lst.sldId_lst]
+
+
+def _strip_macros(prs: PresentationType) -> None:
+    """Turns the presentation into a macro-free one before saving."""
+    for rel in list(prs.part.rels):
+        if rel.reltype.endswith("/vbaProject"):
+            prs.part.drop_rel(rel.rId)
+    prs.part._content_type = CT.PML_PRESENTATION_MAIN
+
+
+def save_presentation(prs: PresentationType, output_dir: Path) -> None:
+    """Saves the presentation as a macro-free .pptx file."""
+    _strip_macros(prs)
+
+    # Keep slide part names continuous after duplicating and deleting
+    prs.part.rename_slide_parts([s.rId for s in prs.slides._sldIdLst])  # type: ignore
+    prs.save(str(output_dir))
+
+
+class SlideStream:
+    """Writes a macro-free .pptx file one slide at a time.
+
+    python-pptx keeps every slide in memory until the presentation is
+    saved. A stream appends a copy of a template slide, lets the caller
+    fill it, then writes the slide and its images to the zip and drops
+    it, so only one slide is held in memory at a time. The rest of the
+    package is written when the stream is closed.
+
+    Usage:
+        with SlideStream(prs, output_dir, template_ids) as stream:
+            for template in template_ids:
+                slide = stream.add_slide(int(template) - 1)
+                ...  # fill the slide
+    """
+
+    def __init__(
+        self, prs: PresentationType, output_dir: Path, template_ids: Iterable
+    ) -> None:
+        """Opens the output file for writing.
+
+        Args:
+            prs: the opened template presentation.
+            output_dir: the path to the .pptx file to write.
+            template_ids: the 1-based indices of the template slides
+                that will be added.
+
+        Raises:
+            UnsupportedSlideError: one of the template slides links to a
+                part that cannot be streamed, see duplicate_slide(), or
+                has notes. Nothing has been written at this point.
+        """
+        templates = list(prs.slides)
+        for index in {int(as_type(int, x)) - 1 for x in template_ids}:
+            for rel in templates[index].part.rels:
+                if rel.is_external or rel.reltype == RT.SLIDE_LAYOUT:
+                    continue
+                if rel.reltype not in SHAREABLE_RELTYPES:
+                    raise UnsupportedSlideError(
+                        f"Cannot stream relationship: {rel.reltype}"
+                    )
+
+        self._prs = prs
+        self._output_dir = output_dir
+        self._templates_count = len(templates)
+        self._layout_partnames = {
+            layout.part.partname
+            for master in prs.slide_masters
+            for layout in master.slide_layouts
+        }
+        self._slide: Slide | None = None  # the slide added last, not written yet
+        self._slide_parts: list[Part] = []  # stand-ins for the written slides
+        self._written: dict[str, Part] = {}  # stand-ins of the parts written so far
+        self._zip = zipfile.ZipFile(output_dir, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def __enter__(self) -> "SlideStream":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:  # do not leave a broken presentation behind
+            self._zip.close()
+            with contextlib.suppress(OSError):
+                os.remove(self._output_dir)
+
+    def _write_part(self, part: Part, partname: PackURI | None = None) -> Part:
+        """Writes the part and returns a stand-in for it without content."""
+        partname = partname or part.partname
+        self._zip.writestr(partname.membername, part.blob)
+        if part._rels:
+            self._zip.writestr(partname.rels_uri.membername, part.rels.xml)
+
+        written = self._written[partname] = Part(
+            partname, part.content_type, part.package
+        )
+        return written
+
+    def _flush(self) -> None:
+        """Writes the slide added last and removes it from the presentation."""
+        if (slide := self._slide) is None:
+            return
+        self._slide = None
+
+        # Images and media used by the slide, layouts are written on close
+        for rel in slide.part.rels:
+            if rel.is_external or rel.reltype == RT.SLIDE_LAYOUT:
+                continue
+            if rel.target_partname not in self._written:
+                self._write_part(rel.target_part)
+
+        # All slides are in the same folder, so the relative targets still hold
+        partname = PackURI(f"/ppt/slides/slide{len(self._slide_parts) + 1}.xml")
+        self._slide_parts.append(self._write_part(slide.part, partname))
+        delete_slides(self._prs, [self._templates_count])
+
+    def add_slide(self, index: int) -> Slide:
+        """Writes the previous slide and appends a copy of a template slide.
+
+        Args:
+            index: the 0-based index of the template slide to copy.
+        """
+        self._flush()
+        self._slide = duplicate_slide(self._prs, index)
+        return self._slide
+
+    def copy_slide(
+        self, package: zipfile.ZipFile, partname: PackURI, images: "ImageRegistry"
+    ) -> None:
+        """Writes the previous slide and a slide of another .pptx file as is.
+
+        The slide is copied without being parsed, so it must come from a
+        presentation of the same template, where the slide layouts have
+        the same part names. Its images are embedded through the image
+        registry, so every distinct image is still written only once.
+
+        Args:
+            package: the other .pptx file.
+            partname: the part name of the slide in package.
+            images: the image registry of the presentation of the stream.
+
+        Raises:
+            UnsupportedSlideError: the slide links to a part other than its
+                slide layout and images, or its slide layout is missing.
+                Nothing has been written for the slide.
+        """
+        self._flush()
+
+        rels = CT_Relationships.new()
+        image_parts = []
+        for rel in _read_rels(package, partname):
+            if rel.targetMode == RTM.EXTERNAL:
+                rels.add_rel(rel.rId, rel.reltype, rel.target_ref, is_external=True)
+                continue
+
+            target = PackURI.from_rel_ref(partname.baseURI, rel.target_ref)
+            if rel.reltype == RT.SLIDE_LAYOUT and target in self._layout_partnames:
+                rels.add_rel(rel.rId, rel.reltype, target.relative_ref(SLIDES_BASE_URI))
+            elif rel.reltype == RT.IMAGE:
+                try:
+                    image_part = images.get_or_add(
+                        (package, target), lambda: package.read(target.membername)
+                    )
+                except (KeyError, OSError) as e:  # missing or unreadable image
+                    raise UnsupportedSlideError(f"Cannot copy image: {target}") from e
+                image_parts.append(image_part)
+                rels.add_rel(
+                    rel.rId,
+                    rel.reltype,
+                    image_part.partname.relative_ref(SLIDES_BASE_URI),
+                )
+            else:
+                raise UnsupportedSlideError(f"Cannot copy relationship: {rel.reltype}")
+
+        for image_part in image_parts:
+            if image_part.partname not in self._written:
+                self._write_part(image_part)
+
+        new_partname = PackURI(
+            f"{SLIDES_BASE_URI}/slide{len(self._slide_parts) + 1}.xml"
+        )
+        self._zip.writestr(new_partname.membername, package.read(partname.membername))
+        self._zip.writestr(new_partname.rels_uri.membername, rels.xml)
+
+        written = self._written[new_partname] = Part(
+            new_partname, CT.PML_SLIDE, self._prs.part.package
+        )
+        self._slide_parts.append(written)
+
+    def close(self) -> None:
+        """Writes the last slide and the rest of the package."""
+        self._flush()
+
+        prs = self._prs
+        delete_slides(prs, range(self._templates_count))
+        _strip_macros(prs)
+
+        package = prs.part.package
+        parts = [p for p in package.iter_parts() if p.partname not in self._written]
+
+        # The written slides are all new, so skip the lookups of relate_to()
+        # and add_sldId(), which scan every slide added before
+        sld_id_lst = prs.slides._sldIdLst  # type: ignore
+        first_id = sld_id_lst._next_id
+        for i, slide_part in enumerate(self._slide_parts):
+            rId = prs.part.rels._add_relationship(RT.SLIDE, slide_part)
+            sld_id_lst._add_sldId(id=first_id + i, rId=rId)
+        self._zip.writestr(
+            CONTENT_TYPES_URI.membername,
+            serialize_part_xml(
+                _ContentTypesItem.xml_for([*self._written.values(), *parts])
+            ),
+        )
+        self._zip.writestr(PACKAGE_URI.rels_uri.membername, package._rels.xml)
+        for part in parts:
+            self._write_part(part)
+        self._zip.close()
+
+
+class ImageRegistry:
+    """Embeds every distinct image only once in a presentation.
+
+    python-pptx looks for an identical image by walking and hashing
+    every image of the package on each insertion. The registry instead
+    scans the package once, and remembers the image part of every key,
+    e.g. an avatar or a URL, so that repeated images are only related
+    to the next slide.
+    """
+
+    def __init__(self, prs: PresentationType) -> None:
+        self._package = prs.part.package
+        self._parts: dict[Hashable, ImagePart | None] = {}
+        self._parts_by_sha1: dict[str, ImagePart] | None = None
+        self._next_idx = 1
+
+    def _scan(self) -> dict[str, ImagePart]:
+        """Indexes the images already in the package, e.g. of the template."""
+        if self._parts_by_sha1 is None:
+            self._parts_by_sha1 = {}
+            for part in self._package.iter_parts():
+                if isinstance(part, ImagePart):
+                    self._parts_by_sha1.setdefault(part.sha1, part)
+                if part.partname.startswith("/ppt/media/image"):
+                    self._next_idx = max(self._next_idx, (part.partname.idx or 0) + 1)
+        return self._parts_by_sha1
+
+    def _next_partname(self, ext: str) -> PackURI:
+        partname = PackURI(f"/ppt/media/image{self._next_idx}.{ext}")
+        self._next_idx += 1
+        return partname
+
+    def get_or_add(
+        self, key: Hashable, load: Callable[[], bytes | None]
+    ) -> ImagePart | None:
+        """Returns the image part of the key, loading the image if new.
+
+        Args:
+            key: identifies the image, e.g. ("url", img_url).
+            load: returns the image bytes, or None if there is no image.
+                Only called the first time the key is seen.
+
+        Returns:
+            ImagePart | None: the image part, or None if load() returned
+                None.
+        """
+        if key in self._parts:
+            return self._parts[key]
+
+        image_part = None
+        if (blob := load()) is not None:
+            image = Image.from_blob(blob)
+            parts_by_sha1 = self._scan()
+            if (image_part := parts_by_sha1.get(image.sha1)) is None:
+                image_part = ImagePart(
+                    self._next_partname(image.ext),
+                    image.content_type,
+                    self._package,
+                    image.blob,
+                )
+                parts_by_sha1[image.sha1] = image_part
+
+        self._parts[key] = image_part
+        return image_part
+
+    def add_picture(
+        self, slide: Slide, image_part: ImagePart, left, top, width, height
+    ) -> Picture:
+        """Adds a picture of a registered image on top of the slide."""
+        rId = slide.part.relate_to(image_part, RT.IMAGE)
+        shapes = slide.shapes  # type: ignore
+        pic = shapes._add_pic_from_image_part(image_part, rId, left, top, width, height)
+        return shapes._shape_factory(pic)
@@ -0,0 +1,159 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from pathlib import Path
+
+import pandas as pd
+import xlsxwriter
+from xlsxwriter.exceptions import FileCreateError
+from xlsxwriter.workbook import Workbook
+from xlsxwriter.worksheet import Worksheet
+
+from exceptions import StatisticsLockedError
+
+
+# Filters a column of the data sheet by the contestant name in column A
+LOOKUP_FORMULA = (
+    "=IF(ISBLANK($A2), 0, "
+    "FILTER(CHOOSECOLS(data!$A:$Z, MATCH(B$1, data!$1:$1, 0)), "
+    "CHOOSECOLS(data!$A:$Z, MATCH($A$1, data!$1:$1, 0))=$A2))"
+)
+
+# Same as above, with the data sheet chosen by its name in column B
+COMBINED_LOOKUP_FORMULA = (
+    "=IF(OR(ISBLANK($A2), ISBLANK($B2)), 0, "
+    'FILTER(CHOOSECOLS(INDIRECT("\'"&$B2&"\'!$A:$Z"), '
+    'MATCH(C$1, INDIRECT("\'"&$B2&"\'!$1:$1"), 0)), '
+    'CHOOSECOLS(INDIRECT("\'"&$B2&"\'!$A:$Z"), '
+    'MATCH($A$1, INDIRECT("\'"&$B2&"\'!$1:$1"), 0))=$A2))'
+)
+
+
+def _open_workbook(output_stats_dir: Path) -> Workbook:
+    return xlsxwriter.Workbook(
+        str(output_stats_dir),
+        {
+            "constant_memory": True,  # stream rows to disk
+            "use_future_functions": True,  # FILTER and CHOOSECOLS
+            "default_format_properties": {
+                "font_name": "Arial Nova",
+                "font_size": 10,
+                "valign": "vcenter",
+            },
+        },
+    )
+
+
+def _close_workbook(workbook: Workbook) -> None:
+    try:
+        workbook.close()
+    except FileCreateError as e:
+        raise StatisticsLockedError(*e.args) from e
+
+
+def _write_lookup_sheet(
+    workbook: Workbook, titles: list[str], formula: str
+) -> Worksheet:
+    """Writes the lookup sheet, with the formula right below the last title."""
+    sheet_lookup = workbook.add_worksheet("lookup")
+    sheet_lookup.set_default_row(15)
+
+    title_format = {"bold": True, "align": "center", "bottom": 1}
+    sheet_lookup.set_column(0, 0, None, workbook.add_format({"right": 1}))
+    sheet_lookup.set_row(0, None, workbook.add_format(title_format))
+    sheet_lookup.write(
+        0, 0, titles[0], workbook.add_format(title_format | {"right": 1})
+    )
+    for col, title in enumerate(titles[1:], 1):
+        sheet_lookup.write(0, col, title, workbook.add_format(title_format))
+
+    last_col = len(titles) - 1
+    sheet_lookup.write_dynamic_array_formula(1, last_col, 1, last_col, formula)
+    return sheet_lookup
+
+
+def _write_data_sheet(workbook: Workbook, name: str, df: pd.DataFrame) -> None:
+    sheet_data = workbook.add_worksheet(name)
+    sheet_data.set_default_row(15)
+
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center"})
+    sheet_data.write_row(0, 0, df.columns.astype(str).tolist(), header_format)
+    for row, values in enumerate(df.fillna("").itertuples(index=False), 1):
+        sheet_data.write_row(row, 0, values)
+
+
+def _get_worksheet_names(sheets: list[str]) -> list[str]:
+    """Makes the sheet names valid and unique as Excel worksheet names."""
+    names: list[str] = []
+    for sheet in sheets:
+        base = sheet.translate(str.maketrans("", "", "[]:*?/\\'"))[:31] or "sheet"
+        name, n = base, 1
+        while name.lower() in ("lookup", *map(str.lower, names)):
+            n += 1
+            name = f"{base[:31 - len(str(n)) - 1]}_{n}"
+        names.append(name)
+    return names
+
+
+def export_statistics(df: pd.DataFrame, output_stats_dir: Path) -> None:
+    """Exports the data of a sheet to a statistics workbook.
+
+    The workbook contains the data sheet and a lookup sheet that
+    filters the data by contestant name. It is written in a single
+    streaming pass and does not need Excel.
+
+    Raises:
+        StatisticsLockedError: the workbook is opened in Excel.
+    """
+    workbook = _open_workbook(output_stats_dir)
+    _write_lookup_sheet(workbook, ["name", "avg"], LOOKUP_FORMULA)
+    _write_data_sheet(workbook, "data", df)
+    _close_workbook(workbook)
+
+
+def export_combined_statistics(
+    groups: dict[str, pd.DataFrame], output_stats_dir: Path
+) -> None:
+    """Exports the data of every sheet to a single statistics workbook.
+
+    Every sheet gets its own data sheet, and the shared lookup sheet
+    filters the data sheet named in column B by the contestant name in
+    column A.
+
+    Raises:
+        StatisticsLockedError: the workbook is opened in Excel.
+    """
+    names = _get_worksheet_names(list(groups))
+
+    workbook = _open_workbook(output_stats_dir)
+    sheet_lookup = _write_lookup_sheet(
+        workbook, ["name", "sheet", "avg"], COMBINED_LOOKUP_FORMULA
+    )
+    sheet_lookup.write(1, 1, names[0])
+    for name, df in zip(names, groups.values()):
+        _write_data_sheet(workbook, name, df)
+    _close_workbook(workbook)
+
+
+def export_data(
+    groups: dict[str, pd.DataFrame], output_data_dir: Path, *, fmt: str
+) -> None:
+    """Exports the processed data of every sheet for other programs.
+
+    Args:
+        groups: the processed data of every sheet.
+        output_data_dir: the folder to save the files to, one per sheet.
+        fmt: "csv" or "parquet".
+    """
+    for sheet, df in groups.items():
+        match fmt:
+            case "csv":
+                df.to_csv(output_data_dir / f"{sheet}.csv", index=False)
+            case "parquet":
+                # Mixed object columns are stored as text
+                text_cols = df.columns[df.dtypes == object]
+                df.astype({col: "string" for col in text_cols}).rename(
+                    columns=str
+                ).to_parquet(output_data_dir / f"{sheet}.parquet", index=False)
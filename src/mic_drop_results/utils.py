@@ -5,16 +5,19 @@
 
 from collections.abc import Callable, Generator
 import ctypes
+import functools
 import re
 import sys
-from typing import Any, TypeVar
+from typing import TYPE_CHECKING, Any, TypeVar
 
-import cv2
 from unidecode import unidecode
 
 from compiled_regex import match_non_username_char, match_space
 from constants import *
 
+if TYPE_CHECKING:  # pandas is only loaded once the data file is read
+    import pandas as pd
+
 
 def is_number(val: Any) -> bool:
     """Checks if value can be converted to type float."""
@@ -220,43 +223,58 @@ def get_avatar_dir(
     *,
     og_dir: Path | None = None,
     effect: int = 0,
+    avatar_dir: Path = AVATAR_DIR,
 ) -> Path:  # TODO: docstring
     """Returns the local path to the avatar file from user ID."""
     if uid is not None:
-        return abs_dir(AVATAR_DIR, f"{effect}_{uid}.png")
+        return abs_dir(avatar_dir, f"{effect}_{uid}.png")
 
     # uid is None:
     if og_dir is None or og_dir.stem == og_dir.name:
         raise ValueError("When uid is None, og_dir must lead to a file.")
 
-    return abs_dir(AVATAR_DIR, f"{effect}_{og_dir.name[2:]}")
-
-
-def artistic_effect(og_dir: Path, *, effect: int) -> Path:
-    """Creates an image with applied artistic effect and returns the path."""
-    if effect != 0:
-        img = cv2.imread(str(og_dir))
-        match effect:  # TODO: add more effects
-            case 1:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return abs_dir(avatar_dir, f"{effect}_{og_dir.name[2:]}")
 
-        fx_dir = get_avatar_dir(og_dir=og_dir, effect=effect)
-        cv2.imwrite(str(fx_dir), img)
-        return fx_dir
 
-    return og_dir
+@functools.lru_cache(maxsize=None)
+def _compile_coef_pattern(field_name: str) -> re.Pattern:
+    return re.compile(r"(?<={" + field_name + r"})[0-9]")
 
 
 def parse_coef(run_text: str, *, field_name: str) -> int:
     """Parses the coefficient of a field from the run text."""
-    pattern = re.compile(r"(?<={" + field_name + r"})[0-9]")
-    coef = pattern.findall(run_text)
+    coef = _compile_coef_pattern(field_name).findall(run_text)
     return int(*coef) if coef is not None else 0
 
 
 def clean_name(text) -> str:
-    text = unidecode(str(text))  # simplify special unicode characters
+    # Memoize by the string, as e.g. 1 and 1.0 are equal keys but differ in text
+    return _clean_name(str(text))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _clean_name(text: str) -> str:
+    text = unidecode(text)  # simplify special unicode characters
     if t := match_non_username_char.sub("", text):  # remove special characters
         text = t
     text = match_space.sub("", text).lower()  # remove space
     return text
+
+
+def clean_names(values: "pd.Series") -> "pd.Series":
+    """Applies clean_name() to a whole column.
+
+    Every distinct value is normalized only once, which is much faster
+    than Series.apply() on columns with many repeated names.
+
+    Examples:
+        >>> clean_names(pd.Series(["Ann B", "ann b", None])).tolist()
+        ['annb', 'annb', 'none']
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Factorize the text, as e.g. 1 and 1.0 are equal values but differ in text
+    codes, uniques = pd.factorize(values.astype(str))
+    cleaned = np.array([_clean_name(u) for u in uniques], dtype=object)
+    return pd.Series(cleaned[codes], index=values.index, name=values.name)
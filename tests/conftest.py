@@ -0,0 +1,25 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from pathlib import Path
+import sys
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+# The modules of the program import each other by their bare names
+sys.path[:0] = [
+    str(ROOT_DIR / "src" / "mic_drop_results"),
+    str(ROOT_DIR / "benchmarks"),
+]
+
+
+@pytest.fixture(autouse=True)
+def batch_mode(monkeypatch):
+    """Runs the program in batch mode, so errors never wait for input."""
+    import constants
+
+    monkeypatch.setattr(constants, "interactive", False)
@@ -0,0 +1,48 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import cv2
+import numpy as np
+import pytest
+
+from avatars import AvatarRenderer, render_avatar
+from utils import get_avatar_dir
+
+SIZE = (10**7, 10**7)  # larger than the avatars, so they are not resized
+
+
+def decode(png: bytes) -> np.ndarray:
+    return cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+@pytest.mark.parametrize("effect", [0, 1])
+def test_transparent_pixels_stay_transparent(effect):
+    img = np.zeros((128, 128, 4), dtype=np.uint8)
+    img[:, :, 2] = 255  # red, fully transparent
+
+    out = decode(render_avatar(img, effect=effect, size=SIZE))
+    assert out.shape == (128, 128, 4)
+    assert out[64, 64, 3] == 0
+    assert not img[:, :, 3].any()  # the decoded avatar is left untouched
+
+
+@pytest.mark.parametrize("shape", [(128, 128), (128, 128, 3)])
+def test_opaque_avatar_is_cropped_to_a_circle(shape):
+    img = np.full(shape, 200, dtype=np.uint8)
+
+    out = decode(render_avatar(img, effect=0, size=SIZE))
+    assert out.shape == (128, 128, 4)
+    assert out[64, 64].tolist() == [200, 200, 200, 255]
+    assert out[0, 0, 3] == 0
+
+
+def test_renderer_keeps_alpha_of_downloaded_png(tmp_path):
+    img = np.zeros((128, 128, 4), dtype=np.uint8)
+    img[32:96, 32:96] = (0, 255, 0, 255)  # opaque square on a transparent background
+    cv2.imwrite(str(get_avatar_dir("1", avatar_dir=tmp_path)), img)
+
+    out = decode(AvatarRenderer(avatar_dir=tmp_path).get("1", effect=0, size=SIZE))
+    assert out[64, 64].tolist() == [0, 255, 0, 255]
+    assert out[20, 64, 3] == 0
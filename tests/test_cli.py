@@ -0,0 +1,84 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import re
+
+import pytest
+
+import cli
+import client
+from stub_discord import StubDiscordServer
+from synthetic import make_season, make_template
+
+
+@pytest.fixture
+def season(tmp_path):
+    """Writes a data file, template, settings and token file to tmp_path."""
+    make_season(
+        tmp_path / "data.xlsx",
+        n_sheets=2,
+        n_rows=6,
+        n_scols=1,
+        n_scores=2,
+        n_tables=1,
+        n_db_rows=10,
+        n_templates=2,
+    )
+    make_template(tmp_path / "template.pptx", n_templates=2, n_fields=2, n_scores=2)
+    (tmp_path / "token.txt").write_text("x" * 72 + "\n")
+
+    settings = (cli.MAIN_DIR / "settings.ini").read_text()
+    settings = re.sub(r"(?m)^    avatar_mode = .*$", "    avatar_mode = 1", settings)
+    settings = re.sub(r"(?m)^    sort_orders = .*$", "    sort_orders = [0]", settings)
+    (tmp_path / "settings.ini").write_text(settings)
+    return tmp_path
+
+
+def test_generate_with_relative_paths(season, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    with StubDiscordServer() as server:
+        monkeypatch.setattr(client, "DISCORD_API_URL", server.api_url)
+        monkeypatch.setattr(client, "DISCORD_CDN_URL", server.cdn_url)
+        # fmt: off
+        code = cli.main([
+            "generate",
+            "--data", "data.xlsx",
+            "--template", "template.pptx",
+            "--out", "out",
+            "--settings", "settings.ini",
+            "--tokens", "token.txt",
+        ])
+        # fmt: on
+
+    assert code == 0
+    avatars = list((tmp_path / "out" / ".temp" / "avatars").iterdir())
+    assert server.hits["cdn"] > 0 and len(avatars) == server.hits["cdn"]
+    assert (tmp_path / "out" / "Group 1.pptx").is_file()
+    assert (tmp_path / "out" / "Group 2.pptx").is_file()
+    assert (tmp_path / "out" / ".temp" / "trace.json").is_file()
+
+
+def test_locked_presentation_is_not_reported_as_statistics(season, capsys, monkeypatch):
+    def generate_sheet(sheet, df, **options):
+        raise PermissionError(13, "Permission denied", str(options["output_prs_dir"]))
+
+    monkeypatch.setattr(cli, "generate_sheet", generate_sheet)
+    # fmt: off
+    with pytest.raises(SystemExit) as exc_info:
+        cli.main([
+            "generate",
+            "--data", str(season / "data.xlsx"),
+            "--template", str(season / "template.pptx"),
+            "--out", str(season / "out"),
+            "--settings", str(season / "settings.ini"),
+            "--no-avatars",
+        ])
+    # fmt: on
+
+    assert exc_info.value.code == 73
+    output = capsys.readouterr().out
+    assert "Failed to save PowerPoint file" in output and "Group 1.pptx" in output
+    assert "Statistics.xlsx" not in output
@@ -0,0 +1,66 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import asyncio
+
+import cv2
+import numpy as np
+import pytest
+
+import client
+from client import AvatarStatus, DownloadStage
+
+
+def run_stage(uids: list[str], on_done, *, workers: int = 2) -> None:
+    async def main() -> None:
+        downloads = DownloadStage(
+            None, None, workers=workers, maxsize=2, on_done=on_done  # type: ignore
+        )
+
+        async def produce() -> None:
+            for uid in uids:
+                await downloads.put(uid, f"https://cdn.test/{uid}.png")
+
+        await asyncio.wait_for(downloads.run(produce()), timeout=5)
+
+    asyncio.run(main())
+
+
+async def fake_download(session, uid, avatar_url, cache) -> None:
+    await asyncio.sleep(0)
+    if int(uid) % 3 == 0:
+        raise RuntimeError("unexpected error")
+
+
+def test_download_errors_are_reported_as_failed(monkeypatch):
+    monkeypatch.setattr(client, "_download", fake_download)
+    results = {}
+    run_stage([str(i) for i in range(20)], results.__setitem__)
+
+    assert results == {
+        str(i): AvatarStatus.FAILED if i % 3 == 0 else AvatarStatus.DOWNLOADED
+        for i in range(20)
+    }
+
+
+def test_dead_workers_do_not_block_the_producers(monkeypatch):
+    monkeypatch.setattr(client, "_download", fake_download)
+
+    def on_done(uid: str, status: AvatarStatus) -> None:
+        raise ValueError(uid)  # stops the worker that reports it
+
+    # Far more items than the queue and the workers can hold
+    with pytest.raises(ValueError):
+        run_stage([str(i) for i in range(100)], on_done)
+
+
+def test_save_avatar_raises_if_not_written(tmp_path):
+    _, png = cv2.imencode(".png", np.zeros((4, 4, 3), dtype=np.uint8))
+
+    client._save_avatar(png.tobytes(), tmp_path / "avatar.png")
+    assert (tmp_path / "avatar.png").is_file()
+
+    with pytest.raises(OSError):
+        client._save_avatar(png.tobytes(), tmp_path / "missing" / "avatar.png")
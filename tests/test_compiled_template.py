@@ -0,0 +1,45 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import compiled_template
+from compiled_template import compile_template, open_compiled_template
+import instrument
+from slides import duplicate_slides
+from synthetic import make_template
+
+
+def test_compiled_template_copies_are_independent(tmp_path):
+    make_template(tmp_path / "template.pptx", n_templates=2, n_fields=2, n_scores=2)
+    template = compile_template(
+        tmp_path / "template.pptx",
+        trigger_word="#",
+        cache_dir=tmp_path / "template_cache.pkl",
+    )
+    assert template.slides_count == 2
+
+    prs = open_compiled_template(template)
+    duplicate_slides(prs, [1, 2, 2, 1])
+    prs.slides[0].shapes._spTree.clear()
+
+    other = open_compiled_template(template)
+    assert len(other.slides) == 2
+    assert len(other.slides[0].shapes) > 0
+    assert other is not prs
+
+
+def test_compiled_template_cache(tmp_path):
+    make_template(tmp_path / "template.pptx", n_templates=2, n_fields=2, n_scores=2)
+    options = dict(trigger_word="#", cache_dir=tmp_path / "template_cache.pkl")
+
+    instrument.collect()
+    template = compile_template(tmp_path / "template.pptx", **options)
+    compiled_template._blobs.clear()  # like a later run
+    cached = compile_template(tmp_path / "template.pptx", **options)
+
+    counters = instrument.collect()["counters"]
+    assert counters["template_cache.misses"] == 1
+    assert counters["template_cache.hits"] == 1
+    assert cached == template
+    assert len(open_compiled_template(cached).slides) == 2
@@ -0,0 +1,126 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import os
+import zipfile
+
+import cv2
+import numpy as np
+from pptx import Presentation
+import pytest
+
+from compiled_template import compile_template
+from config import Config
+from generate import generate_sheet
+from incremental import load_previous_output, slide_fingerprints
+from processing import process_data
+import utils
+from synthetic import make_season, make_template
+
+N_ROWS = 12
+
+
+@pytest.fixture
+def sheet(tmp_path):
+    """Returns a function generating a sheet with avatars in incremental mode."""
+    avatar_dir = tmp_path / "avatars"
+    os.makedirs(avatar_dir)
+
+    make_season(
+        tmp_path / "data.xlsx",
+        n_sheets=1,
+        n_rows=N_ROWS,
+        n_scols=1,
+        n_scores=4,
+        n_tables=1,
+        n_db_rows=N_ROWS,
+        n_templates=2,
+    )
+    make_template(tmp_path / "template.pptx", n_templates=2, n_fields=4, n_scores=4)
+
+    cfg = Config(str(utils.MAIN_DIR / "settings.ini"))
+    cfg.sort_orders = [True]
+    (name, df), *_ = process_data(tmp_path / "data.xlsx", sort_orders=[True])[0].items()
+
+    rng = np.random.default_rng(0)
+    for uid in df["__uid"].dropna():
+        img = rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+        cv2.imwrite(str(utils.get_avatar_dir(uid, avatar_dir=avatar_dir)), img)
+
+    template = compile_template(
+        tmp_path / "template.pptx",
+        trigger_word=cfg.trigger_word,
+        cache_dir=tmp_path / "template_cache.pkl",
+    )
+    output_prs_dir = tmp_path / f"{name}.pptx"
+    avatar_urls = {uid: f"https://cdn.test/{uid}.png" for uid in df["__uid"]}
+
+    def generate(df) -> dict:
+        fingerprints = slide_fingerprints(
+            df, template_key=template.key, avatar_urls=avatar_urls
+        )
+        result = generate_sheet(
+            name,
+            df,
+            cfg=cfg,
+            template=template,
+            output_prs_dir=output_prs_dir,
+            fingerprints=fingerprints,
+            avatar_dir=avatar_dir,
+        )
+        return result["counters"]
+
+    generate.df = df
+    generate.output_prs_dir = output_prs_dir
+    return generate
+
+
+def read_package(prs_dir) -> dict[str, bytes]:
+    with zipfile.ZipFile(prs_dir) as package:
+        return {name: package.read(name) for name in package.namelist()}
+
+
+def slide_names(package: dict[str, bytes]) -> list[str]:
+    return sorted(n for n in package if n.startswith("ppt/slides/slide"))
+
+
+def test_unchanged_rows_are_copied_byte_for_byte(sheet):
+    df = sheet.df
+    counters = sheet(df)
+    assert "slides.reused" not in counters
+    before = read_package(sheet.output_prs_dir)
+
+    score_col = next(col for col in df.columns if str(col).startswith("score"))
+    changed = df.copy()
+    changed.loc[changed.index[3], score_col] = "123.4"
+
+    counters = sheet(changed)
+    assert counters["slides.reused"] == N_ROWS - 1
+    assert counters["slides.filled"] == 1
+    after = read_package(sheet.output_prs_dir)
+
+    assert slide_names(after) == slide_names(before)
+    assert [n for n in slide_names(after) if after[n] != before[n]] == [
+        "ppt/slides/slide4.xml"
+    ]
+    assert b"123.4" in after["ppt/slides/slide4.xml"]
+    assert b"123.4" not in before["ppt/slides/slide4.xml"]
+
+    # Every avatar is still embedded once
+    media = lambda package: sorted(n for n in package if n.startswith("ppt/media/"))
+    assert len(media(after)) == len(media(before))
+
+    prs = Presentation(str(sheet.output_prs_dir))
+    assert len(prs.slides) == N_ROWS
+    assert sum(len(s.shapes) for s in prs.slides) > 0
+
+
+def test_modified_output_is_not_reused(sheet):
+    sheet(sheet.df)
+    assert load_previous_output(sheet.output_prs_dir) is not None
+
+    with open(sheet.output_prs_dir, "ab") as f:
+        f.write(b"\0")  # e.g. edited and saved in PowerPoint
+    assert load_previous_output(sheet.output_prs_dir) is None
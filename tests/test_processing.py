@@ -0,0 +1,261 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from processing import (
+    build_database_index,
+    format_floats,
+    join_database,
+    load_processed_data,
+    process_data,
+    rank_rows,
+    rank_sheet,
+    save_processed_data,
+    throw_warnings,
+)
+from synthetic import make_season
+from utils import clean_name
+
+
+def legacy_rank(values: np.ndarray, sort_orders: list[bool]) -> np.ndarray:
+    """The row-wise tuple ranking that rank_rows() replaced."""
+    return (
+        pd.DataFrame(values * (np.array(sort_orders) * 2 - 1))
+        .apply(tuple, axis=1)  # type: ignore
+        .rank(method="min", ascending=False)
+        .astype(int)
+        .to_numpy()
+    )
+
+
+def legacy_join(df: pd.DataFrame, database: list[pd.DataFrame]) -> pd.DataFrame:
+    """The merge of the contestant database that join_database() replaced."""
+    process_str = lambda series: (
+        series.apply(clean_name) if (series.dtype.kind == "O") else series
+    )
+
+    for table in database:
+        table = table.copy()
+        df_cols = df.columns.tolist()
+        db_cols = table.columns.tolist()
+
+        anchor_col = db_cols[0]
+        overlapped_cols = [
+            col for col in db_cols if (col in df_cols) and (col != anchor_col)
+        ]
+
+        if anchor_col not in df_cols:
+            continue
+
+        df["__merge_anchor"] = process_str(df[anchor_col])
+        table["__merge_anchor"] = process_str(table[anchor_col])
+        table = table.drop(columns=anchor_col)
+        table = table.drop_duplicates("__merge_anchor")
+
+        df = df.merge(table, on="__merge_anchor", how="left")
+
+        for col in overlapped_cols:
+            df[col] = df[f"{col}_x"].fillna(df[f"{col}_y"])
+            df = df.drop(columns=[f"{col}_x", f"{col}_y"])
+
+        df = df.drop(columns="__merge_anchor")
+    return df
+
+
+# rank_rows()
+@pytest.mark.parametrize(
+    "sort_orders",
+    [[True], [False], [True, False], [False, True, True], [True] * 5],
+)
+def test_rank_rows_matches_legacy(sort_orders):
+    rng = np.random.default_rng(len(sort_orders))
+
+    # Few distinct values to produce plenty of ties on every column
+    values = rng.integers(0, 5, size=(500, len(sort_orders))) / 2
+    values[::7, 0] = rng.normal(size=len(values[::7]))
+
+    ranks = rank_rows(values, sort_orders)
+    np.testing.assert_array_equal(ranks, legacy_rank(values, sort_orders))
+
+
+def test_rank_rows_ties_share_lowest_rank():
+    values = np.array([[9, 1], [9, 2], [10, 5], [9, 1]])
+    np.testing.assert_array_equal(rank_rows(values, [True, False]), [2, 4, 1, 2])
+
+
+def test_rank_rows_full_ties():
+    values = np.ones((4, 2))
+    np.testing.assert_array_equal(rank_rows(values, [True, True]), [1, 1, 1, 1])
+
+
+def test_rank_rows_nan_filled_column():
+    # process_data() fills the missing sorting values with 0 before ranking
+    values = np.array([[np.nan, 3], [np.nan, 1], [2, np.nan], [np.nan, 3]])
+    values = np.nan_to_num(values, nan=0)
+
+    ranks = rank_rows(values, [True, False])
+    np.testing.assert_array_equal(ranks, legacy_rank(values, [True, False]))
+    np.testing.assert_array_equal(ranks, [3, 2, 1, 3])
+
+
+def test_rank_rows_empty():
+    assert rank_rows(np.empty((0, 2)), [True, False]).tolist() == []
+
+
+# format_floats() and rank_sheet()
+def test_format_floats_matches_per_value_format():
+    values = np.array([1.0, -2.0, 2.5, 0.1, np.nan, np.inf, -np.inf, 1e20, -0.0])
+    with np.errstate(invalid="ignore"):
+        expected = [str(int(x)) if x % 1 == 0 else str(x) for x in values]
+    assert format_floats(values).tolist() == expected
+
+
+def test_format_floats_repeated_values():
+    # Equal values are formatted once, 0.0 and -0.0 included
+    values = np.tile([7.5, np.nan, 9.0, -0.0, 0.0, 7.25, 2.0**70], 50)
+    with np.errstate(invalid="ignore"):
+        expected = [str(int(x)) if x % 1 == 0 else str(x) for x in values]
+    assert format_floats(values).tolist() == expected
+
+
+def test_format_floats_keeps_object_dtype():
+    formatted = format_floats(np.array([1.0, 1.5]))
+    assert formatted.dtype == object
+    assert formatted.tolist() == ["1", "1.5"]
+
+
+def test_rank_sheet():
+    df = pd.DataFrame(
+        {
+            "score": [7.5, 9.0, 7.5, 10.0],
+            "time": [30.0, 20.0, 25.0, 40.0],
+            "name": ["a", "b", "c", "d"],
+            "count": [1, 2, 3, 4],
+        }
+    )
+    ranked = rank_sheet(df, [True, False])
+
+    assert ranked["name"].tolist() == ["d", "b", "c", "a"]
+    assert ranked["__r"].tolist() == [1, 2, 3, 4]
+    assert ranked["score"].tolist() == ["10", "9", "7.5", "7.5"]
+    assert ranked["time"].tolist() == ["40", "20", "25", "30"]
+    assert ranked["count"].tolist() == [4, 2, 3, 1]  # ints are left as they are
+
+
+def test_rank_sheet_ties():
+    df = pd.DataFrame({"score": [1.0, 2.0, 2.0, 1.0], "name": list("abcd")})
+    ranked = rank_sheet(df, [True])
+
+    assert ranked["__r"].tolist() == [1, 1, 3, 3]
+    assert ranked["name"].tolist() == ["b", "c", "a", "d"]  # stable within ties
+
+
+# join_database()
+def make_database() -> list[pd.DataFrame]:
+    return [
+        pd.DataFrame(
+            {
+                "name": ["Ann B", "Bob", "ann b", "Çelik", None],
+                "country": ["NO", "SE", "DK", "TR", "??"],
+                "team": ["red", "blue", "green", None, "none"],
+            }
+        ),
+        pd.DataFrame({"id": [1, 2, 3], "joined": [2019, 2020, 2021]}),
+        pd.DataFrame({"unused": ["x"], "other": ["y"]}),  # anchor not in the sheet
+    ]
+
+
+def make_sheet() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "score": [3, 2, 1, 0],
+            "name": ["ANN  B!", "celik", "Nobody", "bob"],
+            "team": [None, "yellow", None, None],
+            "id": [3, 1, 4, 2],
+        }
+    )
+
+
+def test_join_database_matches_legacy():
+    database = make_database()
+    expected = legacy_join(make_sheet(), database)
+    joined = join_database(make_sheet(), [build_database_index(t) for t in database])
+
+    pd.testing.assert_frame_equal(joined, expected, check_dtype=False)
+
+
+def test_join_database_column_order():
+    database = make_database()
+    joined = join_database(make_sheet(), [build_database_index(t) for t in database])
+
+    # The filled columns of the sheet move after the new columns of each table
+    assert joined.columns.tolist() == [
+        "score",
+        "name",
+        "id",
+        "country",
+        "team",
+        "joined",
+    ]
+
+
+def test_join_database_fills_only_empty_cells():
+    database = make_database()
+    joined = join_database(make_sheet(), [build_database_index(t) for t in database])
+
+    assert joined["country"].tolist() == ["NO", "TR", np.nan, "SE"]
+    assert joined["team"].tolist() == ["red", "yellow", np.nan, "blue"]
+    pd.testing.assert_series_equal(
+        joined["joined"], pd.Series([2021, 2019, np.nan, 2020], name="joined")
+    )
+
+
+def test_join_database_without_matching_anchor():
+    df = make_sheet()
+    joined = join_database(df, [build_database_index(make_database()[2])])
+    assert joined is df
+
+
+# The data cache
+def test_cached_data_keeps_the_warnings(tmp_path, capsys):
+    groups = {"Group 1": pd.DataFrame({"avg": [1.0, 0.0], "name": ["a", "b"]})}
+    database = {"(Contestants)": pd.DataFrame({"name": ["a"], "country": ["NO"]})}
+    warnings = [(61, ("[b]Sheet name:[/b]  Group 1", "a preview of the rows"))]
+
+    cache_dir = tmp_path / "data_cache.pkl"
+    save_processed_data(cache_dir, "key", groups, database, warnings)
+    assert load_processed_data(cache_dir, "other key") is None
+
+    cached_groups, _, cached_warnings = load_processed_data(cache_dir, "key")
+    pd.testing.assert_frame_equal(cached_groups["Group 1"], groups["Group 1"])
+    assert cached_warnings == warnings
+
+    throw_warnings(cached_warnings)
+    out = capsys.readouterr().out
+    assert "WARNING" in out and "E-061" in out and "Group 1" in out
+
+
+def test_process_data_without_warnings(tmp_path):
+    data_dir = tmp_path / "data.xlsx"
+    make_season(
+        data_dir,
+        n_sheets=2,
+        n_rows=5,
+        n_scols=2,
+        n_scores=2,
+        n_tables=1,
+        n_db_rows=10,
+        n_templates=1,
+    )
+
+    warnings = []
+    groups, database = process_data(
+        data_dir, sort_orders=[True, False], warnings=warnings
+    )
+    assert warnings == []
+    assert list(groups) == ["Group 1", "Group 2"] and len(database) == 1
@@ -0,0 +1,38 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+from pptx import Presentation
+from pptx.chart.data import CategoryChartData
+from pptx.enum.chart import XL_CHART_TYPE
+from pptx.util import Inches
+import pytest
+
+from exceptions import UnsupportedSlideError
+from slides import SlideStream, duplicate_slides
+
+
+def make_chart_template():
+    """Returns a presentation whose only slide has a chart, which needs
+    PowerPoint to be duplicated."""
+    prs = Presentation()
+    slide = prs.slides.add_slide(prs.slide_layouts[6])
+    chart_data = CategoryChartData()
+    chart_data.categories = ["a", "b"]
+    chart_data.add_series("score", (1, 2))
+    slide.shapes.add_chart(
+        XL_CHART_TYPE.COLUMN_CLUSTERED, 0, 0, Inches(4), Inches(3), chart_data
+    )
+    return prs
+
+
+def test_duplicate_slides_raises_unsupported_slide():
+    with pytest.raises(UnsupportedSlideError):
+        duplicate_slides(make_chart_template(), [1, 1])
+
+
+def test_slide_stream_raises_unsupported_slide(tmp_path):
+    with pytest.raises(UnsupportedSlideError):
+        SlideStream(make_chart_template(), tmp_path / "output.pptx", [1, 1])
+    assert not (tmp_path / "output.pptx").exists()
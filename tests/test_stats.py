@@ -0,0 +1,20 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import pandas as pd
+import pytest
+
+from exceptions import StatisticsLockedError
+from stats import export_combined_statistics, export_statistics
+
+
+def test_unwritable_workbook_raises_statistics_locked(tmp_path):
+    df = pd.DataFrame({"name": ["a", "b"], "avg": [1.0, 2.5]})
+    output_stats_dir = tmp_path / "missing" / "Statistics.xlsx"
+
+    with pytest.raises(StatisticsLockedError):
+        export_statistics(df, output_stats_dir)
+    with pytest.raises(StatisticsLockedError):
+        export_combined_statistics({"sheet": df}, output_stats_dir)
@@ -0,0 +1,33 @@
+# Copyright 2023 Phan Huy
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+
+import pandas as pd
+
+from utils import clean_name, clean_names
+
+
+def test_clean_names_matches_clean_name():
+    values = pd.Series(
+        ["Ann B", "ann b", "  ANN   B ", "Çelik", "José!", "!!!", "x_y", None, 1, 1.0],
+        index=range(10, 20),
+        name="name",
+    )
+    expected = values.apply(clean_name)
+
+    pd.testing.assert_series_equal(clean_names(values), expected, check_dtype=False)
+
+
+def test_clean_names_repeated_values():
+    values = pd.Series(["Bob", "BOB", "bob "] * 1000)
+    assert set(clean_names(values)) == {"bob"}
+
+
+def test_clean_names_keeps_text_of_numbers():
+    # 1 and 1.0 are equal but must not share the cleaned text
+    assert clean_names(pd.Series([1, 1.0], dtype=object)).tolist() == ["1", "1.0"]
+
+
+def test_clean_names_empty():
+    assert clean_names(pd.Series([], dtype=object)).tolist() == []